@@ -0,0 +1,364 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `benchmark` module contains classes for generating a corpus of synthetic
+spritefiles and measuring how quickly the classes in the
+[spritefile](spritefile.html) module can read and decode them."""
+
+from java.io import BufferedOutputStream, File, FileOutputStream, \
+                    RandomAccessFile
+from java.lang import Object, String, System, Thread
+from java.nio import ByteBuffer, ByteOrder
+from java.util import List, Random
+
+from android.util import Log
+
+from spritefile import Sprite, Spritefile
+
+"""The following class writes spritefiles containing sprites with random pixel
+and mask data. One file is written for each of the old screen modes described
+by `Spritefile.mode_log2bpp` and for each of the sprite types described by
+`Spritefile.type_bpp`. Each file contains variants of a small and a large
+sprite with and without palettes and masks and, for old screen modes, with
+an unusual number of unused bits at the start of each row."""
+
+class CorpusGenerator(Object):
+
+    __fields__ = {"directory": File, "random": Random}
+    
+    # The dimensions of the small and large sprites in each file.
+    small_width = 34
+    small_height = 17
+    large_width = 320
+    large_height = 256
+    
+    @args(void, [File])
+    def __init__(self, directory):
+    
+        Object.__init__(self)
+        
+        self.directory = directory
+        
+        # Use a fixed seed so that the same corpus is generated each time.
+        self.random = Random(long(1))
+    
+    """This method writes the corpus to the generator's directory, returning a
+    list of the files it created."""
+    
+    @args(List(File), [])
+    def generate(self):
+    
+        self.directory.mkdirs()
+        files = []
+        
+        for mode in range(len(Spritefile.mode_log2bpp)):
+            files.add(self.writeFile("mode" + String.valueOf(mode),
+                                     mode, 1 << Spritefile.mode_log2bpp[mode],
+                                     False))
+        
+        # Type 0 is not used by new format sprites.
+        for sprite_type in range(1, len(Spritefile.type_bpp)):
+            bpp = Spritefile.type_bpp[sprite_type]
+            # New format sprites have 90 dots per inch in each direction.
+            mode_word = (sprite_type << 27) | (90 << 14) | (90 << 1) | 1
+            files.add(self.writeFile("type" + String.valueOf(sprite_type),
+                                     mode_word, bpp, True))
+        
+        return files
+    
+    """This method writes a spritefile containing all the variants of sprites
+    for the given mode word and colour depth."""
+    
+    @args(File, [String, int, int, bool])
+    def writeFile(self, name, mode, bpp, new_format):
+    
+        sprites = []
+        
+        for palette_size in self.paletteSizes(bpp):
+        
+            for has_mask in [False, True]:
+            
+                # Sprites for old screen modes can have unused bits at the
+                # start of each row.
+                first_bits = [0]
+                if not new_format and bpp < 32:
+                    first_bits.add((bpp * 3) % 32)
+                
+                for first_bit in first_bits:
+                
+                    sprite_name = "p" + String.valueOf(palette_size)
+                    if has_mask:
+                        sprite_name += "m"
+                    sprite_name += "f" + String.valueOf(first_bit)
+                    
+                    sprites.add(self.makeSprite(sprite_name + "s", mode, bpp,
+                        self.small_width, self.small_height, first_bit,
+                        has_mask, palette_size, new_format))
+                    sprites.add(self.makeSprite(sprite_name + "l", mode, bpp,
+                        self.large_width, self.large_height, first_bit,
+                        has_mask, palette_size, new_format))
+        
+        # The spritefile header contains the number of sprites, the offset of
+        # the first sprite and the offset of the free space after the last
+        # sprite. Offsets include the size word that is not stored in files.
+        free = 16
+        for data in sprites:
+            free += len(data)
+        
+        header = ByteBuffer.allocate(12)
+        header.order(ByteOrder.LITTLE_ENDIAN)
+        header.putInt(len(sprites))
+        header.putInt(16)
+        header.putInt(free)
+        
+        file = File(self.directory, name + ".spr")
+        stream = BufferedOutputStream(FileOutputStream(file))
+        stream.write(header.array())
+        for data in sprites:
+            stream.write(data)
+        stream.flush()
+        stream.close()
+        
+        return file
+    
+    """We generate sprites without palettes and with each of the palette sizes
+    that are meaningful for each colour depth."""
+    
+    @args(List(int), [int])
+    def paletteSizes(self, bpp):
+    
+        if bpp == 1:
+            return [0, 2]
+        elif bpp == 2:
+            return [0, 4]
+        elif bpp == 4:
+            return [0, 16]
+        elif bpp == 8:
+            return [0, 16, 64, 256]
+        else:
+            return [0]
+    
+    """This method returns the bytes for a single sprite with the given
+    properties, filling its palette, image and mask with random values."""
+    
+    @args([byte], [String, int, int, int, int, int, bool, int, bool])
+    def makeSprite(self, name, mode, bpp, width, height, first_bit, has_mask,
+                   palette_size, new_format):
+        
+        row_bits = first_bit + (width * bpp)
+        h_words = (row_bits + 31) / 32
+        last_bit = (row_bits - 1) % 32
+        
+        image_size = h_words * 4 * height
+        
+        if not has_mask:
+            mask_size = 0
+        elif bpp >= 16:
+            mask_size = ((width + 31) / 32) * 4 * height
+        else:
+            mask_size = image_size
+        
+        image_offset = 44 + (palette_size * 8)
+        size = image_offset + image_size + mask_size
+        
+        buf = ByteBuffer.allocate(size)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        
+        buf.putInt(size)
+        
+        name_bytes = array(byte, 12)
+        encoded = name.getBytes("ASCII")
+        System.arraycopy(encoded, 0, name_bytes, 0, len(encoded))
+        buf.put(name_bytes)
+        
+        buf.putInt(h_words - 1)
+        buf.putInt(height - 1)
+        buf.putInt(first_bit)
+        buf.putInt(last_bit)
+        buf.putInt(image_offset)
+        if has_mask:
+            buf.putInt(image_offset + image_size)
+        else:
+            buf.putInt(image_offset)
+        buf.putInt(mode)
+        
+        # Each palette entry contains a pair of colours, each stored as a word
+        # containing blue, green and red components in its upper three bytes.
+        colour = array(byte, 3)
+        for i in range(palette_size):
+            self.random.nextBytes(colour)
+            for j in range(2):
+                buf.put(byte(0))
+                buf.put(colour)
+        
+        data = array(byte, image_size + mask_size)
+        self.random.nextBytes(data)
+        buf.put(data)
+        
+        return buf.array()
+
+
+"""The following class records the amount of data processed and the time taken
+to process it for one phase of reading a spritefile."""
+
+class Throughput(Object):
+
+    __fields__ = {"bytes": long, "count": int, "ns": long}
+    
+    def __init__(self):
+    
+        Object.__init__(self)
+        self.bytes = long(0)
+        self.count = 0
+        self.ns = long(0)
+    
+    @args(void, [long, int, long])
+    def add(self, bytes, count, ns):
+    
+        self.bytes += bytes
+        self.count += count
+        self.ns += ns
+    
+    """We describe throughput in megabytes per second and sprites per second,
+    using integer arithmetic to obtain a single decimal place for the first."""
+    
+    @args(String, [])
+    def describe(self):
+    
+        if self.ns <= 0:
+            return "n/a"
+        
+        bytes_per_second = (self.bytes * long(1000000000)) / self.ns
+        mb10 = (bytes_per_second * long(10)) / long(1048576)
+        sprites_per_second = (long(self.count) * long(1000000000)) / self.ns
+        
+        return String.valueOf(mb10 / long(10)) + "." + \
+               String.valueOf(mb10 % long(10)) + " MB/s, " + \
+               String.valueOf(sprites_per_second) + " sprites/s"
+
+
+"""The following class measures the rate at which each spritefile in a list is
+indexed and the rates at which the pixels and masks of its sprites are decoded.
+Each phase is repeated a number of times to obtain measurable durations. The
+results are returned as a list of lines of text, one for each file."""
+
+class Benchmark(Object):
+
+    __fields__ = {"files": List(File), "repeats": int}
+    
+    @args(void, [List(File), int])
+    def __init__(self, files, repeats):
+    
+        Object.__init__(self)
+        self.files = files
+        self.repeats = repeats
+    
+    @args(List(String), [])
+    def run(self):
+    
+        lines = []
+        for file in self.files:
+            lines.add(self.measure(file))
+        
+        return lines
+    
+    @args(String, [File])
+    def measure(self, file):
+    
+        index = Throughput()
+        pixels = Throughput()
+        masks = Throughput()
+        
+        # Header indexing
+        spritefile = Spritefile()
+        
+        start = System.nanoTime()
+        for i in range(self.repeats):
+            spritefile.read(file)
+        
+        index.add(file.length() * long(self.repeats),
+                  len(spritefile.sprites) * self.repeats,
+                  System.nanoTime() - start)
+        
+        # Spritefile instances can decode sprites using several threads. We
+        # measure the work done in a single thread.
+        spritefile.setDecodeThreads(1)
+        
+        f = RandomAccessFile(file, "r")
+        
+        for name in spritefile.sprites.keySet():
+        
+            sprite = spritefile.sprites[name]
+            spritefile.read_header(f, sprite)
+            
+            image_size = sprite.h_words * 4 * sprite.v_lines
+            image = spritefile.read_block(f, sprite.image_ptr, image_size)
+            rgba = array(byte, sprite.width * sprite.height * 4)
+            
+            # Pixel decoding
+            start = System.nanoTime()
+            for i in range(self.repeats):
+                spritefile.decode_rows(sprite, image, None, rgba, 0,
+                                       sprite.height)
+            
+            pixels.add(long(image_size) * long(self.repeats), self.repeats,
+                       System.nanoTime() - start)
+            
+            if sprite.mask_ptr == sprite.image_ptr:
+                continue
+            
+            mask_size = spritefile.mask_row_words(sprite) * 4 * sprite.height
+            mask = spritefile.read_block(f, sprite.mask_ptr, mask_size)
+            
+            # Mask decoding
+            start = System.nanoTime()
+            for i in range(self.repeats):
+                spritefile.mask2rgba(mask, sprite, rgba, 0, sprite.height)
+            
+            masks.add(long(mask_size) * long(self.repeats), self.repeats,
+                      System.nanoTime() - start)
+        
+        f.close()
+        
+        return file.getName() + ": index " + index.describe() + \
+               "; pixels " + pixels.describe() + "; masks " + masks.describe()
+
+
+"""The following class generates a corpus in a given directory and runs the
+benchmark on it in a background thread, writing the results to the system log
+with the `SpriteViewer` tag."""
+
+class BenchmarkTask(Thread):
+
+    __fields__ = {"directory": File}
+    
+    repeats = 5
+    
+    @args(void, [File])
+    def __init__(self, directory):
+    
+        Thread.__init__(self)
+        self.directory = directory
+    
+    def run(self):
+    
+        Log.i("SpriteViewer", "Generating benchmark corpus in " + \
+              self.directory.getPath())
+        files = CorpusGenerator(self.directory).generate()
+        
+        for line in Benchmark(files, self.repeats).run():
+            Log.i("SpriteViewer", line)
+        
+        Log.i("SpriteViewer", "Benchmark finished")
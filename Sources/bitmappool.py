@@ -0,0 +1,299 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `bitmappool` module provides a class for reusing the bitmaps used to
+show previews of sprites, together with the chequered images shown behind
+them. It also converts finished previews to more compact pixel formats when
+they can be stored in them without loss."""
+
+from java.lang import Math, Object
+from java.nio import ByteBuffer
+from java.util.concurrent import ConcurrentLinkedQueue
+from java.util.concurrent.atomic import AtomicInteger
+
+from android.graphics import Bitmap, BitmapShader, Canvas, Color, Paint, \
+                             PorterDuff, Shader
+from android.graphics.drawable import BitmapDrawable, ColorDrawable, \
+                                      Drawable, InsetDrawable, LayerDrawable
+from android.widget import ImageView
+
+from profiling import Profiler
+
+"""The following class holds a number of bitmaps of a fixed size that are not
+currently in use, so that new previews can be drawn into them instead of into
+newly allocated bitmaps. Bitmaps can be obtained and returned from any thread.
+
+The pool also holds an immutable placeholder image of the same size, shown in
+every view whose sprite is being rendered, a similar image marked with a cross
+that is shown for sprites that cannot be decoded, and a tile of the lighter
+chequered pattern shown behind finished previews. Previews are drawn on
+transparent bitmaps and the pattern is drawn as the background of each view
+that shows them, so that compact previews only need to hold the pixels of the
+sprite."""
+
+class BitmapPool(Object):
+
+    __fields__ = {
+        "width": int, "height": int, "capacity": int,
+        "free": ConcurrentLinkedQueue(Bitmap), "size": AtomicInteger,
+        "placeholder": Bitmap, "failure": Bitmap, "tile": Bitmap,
+        "profiler": Profiler
+        }
+    
+    # The size of the squares in the chequered pattern.
+    square = 16
+    
+    @args(void, [int, int, int, Profiler])
+    def __init__(self, width, height, capacity, profiler):
+    
+        Object.__init__(self)
+        
+        self.width = width
+        self.height = height
+        self.capacity = capacity
+        self.profiler = profiler
+        
+        self.free = ConcurrentLinkedQueue()
+        self.size = AtomicInteger(0)
+        
+        placeholder = self.chequered(width, height, False)
+        self.placeholder = placeholder.copy(Bitmap.Config.ARGB_8888, False)
+        failure = self.crossed(placeholder)
+        self.failure = failure.copy(Bitmap.Config.ARGB_8888, False)
+        self.tile = self.chequerTile(True)
+    
+    """The following method returns a mutable, transparent bitmap, reusing one
+    from the pool if possible."""
+    
+    @args(Bitmap, [])
+    def acquire(self):
+    
+        bitmap = self.free.poll()
+        
+        if bitmap != None:
+            self.size.decrementAndGet()
+        else:
+            bitmap = Bitmap.createBitmap(self.width, self.height,
+                                         Bitmap.Config.ARGB_8888)
+            self.profiler.count(Profiler.ALLOCATED,
+                                long(bitmap.getByteCount()))
+        
+        bitmap.eraseColor(Color.TRANSPARENT)
+        return bitmap
+    
+    """This method returns a bitmap to the pool when it is no longer displayed.
+    Bitmaps of other sizes or formats and bitmaps returned to a full pool are
+    left for the garbage collector."""
+    
+    @args(void, [Bitmap])
+    def release(self, bitmap):
+    
+        if bitmap == None or not bitmap.isMutable() or \
+           bitmap.getConfig() != Bitmap.Config.ARGB_8888 or \
+           bitmap.getWidth() != self.width or \
+           bitmap.getHeight() != self.height:
+            return
+        
+        if self.size.incrementAndGet() > self.capacity:
+            self.size.decrementAndGet()
+            return
+        
+        self.free.add(bitmap)
+    
+    """The following method returns a version of a finished preview that uses
+    less memory if one can be made without changing any pixels, returning the
+    original bitmap to the pool. The sprite is drawn in the middle of the
+    preview, so the compact version only holds the rectangle it occupies,
+    which must be opaque. Sprites containing only shades of grey are stored
+    with one byte per pixel, and sprites containing only colours that can be
+    represented exactly with 16 bits are stored in that form. Other previews
+    are returned unchanged."""
+    
+    @args(Bitmap, [Bitmap])
+    def compact(self, preview):
+    
+        width = preview.getWidth()
+        height = preview.getHeight()
+        pixels = array(int, width * height)
+        preview.getPixels(pixels, 0, width, 0, 0, width, height)
+        
+        # Find the rectangle containing the sprite.
+        left = width
+        right = -1
+        top = height
+        bottom = -1
+        for y in range(height):
+            for x in range(width):
+                if (pixels[(y * width) + x] >> 24) & 0xff != 0:
+                    left = Math.min(left, x)
+                    right = Math.max(right, x)
+                    top = Math.min(top, y)
+                    bottom = Math.max(bottom, y)
+        
+        if right == -1:
+            return preview
+        
+        w = right - left + 1
+        h = bottom - top + 1
+        
+        grey = True
+        exact = True
+        
+        for y in range(top, bottom + 1):
+            for x in range(left, right + 1):
+            
+                pixel = pixels[(y * width) + x]
+                
+                if (pixel >> 24) & 0xff != 0xff:
+                    return preview
+                
+                r = (pixel >> 16) & 0xff
+                g = (pixel >> 8) & 0xff
+                b = pixel & 0xff
+                
+                if r != g or g != b:
+                    grey = False
+                
+                # Expanding 5 and 6 bit components to 8 bits replicates their
+                # upper bits in the lowest bits.
+                if ((r >> 3) << 3) | (r >> 5) != r or \
+                   ((g >> 2) << 2) | (g >> 6) != g or \
+                   ((b >> 3) << 3) | (b >> 5) != b:
+                    exact = False
+                
+                if not grey and not exact:
+                    return preview
+        
+        if grey:
+            compacted = Bitmap.createBitmap(w, h, Bitmap.Config.ALPHA_8)
+            row_bytes = compacted.getRowBytes()
+            levels = array(byte, row_bytes * h)
+            for y in range(h):
+                for x in range(w):
+                    levels[(y * row_bytes) + x] = \
+                        byte(pixels[((top + y) * width) + left + x] & 0xff)
+            compacted.copyPixelsFromBuffer(ByteBuffer.wrap(levels))
+        else:
+            compacted = Bitmap.createBitmap(w, h, Bitmap.Config.RGB_565)
+            compacted.setPixels(pixels, (top * width) + left, width, 0, 0,
+                                w, h)
+        
+        self.release(preview)
+        return compacted
+    
+    """The following method shows a preview or placeholder of this pool's size
+    in a view, drawing the chequered pattern behind it. Compact previews are
+    placed in the middle of the area of a whole preview so that they are scaled
+    in the same way as other previews. Previews that only contain levels of
+    grey are stored as alpha values, so they are drawn as white on a black
+    rectangle to be shown correctly."""
+    
+    @args(void, [ImageView, Bitmap])
+    def show(self, view, bitmap):
+    
+        background = BitmapDrawable(view.getResources(), self.tile)
+        background.setTileModeXY(Shader.TileMode.REPEAT,
+                                 Shader.TileMode.REPEAT)
+        view.setBackgroundDrawable(background)
+        
+        width = bitmap.getWidth()
+        height = bitmap.getHeight()
+        config = bitmap.getConfig()
+        
+        if width == self.width and height == self.height and \
+           config != Bitmap.Config.ALPHA_8:
+            view.setImageBitmap(bitmap)
+            return
+        
+        image = BitmapDrawable(view.getResources(), bitmap)
+        left = (self.width - width)/2
+        top = (self.height - height)/2
+        right = self.width - width - left
+        bottom = self.height - height - top
+        
+        if config == Bitmap.Config.ALPHA_8:
+            image.setColorFilter(Color.WHITE, PorterDuff.Mode.SRC_IN)
+            layers = array(Drawable, 2)
+            layers[0] = ColorDrawable(Color.BLACK)
+            layers[1] = image
+            inset = InsetDrawable(LayerDrawable(layers), left, top, right,
+                                  bottom)
+        else:
+            inset = InsetDrawable(image, left, top, right, bottom)
+        
+        view.setImageDrawable(inset)
+    
+    """We create chequered images by filling them with a repeating tile that
+    contains two squares of each shade."""
+    
+    @static
+    @args(Bitmap, [int, int, bool])
+    def chequered(width, height, ready):
+    
+        paint = Paint()
+        paint.setShader(BitmapShader(BitmapPool.chequerTile(ready),
+            Shader.TileMode.REPEAT, Shader.TileMode.REPEAT))
+        
+        bitmap = Bitmap.createBitmap(width, height, Bitmap.Config.ARGB_8888)
+        Canvas(bitmap).drawPaint(paint)
+        return bitmap
+    
+    """The following method draws a cross over the middle of a bitmap,
+    returning the bitmap. It is used to mark the previews of sprites that
+    cannot be decoded."""
+    
+    @static
+    @args(Bitmap, [Bitmap])
+    def crossed(bitmap):
+    
+        w = bitmap.getWidth()
+        h = bitmap.getHeight()
+        s = Math.min(w, h)/4
+        
+        paint = Paint(Paint.ANTI_ALIAS_FLAG)
+        paint.setColor(Color.argb(255, 192, 32, 32))
+        paint.setStrokeWidth(float(Math.max(2, s/4)))
+        paint.setStrokeCap(Paint.Cap.ROUND)
+        
+        canvas = Canvas(bitmap)
+        canvas.drawLine(w/2 - s, h/2 - s, w/2 + s, h/2 + s, paint)
+        canvas.drawLine(w/2 + s, h/2 - s, w/2 - s, h/2 + s, paint)
+        return bitmap
+    
+    """This method returns the tile used to create a chequered pattern, using
+    lighter shades for the background of previews than for placeholders."""
+    
+    @static
+    @args(Bitmap, [bool])
+    def chequerTile(ready):
+    
+        if ready:
+            b1 = Color.argb(255, 96, 96, 96)
+            b2 = Color.argb(255, 128, 128, 128)
+        else:
+            b1 = Color.argb(255, 32, 32, 32)
+            b2 = Color.argb(255, 64, 64, 64)
+        
+        s = BitmapPool.square
+        colours = array(int, 4 * s * s)
+        for y in range(2 * s):
+            for x in range(2 * s):
+                if (x / s) == (y / s):
+                    colours[(y * 2 * s) + x] = b2
+                else:
+                    colours[(y * 2 * s) + x] = b1
+        
+        return Bitmap.createBitmap(colours, 2 * s, 2 * s,
+                                   Bitmap.Config.ARGB_8888)
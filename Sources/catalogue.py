@@ -0,0 +1,320 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `catalogue` module provides classes for maintaining a database of the
+sprites contained in spritefiles so that sprites can be found by name without
+reading each file."""
+
+from java.io import File, RandomAccessFile
+from java.lang import Object, Runnable, String
+from java.util import HashSet, List
+from java.util.concurrent import ExecutorService, Executors
+
+from android.content import Context
+from android.database.sqlite import SQLiteDatabase, SQLiteOpenHelper
+from android.util import Log
+
+from discovery import DiscoveryListener
+from spritefile import Spritefile, SpritefileHeader
+
+"""The following class describes a sprite found in the catalogue. Its mode is
+the mode word from the sprite's header, which holds either an old screen mode
+number or the type and resolution of a new format sprite."""
+
+class CatalogueEntry(Object):
+
+    __fields__ = {
+        "path": String, "name": String,
+        "width": int, "height": int, "bpp": int,
+        "mode": int, "has_mask": bool
+        }
+    
+    @args(void, [String, String, int, int, int, int, bool])
+    def __init__(self, path, name, width, height, bpp, mode, has_mask):
+    
+        Object.__init__(self)
+        self.path = path
+        self.name = name
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.mode = mode
+        self.has_mask = has_mask
+
+
+"""The following class manages a SQLite database containing a table of
+spritefiles, recording the modification time and length of each file when it
+was catalogued, and a table of the sprites in each file. The sprites table is
+indexed by name, ignoring case, and by dimensions so that searches do not need
+to examine every sprite.
+
+Files are only catalogued again if their modification time or length has
+changed. Each sprite is described using the information in its header, so no
+image data is decoded."""
+
+class Catalogue(SQLiteOpenHelper):
+
+    DATABASE = "catalogue.db"
+    # Version 2 stores the mode word of each sprite instead of the form of its
+    # decoded pixels.
+    VERSION = 2
+    
+    @args(void, [Context])
+    def __init__(self, context):
+    
+        SQLiteOpenHelper.__init__(self, context, self.DATABASE, None,
+                                  self.VERSION)
+    
+    @args(void, [SQLiteDatabase])
+    def onCreate(self, db):
+    
+        db.execSQL("CREATE TABLE files (id INTEGER PRIMARY KEY, "
+                   "path TEXT UNIQUE NOT NULL, mtime INTEGER, length INTEGER)")
+        db.execSQL("CREATE TABLE sprites (file INTEGER NOT NULL, "
+                   "name TEXT NOT NULL, data_offset INTEGER, width INTEGER, "
+                   "height INTEGER, mode INTEGER, bpp INTEGER, "
+                   "has_mask INTEGER)")
+        db.execSQL("CREATE INDEX sprites_name ON sprites "
+                   "(name COLLATE NOCASE)")
+        db.execSQL("CREATE INDEX sprites_size ON sprites (width, height)")
+        db.execSQL("CREATE INDEX sprites_file ON sprites (file)")
+    
+    @args(void, [SQLiteDatabase, int, int])
+    def onUpgrade(self, db, oldVersion, newVersion):
+    
+        db.execSQL("DROP TABLE IF EXISTS sprites")
+        db.execSQL("DROP TABLE IF EXISTS files")
+        self.onCreate(db)
+    
+    """The following method adds a file to the catalogue or updates its entries
+    if it has changed since it was last catalogued, returning `True` if the
+    catalogue was changed. Files that cannot be read are removed. If the
+    entries cannot be written, the catalogue is left unchanged, the failure is
+    logged and `False` is returned, so the file is catalogued again the next
+    time it is found."""
+    
+    @args(bool, [File])
+    def update(self, file):
+    
+        db = self.getWritableDatabase()
+        path = file.getPath()
+        mtime = file.lastModified()
+        length = file.length()
+        
+        cursor = db.rawQuery("SELECT mtime, length FROM files WHERE path = ?",
+                             array([path]))
+        unchanged = cursor.moveToFirst() and cursor.getLong(0) == mtime and \
+                    cursor.getLong(1) == length
+        cursor.close()
+        
+        if unchanged:
+            return False
+        
+        try:
+            spritefile = Spritefile(file)
+        except:
+            self.remove(file)
+            return True
+        
+        # Replace any existing entries in a single transaction, which is rolled
+        # back if the file cannot be read.
+        inserted = False
+        db.beginTransaction()
+        try:
+            self.deleteFile(db, path)
+            inserted = self.insertFile(db, file, spritefile)
+        except:
+            inserted = False
+        
+        if inserted:
+            db.setTransactionSuccessful()
+        else:
+            Log.w("SpriteViewer", "Failed to catalogue " + path)
+        
+        db.endTransaction()
+        return inserted
+    
+    """This method inserts the entries for a file and its sprites, returning
+    `False` if they could not all be written. The file is closed in either
+    case."""
+    
+    @args(bool, [SQLiteDatabase, File, Spritefile])
+    def insertFile(self, db, file, spritefile):
+    
+        statement = db.compileStatement(
+            "INSERT INTO files (path, mtime, length) VALUES (?, ?, ?)")
+        statement.bindString(1, file.getPath())
+        statement.bindLong(2, file.lastModified())
+        statement.bindLong(3, file.length())
+        file_id = statement.executeInsert()
+        
+        statement = db.compileStatement(
+            "INSERT INTO sprites (file, name, data_offset, width, height, "
+            "mode, bpp, has_mask) VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+        
+        f = RandomAccessFile(file, "r")
+        failed = False
+        
+        try:
+            for sprite in spritefile.sprites.values():
+            
+                try:
+                    spritefile.read_header(f, sprite)
+                except:
+                    # Sprites with unknown modes are not catalogued.
+                    continue
+                
+                statement.bindLong(1, file_id)
+                statement.bindString(2, sprite.name)
+                statement.bindLong(3, long(sprite.offset))
+                statement.bindLong(4, long(sprite.width))
+                statement.bindLong(5, long(sprite.height))
+                statement.bindLong(6, long(sprite.mode_word))
+                statement.bindLong(7, long(sprite.bpp))
+                if sprite.mask_ptr != sprite.image_ptr:
+                    statement.bindLong(8, long(1))
+                else:
+                    statement.bindLong(8, long(0))
+                statement.executeInsert()
+        except:
+            failed = True
+        
+        f.close()
+        return not failed
+    
+    """This method removes a file and its sprites from the catalogue."""
+    
+    @args(void, [File])
+    def remove(self, file):
+    
+        self.deleteFile(self.getWritableDatabase(), file.getPath())
+    
+    @args(void, [SQLiteDatabase, String])
+    def deleteFile(self, db, path):
+    
+        values = array([path])
+        db.execSQL("DELETE FROM sprites WHERE file IN "
+                   "(SELECT id FROM files WHERE path = ?)", values)
+        db.execSQL("DELETE FROM files WHERE path = ?", values)
+    
+    """The following method removes all files from the catalogue except those
+    in the given list."""
+    
+    @args(void, [List(File)])
+    def retain(self, files):
+    
+        paths = HashSet()
+        for file in files:
+            paths.add(file.getPath())
+        
+        db = self.getWritableDatabase()
+        cursor = db.rawQuery("SELECT path FROM files", None)
+        stale = []
+        while cursor.moveToNext():
+            path = cursor.getString(0)
+            if not paths.contains(path):
+                stale.add(path)
+        cursor.close()
+        
+        for path in stale:
+            self.deleteFile(db, path)
+    
+    """This method returns up to `limit` sprites whose names start with the
+    given text, ignoring case, ordered by name. The query can use the index on
+    sprite names, so it does not need to examine every sprite."""
+    
+    @args(List(CatalogueEntry), [String, int])
+    def search(self, text, limit):
+    
+        # Escape characters with special meanings in patterns.
+        pattern = text.replace("\\", "\\\\").replace("%", "\\%")
+        pattern = pattern.replace("_", "\\_")
+        
+        db = self.getReadableDatabase()
+        cursor = db.rawQuery(
+            "SELECT files.path, sprites.name, sprites.width, sprites.height, "
+            "sprites.bpp, sprites.mode, sprites.has_mask "
+            "FROM sprites JOIN files ON sprites.file = files.id "
+            "WHERE sprites.name LIKE ? ESCAPE '\\' "
+            "ORDER BY sprites.name COLLATE NOCASE LIMIT " + \
+            String.valueOf(limit),
+            array([pattern + "%"]))
+        
+        entries = []
+        while cursor.moveToNext():
+            entries.add(CatalogueEntry(cursor.getString(0),
+                cursor.getString(1), cursor.getInt(2), cursor.getInt(3),
+                cursor.getInt(4), cursor.getInt(5), cursor.getInt(6) != 0))
+        
+        cursor.close()
+        return entries
+
+
+"""The following class keeps a catalogue up to date with the results of
+searches for spritefiles, cataloguing each file in a background thread as it
+is found and removing files that no longer exist when a search is finished."""
+
+class CatalogueIndexer(Object):
+
+    __interfaces__ = [DiscoveryListener]
+    
+    __fields__ = {"catalogue": Catalogue, "executor": ExecutorService}
+    
+    @args(void, [Catalogue])
+    def __init__(self, catalogue):
+    
+        Object.__init__(self)
+        self.catalogue = catalogue
+        self.executor = Executors.newSingleThreadExecutor()
+    
+    @args(void, [File, SpritefileHeader])
+    def fileFound(self, file, header):
+    
+        self.executor.execute(CatalogueTask(self.catalogue, file, None))
+    
+    @args(void, [List(File)])
+    def discoveryFinished(self, files):
+    
+        self.executor.execute(CatalogueTask(self.catalogue, None, files))
+
+
+"""This class represents the task of cataloguing a file or, if a list of files
+is given instead, of removing other files from the catalogue."""
+
+class CatalogueTask(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"catalogue": Catalogue, "file": File, "files": List(File)}
+    
+    @args(void, [Catalogue, File, List(File)])
+    def __init__(self, catalogue, file, files):
+    
+        Object.__init__(self)
+        self.catalogue = catalogue
+        self.file = file
+        self.files = files
+    
+    def run(self):
+    
+        try:
+            if self.file != None:
+                self.catalogue.update(self.file)
+            else:
+                self.catalogue.retain(self.files)
+        except:
+            # Failing to catalogue a file only means that its sprites cannot be
+            # found by searching.
+            pass
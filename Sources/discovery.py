@@ -0,0 +1,220 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `discovery` module provides classes for finding spritefiles in
+directory trees using a pool of background threads."""
+
+from java.io import File
+from java.lang import Math, Object, Runnable, Runtime, String
+from java.util import Collections, List
+from java.util.concurrent import ConcurrentHashMap, ExecutorService, Executors
+from java.util.concurrent.atomic import AtomicInteger, AtomicReference
+
+from spritefile import SpritefileHeader
+
+"""We define an interface that other components can implement to receive the
+results of a search. Any number of listeners can be registered with a service.
+The `fileFound` method is called as each spritefile is found, with the header
+that was read to recognise it, and the `discoveryFinished` method is called
+with a list of all the files found once the search is complete. Both methods
+are called in background threads."""
+
+class DiscoveryListener:
+
+    @args(void, [File, SpritefileHeader])
+    def fileFound(self, file, header):
+        pass
+    
+    @args(void, [List(File)])
+    def discoveryFinished(self, files):
+        pass
+
+
+"""The following class searches a list of root directories and their
+subdirectories for spritefiles. Each directory is examined by a separate task
+in a pool containing a bounded number of threads.
+
+Files with one of the recognised suffixes and files without a suffix are
+accepted if they start with a plausible spritefile header. Hidden directories
+are not searched, and each directory is only searched once even if it can be
+reached by more than one path.
+
+A search requested while another is in progress is started when the current
+one has finished, searching the roots given in the most recent request."""
+
+class DiscoveryService(Object):
+
+    __fields__ = {
+        "listeners": List(DiscoveryListener),
+        "suffixes": List(String),
+        "executor": ExecutorService,
+        "tasks": AtomicInteger,
+        "restart": AtomicReference(List(File)),
+        "visited": ConcurrentHashMap(String, bool),
+        "found": List(File)
+        }
+    
+    # The maximum depth of subdirectories to search below each root.
+    max_depth = 8
+    
+    @args(void, [DiscoveryListener, List(String)])
+    def __init__(self, listener, suffixes):
+    
+        Object.__init__(self)
+        
+        self.listeners = [listener]
+        self.suffixes = suffixes
+        
+        processors = Runtime.getRuntime().availableProcessors()
+        threads = Math.max(1, Math.min(4, processors))
+        self.executor = Executors.newFixedThreadPool(threads)
+        self.tasks = AtomicInteger(0)
+        self.restart = AtomicReference()
+    
+    """Other listeners can be registered with the following method before a
+    search is started."""
+    
+    @args(void, [DiscoveryListener])
+    def addListener(self, listener):
+    
+        self.listeners.add(listener)
+    
+    """This method starts a search of the given root directories, or queues it
+    to be started when the search in progress has finished."""
+    
+    @args(void, [List(File)])
+    def start(self, roots):
+    
+        self.restart.set(roots)
+        self.startQueued()
+    
+    """The following method starts the queued search if no search is in
+    progress. The number of outstanding tasks is set to -1 while a search is
+    being started, so only one thread can start it. The thread that finishes a
+    search calls this method again to start any search queued meanwhile."""
+    
+    @args(void, [])
+    def startQueued(self):
+    
+        if not self.tasks.compareAndSet(0, -1):
+            return
+        
+        roots = self.restart.getAndSet(None)
+        
+        if roots == None or len(roots) == 0:
+            self.tasks.set(0)
+            # Another search may have been queued while this one was claimed.
+            if self.restart.get() != None:
+                self.startQueued()
+            return
+        
+        self.visited = ConcurrentHashMap()
+        self.found = Collections.synchronizedList([])
+        
+        # Count the roots before submitting any tasks so that the search is not
+        # considered to be finished before all of them have been searched.
+        self.tasks.set(len(roots))
+        
+        for root in roots:
+            self.executor.execute(DirectorySearch(self, root, 0))
+    
+    @args(bool, [])
+    def isRunning(self):
+    
+        return self.tasks.get() != 0
+    
+    """The following method is called by each task to search a directory. When
+    the last outstanding task has finished, the listener is given the list of
+    all the files found."""
+    
+    @args(void, [File, int])
+    def search(self, directory, depth):
+    
+        try:
+            self.searchDirectory(directory, depth)
+        except:
+            # Unreadable directories are skipped.
+            pass
+        
+        if self.tasks.decrementAndGet() == 0:
+            for listener in self.listeners:
+                listener.discoveryFinished(self.found)
+            
+            self.startQueued()
+    
+    """This method submits new tasks for the subdirectories of a directory and
+    reports any spritefiles that it contains."""
+    
+    @args(void, [File, int])
+    def searchDirectory(self, directory, depth):
+    
+        path = directory.getCanonicalPath()
+        if self.visited.putIfAbsent(path, True) != None:
+            return
+        
+        entries = directory.listFiles()
+        if entries == None:
+            return
+        
+        for file in entries:
+        
+            name = file.getName()
+            
+            if file.isDirectory():
+                if depth < self.max_depth and not name.startsWith("."):
+                    self.tasks.incrementAndGet()
+                    self.executor.execute(DirectorySearch(self, file,
+                                                          depth + 1))
+            
+            elif self.isCandidate(name):
+                header = SpritefileHeader.read(file)
+                if header != None:
+                    self.found.add(file)
+                    for listener in self.listeners:
+                        listener.fileFound(file, header)
+    
+    """This method reports whether a file name has one of the recognised
+    suffixes or has no suffix at all."""
+    
+    @args(bool, [String])
+    def isCandidate(self, name):
+    
+        lower = name.toLowerCase()
+        for suffix in self.suffixes:
+            if lower.endsWith(suffix):
+                return True
+        
+        return lower.indexOf(".") == -1 and lower.indexOf(",") == -1
+
+
+"""The following class represents the task of searching a single directory."""
+
+class DirectorySearch(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"service": DiscoveryService, "directory": File, "depth": int}
+    
+    @args(void, [DiscoveryService, File, int])
+    def __init__(self, service, directory, depth):
+    
+        Object.__init__(self)
+        self.service = service
+        self.directory = directory
+        self.depth = depth
+    
+    def run(self):
+    
+        self.service.search(self.directory, self.depth)
@@ -17,49 +17,447 @@
 spritefiles."""
 
 from java.io import File
-from java.lang import String
-from java.util import List
+from java.lang import Object, Runnable, String
+from java.util import Arrays, Collections, HashSet, LinkedHashMap, List, Set
+from java.util.concurrent import ExecutorService, Executors
+from java.util.concurrent.atomic import AtomicBoolean
 
-from android.os import Environment
+from android.content import Context
+from android.os import Environment, FileObserver, Handler
 from android.util import TypedValue
 from android.view import View, ViewGroup
-from android.widget import AdapterView, LinearLayout, ListView, TextView
+from android.widget import AdapterView, BaseAdapter, LinearLayout, ListView, \
+                           TextView
 
-from serpentine.adapters import FileListAdapter
+from discovery import DiscoveryListener, DiscoveryService
+from spritefile import SpritefileHeader
 
-"""The following class defines an adapter that exposes names of files in a
-directory with particular file suffixes."""
+"""The following class defines an adapter that exposes names of spritefiles
+found in a list of root directories and their subdirectories.
 
-class SpriteFileListAdapter(FileListAdapter):
+The adapter keeps a sorted list of files that is filled by a `DiscoveryService`
+searching the directories in background threads, with each file being added to
+the list as it is found. The list is then kept up to date by applying the
+changes to each root directory reported by a `DirectoryObserver`, so the
+directories do not need to be searched again each time the list is shown.
+They are only searched again if the roots change, if a root directory was
+modified while it was not being watched, or if an observer saw a new
+subdirectory, whose contents it cannot watch. The adapter notifies its views
+whenever the list changes.
 
-    @args(void, [File, List(String)])
-    def __init__(self, directory, suffixes):
+Each item in the list also shows the number of sprites in the file and its
+size. This information comes from the file's header, which is supplied with
+each file found by the search or by an observer. Headers that were not
+supplied are read in a background thread when the item is first shown. The
+headers are cached using the path of each file as a key and are replaced
+whenever a file is found again or written, so the files are not examined in
+the main UI thread. Only the most recently used headers are kept."""
+
+class SpriteFileListAdapter(BaseAdapter):
+
+    __interfaces__ = [DiscoveryListener]
+    
+    __fields__ = {
+        "roots": List(File),
+        "suffixes": List(String),
+        "items": List(File),
+        "observers": List(DirectoryObserver),
+        "discovery": DiscoveryService,
+        "watching": bool,
+        "rescan": AtomicBoolean,
+        "root_times": [long],
+        "headers": LinkedHashMap(String, SpritefileHeader),
+        "requested": Set(String),
+        "reader": ExecutorService
+        }
+    
+    # The maximum number of headers kept.
+    header_limit = 256
+    
+    @args(void, [List(File), List(String)])
+    def __init__(self, roots, suffixes):
+    
+        BaseAdapter.__init__(self)
+        
+        self.suffixes = suffixes
+        self.items = []
+        
+        self.handler = Handler()
+        self.discovery = DiscoveryService(self, suffixes)
+        self.watching = False
+        self.rescan = AtomicBoolean(True)
+        self.root_times = None
+        self.setRoots(roots)
+        
+        # Keep the headers in order of access so that the least recently used
+        # one can be discarded.
+        self.headers = LinkedHashMap(16, float(0.75), True)
+        self.requested = HashSet()
+        self.reader = Executors.newSingleThreadExecutor()
+    
+    def getCount(self):
+        return len(self.items)
+    
+    def getItem(self, position):
+        return self.items[position]
     
-        FileListAdapter.__init__(self, directory, suffixes)
+    def getItemId(self, position):
+        return long(position)
     
     def getView(self, position, convertView, parent):
     
-        view = FileListAdapter.getView(self, position, convertView, parent)
-        CAST(view, TextView).setTextSize(TypedValue.COMPLEX_UNIT_SP, float(20))
-        return view
+        if convertView == None:
+            row = FileRow(parent.getContext())
+        else:
+            row = CAST(convertView, FileRow)
+        
+        file = self.items[position]
+        row.setText(file.getName(), self.describe(file))
+        return row
     
-    """We define a method to obtain a new list of file names and report whether
-    the list has changed."""
+    """The following method returns a description of the contents of a file
+    if its header has been read. Otherwise, it requests that the header be read
+    in a background thread and returns a placeholder description."""
     
-    @args(bool, [])
-    def update(self):
+    @args(String, [File])
+    def describe(self, file):
     
-        items = self.items
-        self.items = []
+        key = file.getPath()
         
-        for suffix in self.suffixes:
-            self.addFiles(suffix)
+        if not self.headers.containsKey(key):
+            # Only request each header once.
+            if self.requested.add(key):
+                self.reader.execute(HeaderTask(self, file, key))
+            return "Reading..."
+        
+        header = self.headers[key]
+        if header == None:
+            return "Not a spritefile"
+        
+        return String.valueOf(header.number) + " sprites, " + \
+               String.valueOf((header.length + long(1023)) / long(1024)) + \
+               " KB, in " + file.getParentFile().getName()
+    
+    """This method is called in the main UI thread when a header has been read,
+    or `None` if the file is not a spritefile, updating the views."""
+    
+    @args(void, [String, SpritefileHeader])
+    def headerRead(self, key, header):
+    
+        self.requested.remove(key)
+        self.putHeader(key, header)
+        self.notifyDataSetChanged()
+    
+    """The following method caches a header, discarding the least recently
+    used headers if too many are cached."""
+    
+    @args(void, [String, SpritefileHeader])
+    def putHeader(self, key, header):
+    
+        self.headers[key] = header
+        
+        while len(self.headers) > self.header_limit:
+            it = self.headers.keySet().iterator()
+            it.next()
+            it.remove()
+    
+    """This method changes the directories that are searched for spritefiles,
+    searching the new directories if the adapter is watching for changes."""
+    
+    @args(void, [List(File)])
+    def setRoots(self, roots):
+    
+        watching = self.watching
+        self.stopWatching()
+        
+        self.roots = roots
+        self.observers = []
+        for root in roots:
+            self.observers.add(DirectoryObserver(self, root))
+        
+        self.rescan.set(True)
+        
+        if watching:
+            self.startWatching()
+    
+    """The following method starts watching the root directories for changes,
+    also starting a background search to pick up any changes that may have
+    been made while they were not being watched. It does nothing if the
+    directories are already being watched."""
+    
+    @args(void, [])
+    def startWatching(self):
+    
+        if self.watching:
+            return
+        
+        self.watching = True
+        for observer in self.observers:
+            observer.startWatching()
+        
+        changed = self.rescan.getAndSet(False)
+        if self.root_times == None or not Arrays.equals(self.root_times,
+                                                        self.rootTimes()):
+            changed = True
+        
+        if changed:
+            self.discovery.start(self.roots)
+    
+    """When the adapter stops watching the root directories, it records their
+    modification times so that it can tell whether files were added to them or
+    removed from them in the meantime."""
+    
+    @args(void, [])
+    def stopWatching(self):
+    
+        if self.watching:
+            for observer in self.observers:
+                observer.stopWatching()
+            self.watching = False
+            self.root_times = self.rootTimes()
+    
+    @args([long], [])
+    def rootTimes(self):
+    
+        times = array(long, len(self.roots))
+        for i in range(len(self.roots)):
+            times[i] = self.roots[i].lastModified()
         
-        for item1, item2 in zip(items, self.items):
-            if item1 != item2:
+        return times
+    
+    """This method reports whether a file name has one of the suffixes that the
+    adapter is interested in."""
+    
+    @args(bool, [String])
+    def matches(self, name):
+    
+        lower = name.toLowerCase()
+        for suffix in self.suffixes:
+            if lower.endsWith(suffix):
                 return True
         
         return False
+    
+    """The discovery service calls the following methods in background threads.
+    We post the results to the main UI thread so that they can be applied."""
+    
+    @args(void, [File, SpritefileHeader])
+    def fileFound(self, file, header):
+    
+        self.post(FileChange(self, file, True, header))
+    
+    @args(void, [List(File)])
+    def discoveryFinished(self, files):
+    
+        self.post(DiscoveryResult(self, files))
+    
+    """Results of searches and changes reported by the observers are posted to
+    the main UI thread so that they can be applied using the following methods.
+    """
+    
+    @args(void, [Runnable])
+    def post(self, runnable):
+    
+        self.handler.post(runnable)
+    
+    """Files are added with their headers if these are known. Otherwise, any
+    cached header is discarded because the file may have changed."""
+    
+    @args(void, [File, SpritefileHeader])
+    def addFile(self, file, header):
+    
+        if header != None:
+            self.putHeader(file.getPath(), header)
+        else:
+            self.headers.remove(file.getPath())
+        
+        index = Collections.binarySearch(self.items, file)
+        if index < 0:
+            self.items.add(-index - 1, file)
+        
+        self.notifyDataSetChanged()
+    
+    @args(void, [File])
+    def removeFile(self, file):
+    
+        self.headers.remove(file.getPath())
+        
+        index = Collections.binarySearch(self.items, file)
+        if index >= 0:
+            self.items.remove(index)
+            self.notifyDataSetChanged()
+    
+    """When a search is complete, files that were not found are removed from
+    the list because they were deleted while the directories were not being
+    watched."""
+    
+    @args(void, [List(File)])
+    def retainFiles(self, files):
+    
+        if self.items.retainAll(HashSet(files)):
+            self.notifyDataSetChanged()
+
+
+"""The following class receives notifications of changes to the files in a
+directory from the system in a background thread, posting them to the main UI
+thread for the adapter to apply. Files with recognised suffixes are added to
+the list when they are created. Files without a suffix are added when they
+have been written, if they start with a plausible spritefile header, as they
+are when the directories are searched. New subdirectories cause the adapter to
+search the directories again the next time it starts watching them."""
+
+class DirectoryObserver(FileObserver):
+
+    __fields__ = {"adapter": SpriteFileListAdapter, "directory": File}
+    
+    @args(void, [SpriteFileListAdapter, File])
+    def __init__(self, adapter, directory):
+    
+        FileObserver.__init__(self, directory.getPath(),
+            FileObserver.CREATE | FileObserver.MOVED_TO |
+            FileObserver.CLOSE_WRITE |
+            FileObserver.DELETE | FileObserver.MOVED_FROM)
+        
+        self.adapter = adapter
+        self.directory = directory
+    
+    @args(void, [int, String])
+    def onEvent(self, event, path):
+    
+        if path == None:
+            return
+        
+        file = File(self.directory, path)
+        
+        if event & (FileObserver.CREATE | FileObserver.MOVED_TO |
+                    FileObserver.CLOSE_WRITE) != 0:
+            if file.isDirectory():
+                self.adapter.rescan.set(True)
+                return
+            
+            # Newly created files are usually empty, so only complete files
+            # are examined.
+            header = None
+            complete = FileObserver.MOVED_TO | FileObserver.CLOSE_WRITE
+            if event & complete != 0 and \
+               self.adapter.discovery.isCandidate(path):
+                header = SpritefileHeader.read(file)
+            
+            if header != None or self.adapter.matches(path):
+                self.adapter.post(FileChange(self.adapter, file, True, header))
+        
+        elif event & (FileObserver.DELETE | FileObserver.MOVED_FROM) != 0:
+            self.adapter.post(FileChange(self.adapter, file, False, None))
+
+
+"""This class describes a change to a directory that is applied to an adapter
+in the main UI thread."""
+
+class FileChange(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"adapter": SpriteFileListAdapter, "file": File,
+                  "added": bool, "header": SpritefileHeader}
+    
+    @args(void, [SpriteFileListAdapter, File, bool, SpritefileHeader])
+    def __init__(self, adapter, file, added, header):
+    
+        Object.__init__(self)
+        self.adapter = adapter
+        self.file = file
+        self.added = added
+        self.header = header
+    
+    def run(self):
+    
+        if self.added:
+            self.adapter.addFile(self.file, self.header)
+        else:
+            self.adapter.removeFile(self.file)
+
+
+"""The following class represents the task of reading the header of a file in
+a background thread, posting the result to the main UI thread for the adapter
+to cache."""
+
+class HeaderTask(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"adapter": SpriteFileListAdapter, "file": File,
+                  "key": String, "header": SpritefileHeader, "done": bool}
+    
+    @args(void, [SpriteFileListAdapter, File, String])
+    def __init__(self, adapter, file, key):
+    
+        Object.__init__(self)
+        self.adapter = adapter
+        self.file = file
+        self.key = key
+        self.header = None
+        self.done = False
+    
+    """The task is run twice: first in a background thread to read the header,
+    then in the main UI thread to deliver it."""
+    
+    def run(self):
+    
+        if not self.done:
+            self.header = SpritefileHeader.read(self.file)
+            self.done = True
+            self.adapter.post(self)
+        else:
+            self.adapter.headerRead(self.key, self.header)
+
+
+"""The following class provides the view for each item in the file list,
+showing the name of a file above a description of its contents."""
+
+class FileRow(LinearLayout):
+
+    __fields__ = {"nameView": TextView, "detailsView": TextView}
+    
+    @args(void, [Context])
+    def __init__(self, context):
+    
+        LinearLayout.__init__(self, context)
+        self.setOrientation(LinearLayout.VERTICAL)
+        
+        self.nameView = TextView(context)
+        self.nameView.setTextSize(TypedValue.COMPLEX_UNIT_SP, float(20))
+        self.detailsView = TextView(context)
+        self.detailsView.setTextSize(TypedValue.COMPLEX_UNIT_SP, float(14))
+        
+        self.addView(self.nameView)
+        self.addView(self.detailsView)
+    
+    @args(void, [String, String])
+    def setText(self, name, details):
+    
+        self.nameView.setText(name)
+        self.detailsView.setText(details)
+
+
+"""This class delivers the complete results of a search to an adapter in the
+main UI thread."""
+
+class DiscoveryResult(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"adapter": SpriteFileListAdapter, "files": List(File)}
+    
+    @args(void, [SpriteFileListAdapter, List(File)])
+    def __init__(self, adapter, files):
+    
+        Object.__init__(self)
+        self.adapter = adapter
+        self.files = files
+    
+    def run(self):
+    
+        self.adapter.retainFiles(self.files)
 
 
 """We define an interface that other components can implement to handle a
@@ -84,7 +482,7 @@ the main activity.
 
 class FileBrowser(LinearLayout):
 
-    __interfaces__ = [AdapterView.OnItemClickListener]
+    __interfaces__ = [AdapterView.OnItemClickListener, Runnable]
     __fields__ = {"handler": FileOpenInterface}
     
     def __init__(self, context):
@@ -93,8 +491,15 @@ class FileBrowser(LinearLayout):
         
         self.handler = None
         
-        envDir = Environment.getExternalStoragePublicDirectory(Environment.DIRECTORY_DOWNLOADS)
-        self.fileAdapter = SpriteFileListAdapter(envDir, [".spr", ",ff9", ".ff9"])
+        # By default, search the downloads and documents directories.
+        roots = [
+            Environment.getExternalStoragePublicDirectory(
+                Environment.DIRECTORY_DOWNLOADS),
+            Environment.getExternalStoragePublicDirectory(
+                Environment.DIRECTORY_DOCUMENTS)
+            ]
+        self.fileAdapter = SpriteFileListAdapter(roots,
+                                                 [".spr", ",ff9", ".ff9"])
         
         self.fileView = ListView(context)
         self.fileView.setOnItemClickListener(self)
@@ -104,13 +509,42 @@ class FileBrowser(LinearLayout):
             ViewGroup.LayoutParams.MATCH_PARENT,
             ViewGroup.LayoutParams.WRAP_CONTENT))
     
-    """We provide a method that the activity can use to request a new list of
-    file names, only refreshing the view if the list has changed."""
+    """We provide methods that the activity can use to control whether the list
+    of file names is kept up to date. The adapter notifies the view when the
+    list changes, so there is no need to refresh the view here.
+    
+    Starting the search and the observers is posted to the view's message queue
+    so that it happens after the activity's first frame has been drawn instead
+    of delaying it."""
     
     def rescan(self):
     
-        if self.fileAdapter.update():
-            self.fileView.setAdapter(self.fileAdapter)
+        self.removeCallbacks(self)
+        self.post(self)
+    
+    def run(self):
+    
+        self.fileAdapter.startWatching()
+    
+    def stopWatching(self):
+    
+        self.removeCallbacks(self)
+        self.fileAdapter.stopWatching()
+    
+    """This method changes the directories searched for spritefiles."""
+    
+    @args(void, [List(File)])
+    def setRoots(self, roots):
+    
+        self.fileAdapter.setRoots(roots)
+    
+    """Other components can be told about the spritefiles that are found by
+    registering a listener with the following method."""
+    
+    @args(void, [DiscoveryListener])
+    def addDiscoveryListener(self, listener):
+    
+        self.fileAdapter.discovery.addListener(listener)
     
     """This method is called when the user clicks a file name in the
     `ListView`, responding by calling the appropriate method of the registered
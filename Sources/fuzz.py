@@ -0,0 +1,316 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `fuzz` module contains classes for generating corrupt spritefiles and
+checking that the classes in the [spritefile](spritefile.html) module reject or
+read them within fixed limits on time and memory, and that the previews of the
+sprites they accept can be drawn without errors."""
+
+from java.io import BufferedInputStream, File, FileInputStream, \
+                    FileOutputStream, RandomAccessFile
+from java.lang import Math, Object, String, System, Thread
+from java.nio import ByteBuffer, ByteOrder
+from java.util import List, Random
+
+from android.graphics import Bitmap, Paint, PorterDuff, PorterDuffXfermode
+from android.util import Log
+
+from benchmark import CorpusGenerator
+from bitmappool import BitmapPool
+from profiling import Profiler
+from spritebrowser import SpriteAdapter, SpriteRenderer
+from spritefile import Spritefile, SpritefileError, SpriteStream
+
+"""The following class creates corrupt versions of the spritefiles generated
+for the benchmark. Each corrupt file is made by applying one kind of damage to
+a copy of a valid file: truncating it, overwriting one of the words in the
+spritefile header or in the header of its first sprite with an awkward value,
+or changing bytes at random positions."""
+
+class FuzzCorpus(Object):
+
+    __fields__ = {"directory": File, "random": Random}
+    
+    # The number of corrupt files made from each valid file.
+    variants = 24
+    
+    # The offsets of the words in the spritefile header and in the header of
+    # the first sprite, which starts immediately after it in generated files.
+    header_words = [0, 4, 8, 12, 28, 32, 36, 40, 44, 48, 52]
+    
+    # Values that are likely to expose missing checks.
+    awkward = [0, 1, -1, 4, 43, 44, 0x7fffffff, -0x7fffffff, 0x10000, 0xffff]
+    
+    @args(void, [File])
+    def __init__(self, directory):
+    
+        Object.__init__(self)
+        
+        self.directory = directory
+        
+        # Use a fixed seed so that the same corpus is generated each time.
+        self.random = Random(long(2))
+    
+    """This method generates valid spritefiles in a subdirectory and writes
+    corrupt versions of them to the corpus directory, returning a list of the
+    corrupt files."""
+    
+    @args(List(File), [])
+    def generate(self):
+    
+        valid = CorpusGenerator(File(self.directory, "valid")).generate()
+        files = []
+        
+        for file in valid:
+        
+            data = self.readFile(file)
+            base = file.getName()
+            
+            for i in range(self.variants):
+                name = base + "." + String.valueOf(i)
+                files.add(self.writeFile(name, self.corrupt(data, i)))
+        
+        return files
+    
+    """The following method returns a corrupt copy of the given data, using
+    the variant number to choose the kind of damage to apply."""
+    
+    @args([byte], [[byte], int])
+    def corrupt(self, data, variant):
+    
+        kind = variant % 3
+        
+        if kind == 0:
+            # Truncate the file at a random position.
+            length = self.random.nextInt(len(data))
+            copy = array(byte, length)
+            System.arraycopy(data, 0, copy, 0, length)
+            return copy
+        
+        copy = array(byte, len(data))
+        System.arraycopy(data, 0, copy, 0, len(data))
+        
+        if kind == 1:
+            # Overwrite a header word with an awkward value.
+            buf = ByteBuffer.wrap(copy)
+            buf.order(ByteOrder.LITTLE_ENDIAN)
+            words = self.header_words
+            offset = words[self.random.nextInt(len(words))]
+            value = self.awkward[self.random.nextInt(len(self.awkward))]
+            buf.putInt(offset, value)
+        else:
+            # Change a few bytes in the first part of the file, where the
+            # headers and palettes are found.
+            for i in range(8):
+                position = self.random.nextInt(Math.min(len(copy), 2048))
+                copy[position] = byte(self.random.nextInt(256))
+        
+        return copy
+    
+    @args([byte], [File])
+    def readFile(self, file):
+    
+        f = RandomAccessFile(file, "r")
+        data = array(byte, int(f.length()))
+        f.readFully(data)
+        f.close()
+        return data
+    
+    @args(File, [String, [byte]])
+    def writeFile(self, name, data):
+    
+        self.directory.mkdirs()
+        file = File(self.directory, name)
+        stream = FileOutputStream(file)
+        stream.write(data)
+        stream.close()
+        return file
+
+
+"""The following class reads a single file in its own thread, both as a file
+and as a stream, decoding every sprite that it can and drawing its preview in
+the same way as the browser. Sprites that are rejected with a `SpritefileError`
+are expected and skipped, but any other exception is recorded as a crash,
+together with the name of the sprite being read when it occurred. A profiler
+records the number of bytes allocated for sprite data so that the amount of
+memory used can be checked."""
+
+class FuzzCase(Thread):
+
+    __fields__ = {"file": File, "profiler": Profiler, "finished": bool,
+                  "crashed": bool, "current": String,
+                  "pool": BitmapPool, "paint": Paint}
+    
+    @args(void, [File])
+    def __init__(self, file):
+    
+        Thread.__init__(self)
+        
+        self.file = file
+        self.profiler = Profiler()
+        self.profiler.setEnabled(True)
+        self.finished = False
+        self.crashed = False
+        self.current = ""
+        
+        size = SpriteAdapter.preview_size
+        self.pool = BitmapPool(size, size, 1, self.profiler)
+        self.paint = Paint()
+        self.paint.setXfermode(PorterDuffXfermode(PorterDuff.Mode.SRC_OVER))
+        
+        # Threads that do not finish must not prevent the application from
+        # exiting.
+        self.setDaemon(True)
+    
+    def run(self):
+    
+        try:
+            self.readFile()
+            self.readStream()
+        except:
+            self.crashed = True
+        
+        self.finished = True
+    
+    """This method opens the file as a spritefile and renders each sprite using
+    the same methods as the `SpriteRenderer` tasks used by the browser."""
+    
+    @args(void, [])
+    def readFile(self):
+    
+        try:
+            spritefile = Spritefile(self.file, self.profiler)
+        except SpritefileError:
+            return
+        
+        for name in spritefile.sprites.keySet():
+        
+            self.current = name
+            try:
+                bitmap = SpriteRenderer.getSpriteBitmap(spritefile, name)
+            except SpritefileError:
+                continue
+            
+            self.draw(bitmap)
+    
+    """The following method reads the file as a stream, as the `StreamLoader`
+    class does for content URIs, and renders each sprite it can decode. Errors
+    in the stream itself end the stream, as they do for the loader."""
+    
+    @args(void, [])
+    def readStream(self):
+    
+        self.current = ""
+        
+        try:
+            stream = SpriteStream(BufferedInputStream(
+                FileInputStream(self.file)))
+        except:
+            return
+        
+        stream.spritefile.profiler = self.profiler
+        
+        while True:
+        
+            try:
+                data = stream.read_sprite()
+            except:
+                break
+            
+            if data == None:
+                break
+            
+            try:
+                sprite = stream.decode(data)
+            except SpritefileError:
+                continue
+            
+            self.current = sprite.name
+            self.draw(SpriteRenderer.spriteBitmap(sprite))
+        
+        stream.close()
+    
+    @args(void, [Bitmap])
+    def draw(self, bitmap):
+    
+        pool = self.pool
+        pool.release(pool.compact(SpriteRenderer.drawPreview(bitmap,
+                                  pool.acquire(), self.paint)))
+
+
+"""The following class generates the corpus in a given directory and reads each
+file in turn, reporting any file that is not read within the time limit or that
+causes more memory than the limit to be allocated, as well as any file that
+causes an unexpected exception. The results are written to the system log with
+the `SpriteViewer` tag."""
+
+class FuzzTask(Thread):
+
+    __fields__ = {"directory": File}
+    
+    # The time allowed for each file in milliseconds and the number of bytes
+    # that may be allocated for the sprites in each file.
+    time_limit = 5000
+    memory_limit = 100663296
+    
+    @args(void, [File])
+    def __init__(self, directory):
+    
+        Thread.__init__(self)
+        self.directory = directory
+    
+    def run(self):
+    
+        Log.i("SpriteViewer", "Generating fuzz corpus in " + \
+              self.directory.getPath())
+        files = FuzzCorpus(self.directory).generate()
+        
+        failures = 0
+        slowest = long(0)
+        largest = long(0)
+        
+        for file in files:
+        
+            case = FuzzCase(file)
+            started = System.nanoTime()
+            case.start()
+            case.join(long(self.time_limit))
+            
+            elapsed = (System.nanoTime() - started) / long(1000000)
+            allocated = case.profiler.getCount(Profiler.ALLOCATED)
+            slowest = Math.max(slowest, elapsed)
+            largest = Math.max(largest, allocated)
+            
+            if not case.finished:
+                failures += 1
+                Log.w("SpriteViewer", file.getName() + \
+                      ": not finished after " + \
+                      String.valueOf(self.time_limit) + " ms")
+            
+            elif case.crashed:
+                failures += 1
+                Log.w("SpriteViewer", file.getName() + \
+                      ": exception while reading '" + case.current + "'")
+            
+            elif allocated > long(self.memory_limit):
+                failures += 1
+                Log.w("SpriteViewer", file.getName() + ": allocated " + \
+                      String.valueOf(allocated) + " bytes")
+        
+        Log.i("SpriteViewer", "Fuzzing finished: " + \
+              String.valueOf(len(files)) + " files, " + \
+              String.valueOf(failures) + " failures, slowest " + \
+              String.valueOf(slowest) + " ms, largest allocation " + \
+              String.valueOf(largest / long(1024)) + " KB")
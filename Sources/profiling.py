@@ -0,0 +1,238 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `profiling` module provides a class for measuring where time is spent
+when reading spritefiles and rendering sprites."""
+
+from java.lang import Math, Object, String, System
+from java.util import Arrays, List
+from java.util.concurrent.atomic import AtomicInteger, AtomicLongArray
+
+from android.os import Trace
+from android.util import Log
+
+"""The following class accumulates the time spent in each phase of reading and
+rendering sprites, together with counters for the amount of work done. It also
+keeps the most recent sprite render latencies so that percentiles can be
+reported. Phases and counters can be updated from several threads at once.
+
+Instances are disabled when created, in which case each method returns
+immediately. When enabled, each phase can also be reported to the platform's
+tracing tools as a named section so that it can be viewed in a system trace."""
+
+class Profiler(Object):
+
+    __fields__ = {
+        "enabled": bool, "tracing": bool,
+        "times": AtomicLongArray, "calls": AtomicLongArray,
+        "counters": AtomicLongArray,
+        "latencies": AtomicLongArray, "samples": AtomicInteger
+        }
+    
+    # Phases
+    READ_NAME = 0
+    READ_DETAILS = 1
+    DECODE_PIXELS = 2
+    DECODE_MASK = 3
+    RENDER = 4
+    PHASES = 5
+    
+    # Counters
+    BYTES_READ = 0
+    SEEKS = 1
+    ALLOCATED = 2
+    CACHE_HITS = 3
+    CACHE_MISSES = 4
+    SHARED_DECODES = 5
+    STORE_HITS = 6
+    COUNTERS = 7
+    
+    # The number of latency samples kept.
+    SAMPLES = 256
+    
+    def __init__(self):
+    
+        Object.__init__(self)
+        
+        self.enabled = False
+        self.tracing = False
+        self.reset()
+    
+    """The following methods enable or disable the profiler and the output of
+    trace sections."""
+    
+    @args(void, [bool])
+    def setEnabled(self, enabled):
+    
+        self.enabled = enabled
+    
+    @args(void, [bool])
+    def setTracing(self, tracing):
+    
+        self.tracing = tracing
+    
+    """We discard all measurements by replacing the arrays that hold them."""
+    
+    @args(void, [])
+    def reset(self):
+    
+        self.times = AtomicLongArray(self.PHASES)
+        self.calls = AtomicLongArray(self.PHASES)
+        self.counters = AtomicLongArray(self.COUNTERS)
+        self.latencies = AtomicLongArray(self.SAMPLES)
+        self.samples = AtomicInteger(0)
+    
+    """The `begin` method marks the start of a phase, returning a time stamp
+    that must be passed to the corresponding call to the `end` method. Calls to
+    these methods must be made in the same thread and be correctly nested."""
+    
+    @args(long, [int])
+    def begin(self, phase):
+    
+        if not self.enabled:
+            return long(0)
+        
+        if self.tracing:
+            Trace.beginSection(self.phaseName(phase))
+        
+        return System.nanoTime()
+    
+    @args(void, [int, long])
+    def end(self, phase, start):
+    
+        if not self.enabled:
+            return
+        
+        self.times.addAndGet(phase, System.nanoTime() - start)
+        self.calls.incrementAndGet(phase)
+        
+        if self.tracing:
+            Trace.endSection()
+    
+    """This method adds the given amount to a counter."""
+    
+    @args(void, [int, long])
+    def count(self, counter, amount):
+    
+        if self.enabled:
+            self.counters.addAndGet(counter, amount)
+    
+    @args(long, [int])
+    def getCount(self, counter):
+    
+        return self.counters.get(counter)
+    
+    """The following method records the time taken to render a sprite,
+    replacing the oldest sample if the maximum number has been reached."""
+    
+    @args(void, [long])
+    def sample(self, ns):
+    
+        if self.enabled:
+            i = self.samples.getAndIncrement()
+            self.latencies.set(i % self.SAMPLES, ns)
+    
+    """This method returns the given percentile of the recorded latencies in
+    nanoseconds, or zero if no samples have been recorded."""
+    
+    @args(long, [int])
+    def percentile(self, p):
+    
+        n = Math.min(self.samples.get(), self.SAMPLES)
+        if n == 0:
+            return long(0)
+        
+        values = array(long, n)
+        for i in range(n):
+            values[i] = self.latencies.get(i)
+        
+        Arrays.sort(values)
+        return values[((n - 1) * p) / 100]
+    
+    @args(String, [int])
+    def phaseName(self, phase):
+    
+        if phase == self.READ_NAME:
+            return "Spritefile.read_name"
+        elif phase == self.READ_DETAILS:
+            return "Spritefile.read_header"
+        elif phase == self.DECODE_PIXELS:
+            return "Spritefile.sprite2rgb"
+        elif phase == self.DECODE_MASK:
+            return "Spritefile.mask2rgba"
+        else:
+            return "SpriteRenderer.render"
+    
+    @args(String, [int])
+    def counterName(self, counter):
+    
+        if counter == self.BYTES_READ:
+            return "bytes read"
+        elif counter == self.SEEKS:
+            return "seeks"
+        elif counter == self.ALLOCATED:
+            return "bytes allocated"
+        elif counter == self.CACHE_HITS:
+            return "cache hits"
+        elif counter == self.CACHE_MISSES:
+            return "cache misses"
+        elif counter == self.SHARED_DECODES:
+            return "shared decodes"
+        else:
+            return "store hits"
+    
+    """The following method returns a description of the measurements as a list
+    of lines of text, giving the number of calls to each phase with the total
+    and mean time spent in it, followed by the value of each counter."""
+    
+    @args(List(String), [])
+    def report(self):
+    
+        lines = []
+        
+        for phase in range(self.PHASES):
+        
+            calls = self.calls.get(phase)
+            total = self.times.get(phase) / long(1000)
+            if calls > long(0):
+                mean = total / calls
+            else:
+                mean = long(0)
+            
+            lines.add(self.phaseName(phase) + ": " + String.valueOf(calls) + \
+                      " calls, " + String.valueOf(total) + " us total, " + \
+                      String.valueOf(mean) + " us mean")
+        
+        for counter in range(self.COUNTERS):
+            lines.add(self.counterName(counter) + ": " + \
+                      String.valueOf(self.counters.get(counter)))
+        
+        p50 = self.percentile(50) / long(1000)
+        p95 = self.percentile(95) / long(1000)
+        lines.add("render latency: " + String.valueOf(p50) + " us p50, " + \
+                  String.valueOf(p95) + " us p95")
+        
+        return lines
+    
+    """This method writes the report to the system log with the given tag."""
+    
+    @args(void, [String])
+    def dump(self, tag):
+    
+        if not self.enabled:
+            return
+        
+        for line in self.report():
+            Log.i(tag, line)
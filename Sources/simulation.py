@@ -0,0 +1,475 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `simulation` module contains classes for measuring how well the
+scheduling and caching policies of the `SpriteAdapter` class in the
+[spritebrowser](spritebrowser.html) module cope with different ways of
+scrolling a grid of sprites. The adapter is driven by scroll traces using a
+simulated clock and a renderer that takes a fixed time to render each sprite
+without decoding anything, so the results are deterministic."""
+
+from java.lang import Integer, Math, Object, Runnable, String, Thread
+from java.util import Collections, List, Map
+
+from android.content import Context
+from android.graphics import Bitmap
+from android.os import Looper
+from android.util import Log
+from android.widget import ImageView, LinearLayout
+
+from profiling import Profiler
+from spritebrowser import RenderEnvironment, SpriteAdapter, WorkItem
+
+"""The following class describes how a grid is scrolled over time as a sequence
+of frames, each of which records a time in milliseconds and the position of
+the first visible item. Traces can be recorded and parsed from text or
+generated for common scrolling patterns."""
+
+class ScrollTrace(Object):
+
+    __fields__ = {"name": String, "times": List(int), "positions": List(int)}
+    
+    # The interval between frames in generated traces in milliseconds.
+    frame_time = 16
+    
+    @args(void, [String])
+    def __init__(self, name):
+    
+        Object.__init__(self)
+        self.name = name
+        self.times = []
+        self.positions = []
+    
+    @args(void, [int, int])
+    def add(self, time, position):
+    
+        self.times.add(time)
+        self.positions.add(position)
+    
+    @args(int, [])
+    def size(self):
+    
+        return len(self.times)
+    
+    """This method parses a recorded trace from text containing frames
+    separated by commas, each written as a time and a position separated by a
+    colon; for example, `0:0,16:3,32:6`."""
+    
+    @static
+    @args(ScrollTrace, [String, String])
+    def parse(name, text):
+    
+        trace = ScrollTrace(name)
+        
+        for frame in text.split(","):
+            pieces = frame.trim().split(":")
+            trace.add(Integer.parseInt(pieces[0]), Integer.parseInt(pieces[1]))
+        
+        return trace
+    
+    """The following methods generate traces in which the grid is flung several
+    times, scrolled slowly, and scrolled back and forth. Positions are tracked
+    in thousandths of a row so that speeds can be expressed with integers."""
+    
+    @static
+    @args(ScrollTrace, [int])
+    def fling(columns):
+    
+        trace = ScrollTrace("fling")
+        time = 0
+        row = 0
+        
+        for i in range(3):
+        
+            # Start at about 60 rows per second and slow down gradually.
+            speed = 1000
+            while speed > 10:
+                trace.add(time, (row / 1000) * columns)
+                row += speed
+                speed = (speed * 95) / 100
+                time += ScrollTrace.frame_time
+            
+            # Pause for a second before the next fling.
+            for j in range(60):
+                trace.add(time, (row / 1000) * columns)
+                time += ScrollTrace.frame_time
+        
+        return trace
+    
+    @static
+    @args(ScrollTrace, [int])
+    def slowScroll(columns):
+    
+        trace = ScrollTrace("slow")
+        time = 0
+        row = 0
+        
+        # Scroll at about two rows per second for ten seconds.
+        for i in range(600):
+            trace.add(time, (row / 1000) * columns)
+            row += 33
+            time += ScrollTrace.frame_time
+        
+        return trace
+    
+    @static
+    @args(ScrollTrace, [int])
+    def backAndForth(columns):
+    
+        trace = ScrollTrace("back and forth")
+        time = 0
+        row = 0
+        
+        # Scroll ten rows down and back up again at about six rows per second.
+        for i in range(5):
+            for step in [100, -100]:
+                for j in range(100):
+                    trace.add(time, (row / 1000) * columns)
+                    row += step
+                    time += ScrollTrace.frame_time
+        
+        return trace
+
+
+"""The following class represents an event scheduled to occur at a given time
+on the simulated clock. Events scheduled for the same time occur in the order
+in which they were scheduled."""
+
+class SimulatedEvent(Object):
+
+    __fields__ = {"time": long, "runnable": Runnable}
+    
+    @args(void, [long, Runnable])
+    def __init__(self, time, runnable):
+    
+        Object.__init__(self)
+        self.time = time
+        self.runnable = runnable
+
+
+"""This class represents a render performed by the simulated environment. It
+is run as an event when the render is complete."""
+
+class SimulatedRender(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"environment": SimulatedEnvironment,
+                  "adapter": SpriteAdapter, "work": WorkItem, "name": String}
+    
+    @args(void, [SimulatedEnvironment, SpriteAdapter, WorkItem, String])
+    def __init__(self, environment, adapter, work, name):
+    
+        Object.__init__(self)
+        self.environment = environment
+        self.adapter = adapter
+        self.work = work
+        self.name = name
+    
+    def run(self):
+    
+        self.environment.finish(self)
+
+
+"""The following class provides a `RenderEnvironment` for adapters that runs
+events on a simulated clock. Renders take a fixed time and are performed by a
+fixed number of workers, with a bounded queue of renders waiting for a worker.
+When the queue is full, requests to start renders are rejected.
+
+A `ScrollSimulator` is notified whenever a render is complete so that it can
+determine whether the result was visible."""
+
+class SimulatedEnvironment(Object):
+
+    __interfaces__ = [RenderEnvironment]
+    
+    __fields__ = {
+        "now": long, "events": List(SimulatedEvent),
+        "workers": int, "busy": int, "queue_limit": int,
+        "queued": List(SimulatedRender), "render_time": int,
+        "renders": int, "simulator": ScrollSimulator, "bitmap": Bitmap
+        }
+    
+    @args(void, [ScrollSimulator, int, int, int])
+    def __init__(self, simulator, workers, queue_limit, render_time):
+    
+        Object.__init__(self)
+        
+        self.simulator = simulator
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.render_time = render_time
+        
+        self.now = long(0)
+        self.events = []
+        self.busy = 0
+        self.queued = []
+        self.renders = 0
+        
+        # All renders produce the same bitmap.
+        self.bitmap = Bitmap.createBitmap(SpriteAdapter.preview_size,
+            SpriteAdapter.preview_size, Bitmap.Config.ARGB_8888)
+    
+    @args(bool, [SpriteAdapter, WorkItem, String])
+    def startRender(self, adapter, work, name):
+    
+        if self.busy + len(self.queued) >= self.workers + self.queue_limit:
+            return False
+        
+        render = SimulatedRender(self, adapter, work, name)
+        
+        if self.busy < self.workers:
+            self.begin(render)
+        else:
+            self.queued.add(render)
+        
+        return True
+    
+    @args(void, [Runnable, long])
+    def postDelayed(self, runnable, delay):
+    
+        time = self.now + delay
+        
+        # Insert the event after all others scheduled for the same time.
+        i = len(self.events)
+        while i > 0 and self.events[i - 1].time > time:
+            i -= 1
+        
+        self.events.add(i, SimulatedEvent(time, runnable))
+    
+    @args(void, [SimulatedRender])
+    def begin(self, render):
+    
+        self.busy += 1
+        self.renders += 1
+        self.postDelayed(render, long(self.render_time))
+    
+    """When a render is complete, we deliver the result to the adapter, tell
+    the simulator which item was rendered, and start the next queued render."""
+    
+    @args(void, [SimulatedRender])
+    def finish(self, render):
+    
+        self.busy -= 1
+        render.adapter.renderFinished(render.work, render.name, self.bitmap)
+        self.simulator.delivered(render.work.position)
+        
+        if not self.queued.isEmpty():
+            self.begin(self.queued.remove(0))
+    
+    """This method runs all events scheduled up to and including the given
+    time, leaving the clock at that time."""
+    
+    @args(void, [long])
+    def advanceTo(self, time):
+    
+        while not self.events.isEmpty() and self.events[0].time <= time:
+            event = self.events.remove(0)
+            self.now = event.time
+            event.runnable.run()
+        
+        self.now = time
+
+
+"""The following class drives an adapter with a scroll trace, requesting views
+for items as they scroll into view in the same way as a `GridView`. It records
+the time between each item becoming visible and its thumbnail being shown,
+the number of renders whose results were not visible when they completed, and
+the adapter's cache hit rate."""
+
+class ScrollSimulator(Object):
+
+    __fields__ = {
+        "context": Context, "trace": ScrollTrace,
+        "items": int, "columns": int, "rows": int,
+        "workers": int, "queue_limit": int, "render_time": int,
+        "environment": SimulatedEnvironment,
+        "first": int, "last": int,
+        "waiting": Map(int, long), "latencies": List(int),
+        "wasted": int, "abandoned": int
+        }
+    
+    @args(void, [Context, ScrollTrace, int, int, int])
+    def __init__(self, context, trace, items, columns, rows):
+    
+        Object.__init__(self)
+        
+        self.context = context
+        self.trace = trace
+        self.items = items
+        self.columns = columns
+        self.rows = rows
+        
+        # By default, model a single worker with an unbounded queue, which is
+        # how AsyncTask.execute behaves on recent versions of Android.
+        self.workers = 1
+        self.queue_limit = items
+        self.render_time = 30
+    
+    """This method changes the model of the renderer used by the simulation."""
+    
+    @args(void, [int, int, int])
+    def setRenderer(self, workers, queue_limit, render_time):
+    
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.render_time = render_time
+    
+    """The following method runs the simulation, returning a line of text that
+    summarises the results."""
+    
+    @args(String, [])
+    def run(self):
+    
+        self.environment = SimulatedEnvironment(self, self.workers,
+            self.queue_limit, self.render_time)
+        
+        adapter = SpriteAdapter(self.environment)
+        names = []
+        for i in range(self.items):
+            names.add("sprite" + String.valueOf(i))
+        adapter.items = names
+        adapter.profiler.setEnabled(True)
+        
+        # The simulated renders model single stage rendering.
+        adapter.setProgressive(False)
+        
+        parent = LinearLayout(self.context)
+        
+        self.first = 0
+        self.last = 0
+        self.waiting = {}
+        self.latencies = []
+        self.wasted = 0
+        self.abandoned = 0
+        
+        visible = self.columns * self.rows
+        end_time = long(0)
+        
+        for i in range(self.trace.size()):
+        
+            end_time = long(self.trace.times[i])
+            self.environment.advanceTo(end_time)
+            
+            first = Math.max(0, Math.min(self.trace.positions[i],
+                                         self.items - visible))
+            last = Math.min(first + visible, self.items)
+            
+            # Items that have scrolled out of view without being shown are
+            # abandoned.
+            for position in range(self.first, self.last):
+                if (position < first or position >= last) and \
+                   self.waiting.containsKey(position):
+                    self.waiting.remove(position)
+                    self.abandoned += 1
+            
+            old_first = self.first
+            old_last = self.last
+            self.first = first
+            self.last = last
+            
+            # Request views for items that have scrolled into view.
+            for position in range(first, last):
+            
+                if old_first <= position < old_last:
+                    continue
+                
+                hits = adapter.profiler.getCount(Profiler.CACHE_HITS)
+                adapter.getView(position, None, parent)
+                
+                if adapter.profiler.getCount(Profiler.CACHE_HITS) > hits:
+                    self.latencies.add(0)
+                else:
+                    self.waiting[position] = end_time
+        
+        # Allow outstanding renders to finish.
+        self.environment.advanceTo(end_time + long(60000))
+        
+        return self.describe(adapter)
+    
+    """The environment calls this method when an item has been rendered. If the
+    item is visible, we record how long it took to appear; otherwise the render
+    was wasted."""
+    
+    @args(void, [int])
+    def delivered(self, position):
+    
+        if position < self.first or position >= self.last:
+            self.wasted += 1
+        
+        elif self.waiting.containsKey(position):
+            since = self.waiting.remove(position)
+            self.latencies.add(int(self.environment.now - since))
+    
+    @args(String, [SpriteAdapter])
+    def describe(self, adapter):
+    
+        hits = adapter.profiler.getCount(Profiler.CACHE_HITS)
+        total = hits + adapter.profiler.getCount(Profiler.CACHE_MISSES)
+        if total > long(0):
+            hit_rate = (hits * long(100)) / total
+        else:
+            hit_rate = long(0)
+        
+        Collections.sort(self.latencies)
+        n = len(self.latencies)
+        if n > 0:
+            p50 = self.latencies[(n - 1) / 2]
+            p95 = self.latencies[((n - 1) * 95) / 100]
+        else:
+            p50 = p95 = 0
+        
+        return self.trace.name + ": " + \
+               String.valueOf(self.environment.renders) + " renders, " + \
+               String.valueOf(self.wasted) + " wasted, " + \
+               String.valueOf(self.abandoned) + " abandoned, hit rate " + \
+               String.valueOf(hit_rate) + "%, time to thumbnail " + \
+               String.valueOf(p50) + " ms p50, " + \
+               String.valueOf(p95) + " ms p95"
+
+
+"""The following class runs the simulation for each of the generated traces in
+a thread of its own, writing the results to the system log with the
+`SpriteViewer` tag."""
+
+class SimulationRunner(Thread):
+
+    __fields__ = {"context": Context}
+    
+    # The size of the simulated file and grid.
+    items = 2000
+    columns = 3
+    rows = 5
+    
+    @args(void, [Context])
+    def __init__(self, context):
+    
+        Thread.__init__(self)
+        self.context = context
+    
+    def run(self):
+    
+        # The views created by the adapter may need a message queue, although
+        # they are never shown.
+        Looper.prepare()
+        
+        traces = [ScrollTrace.fling(self.columns),
+                  ScrollTrace.slowScroll(self.columns),
+                  ScrollTrace.backAndForth(self.columns)]
+        
+        for trace in traces:
+            simulator = ScrollSimulator(self.context, trace, self.items,
+                                        self.columns, self.rows)
+            Log.i("SpriteViewer", simulator.run())
@@ -16,75 +16,306 @@
 """The `spritebrowser` module provides classes for displaying the contents of
 spritefiles."""
 
-from java.io import File
-from java.lang import Math, Object, Runnable, String
+from java.io import BufferedInputStream, File
+from java.lang import Math, Object, Runnable, String, System, Thread
 from java.nio import ByteBuffer
-from java.util import Collections, LinkedList, List, Map, Queue
+from java.util import ArrayList, Collections, HashSet, LinkedList, List, Map, \
+                      Queue, Set
+from java.util.concurrent import Executor, Executors
+from java.util.concurrent.atomic import AtomicBoolean
 
-from android.content import Context, Intent
+from android.content import ContentResolver, Context, Intent
 from android.graphics import Bitmap, Canvas, Color, Paint, \
-                             PorterDuff, PorterDuffXfermode
-from android.os import AsyncTask, Handler
-from android.widget import AdapterView, BaseAdapter, ImageView, GridView, \
-                           LinearLayout, TextView
+                             PorterDuff, PorterDuffXfermode, Rect, Typeface
+from android.net import Uri
+from android.os import AsyncTask, Handler, SystemClock
+from android.view import Gravity, ScaleGestureDetector, View, ViewGroup
+from android.widget import AbsListView, AdapterView, BaseAdapter, \
+                           FrameLayout, ImageView, GridView, LinearLayout, \
+                           TextView
 
-from spritefile import Spritefile
+from bitmappool import BitmapPool
+from profiling import Profiler
+from spritefile import Sprite, Spritefile, SpriteStream
+from spriteindex import SpriteIndex, SpriteIndexWriter
+from thumbnailstore import ThumbnailStore
 
 """We define a class to represent an entry in the cache that is used by the
 `SpriteAdapter` class. It holds the name of a sprite and its bitmap
-representation."""
+representation and the preview size it was rendered for, together with the
+number of views showing the bitmap. An entry is marked as evicted when it is
+removed from the cache, so that its bitmap can be reused once no view shows
+it."""
 
 class CacheEntry(Object):
 
-    __fields__ = {"name": String, "bitmap": Bitmap}
+    __fields__ = {"name": String, "bitmap": Bitmap, "size": int, "views": int,
+                  "evicted": bool}
     
-    @args(void, [String, Bitmap])
-    def __init__(self, name, bitmap):
+    @args(void, [String, Bitmap, int])
+    def __init__(self, name, bitmap, size):
     
         Object.__init__(self)
         self.name = name
         self.bitmap = bitmap
+        self.size = size
+        self.views = 0
+        self.evicted = False
+
+
+"""The following class holds the state associated with a spritefile that has
+been opened by a `SpriteAdapter`: the `Spritefile` object itself, with any
+sprites it has already decoded, the sorted list of sprite names and the cache
+of rendered sprites at each preview size, together with the content key for
+each sprite that has been rendered. The modification time and length of the
+file are recorded so that the state can be discarded if the file changes. If
+the file was opened using an index, the index is also kept so that its
+thumbnails can be used.
+
+The name of the folder holding the file's previews in a `ThumbnailStore` is
+also recorded, together with the preview sizes at which all of the file's
+sprites have been stored."""
+
+class OpenFile(Object):
+
+    __fields__ = {
+        "file": File,
+        "mtime": long,
+        "length": long,
+        "spritefile": Spritefile,
+        "index": SpriteIndex,
+        "items": List(String),
+        "cache": Map(String, CacheEntry),
+        "keys": Map(int, String),
+        "order": Queue(String),
+        "folder": String,
+        "prerendered": Set(int)
+        }
+    
+    @args(void, [File, Spritefile, SpriteIndex, List(String)])
+    def __init__(self, file, spritefile, index, items):
+    
+        Object.__init__(self)
+        
+        self.file = file
+        self.mtime = file.lastModified()
+        self.length = file.length()
+        self.spritefile = spritefile
+        self.index = index
+        self.items = items
+        self.cache = {}
+        self.keys = {}
+        self.order = []
+        self.folder = ThumbnailStore.folderName(file, self.mtime, self.length)
+        self.prerendered = HashSet()
+    
+    """This method reports whether the state describes the given file as it is
+    now, returning `False` if it has been modified since it was opened."""
+    
+    @args(bool, [File])
+    def isCurrent(self, file):
+    
+        return self.file.equals(file) and \
+               file.lastModified() == self.mtime and \
+               file.length() == self.length
 
 
 """The following class exposes the contents of a spritefile to instances of
-`AdapterView` subclasses, such as `ListView` or `GridView`. It defines a
-constant preview size for the sprites that it represents, scaling each sprite
-to fit within a square with sides of this length.
+`AdapterView` subclasses, such as `ListView` or `GridView`. Sprites are scaled
+to fit within a square preview, whose size can be changed to one of a few fixed
+sizes to show more or fewer sprites at once.
 
-The class uses a cache with a constant maximum size to avoid having to render
-sprites each time an item is requested by a view. Sprite rendering is performed
-asynchronously using the `AsyncTask` class. The class implements the `Runnable`
+The class uses a cache with a maximum size for each preview size to avoid
+having to render sprites each time an item is requested by a view. The cache is
+keyed by the hash of each sprite's contents and the preview size, so identical
+sprites with different names share a single preview, and previews of each size
+are kept when the size changes. Until a preview of the current size has been
+rendered, the nearest size in the cache is shown scaled to fit. Since decoded
+sprites are kept by the spritefile, rendering a new size does not decode them
+again. Sprite rendering is performed asynchronously by a `RenderEnvironment`,
+which normally uses the `AsyncTask` class. The class implements the `Runnable`
 interface so that we can implement a method that allows us to postpone events
-and perform them later."""
+and perform them later.
+
+The adapter also keeps the state of a few recently opened files, including
+their caches, so that returning to one of them does not require it to be read
+and rendered again.
+
+Spritefiles with a valid index, as described in the
+[spriteindex](spriteindex.html) module, are opened using the index instead of
+reading the header of each sprite, and any thumbnails it contains are shown
+while sprites are being rendered. An index is written in the background for
+large spritefiles that do not have one.
+
+Spritefiles can also be read from content URIs, which do not refer to files
+that can be read in any order. These are read once by a `StreamLoader` that
+adds the sprites to the adapter in the order in which they occur, together with
+their previews. Since the previews cannot be rendered again cheaply, they are
+kept until they occupy as much memory as the cache of a file, and the remaining
+sprites are shown with placeholders.
+
+Preview bitmaps are obtained from a `BitmapPool` and are returned to it when
+they are removed from the cache and no longer displayed, so scrolling does not
+cause a new bitmap to be allocated for each preview. The adapter counts the
+views showing each cached preview, and implements the `RecyclerListener`
+interface so that the view that displays it can tell it when views leave the
+screen. Views waiting for sprites to be rendered all share the same placeholder
+image.
+
+Large sprites are rendered in two stages. A coarse preview, decoded from a
+sample of the sprite's rows and columns, is shown first and replaced by the
+full preview later. Sprites that are estimated to be no more expensive to
+render in full than a coarse preview are rendered in a single stage.
+
+Renders are not started in the order in which views are requested. The cost of
+each render is estimated from the size of the sprite's data, or from the index
+if there is one, and waiting renders are started cheapest first, with only a
+few in progress at once. Since coarse previews are cheap, every visible sprite
+is normally shown in coarse form before the larger ones are refined. Full
+renders of the most expensive sprites are performed in a separate lane, one at
+a time, so that a single huge sprite does not delay the previews of all the
+small sprites around it.
+
+Sprites requested by the user, to be shown at full size or saved, are decoded
+in a thread of their own and delivered to a `SpriteListener`. No previews are
+started while the user is waiting for one, and a request for a sprite that is
+already being decoded for a preview waits for that decode to finish instead of
+repeating it.
+
+If the adapter is given a `ThumbnailStore`, the previews of all the sprites in
+a file are rendered in the background by a `Prerenderer` once the adapter has
+had nothing to do for a short time. They are kept in the store so that
+scrolling to sprites that have not been shown only requires their previews to
+be loaded, not rendered. The prerenderer is stopped as soon as any other work
+is requested or the application is no longer in the foreground, and is started
+again when the adapter becomes idle."""
 
 class SpriteAdapter(BaseAdapter):
 
-    __interfaces__ = [Runnable]
+    __interfaces__ = [Runnable, AbsListView.RecyclerListener]
     
     __fields__ = {
         "spritefile": Spritefile,
         "items": List(String),
-        "cache": Map(int, CacheEntry),
+        "cache": Map(String, CacheEntry),
         "name_cache": Map(int, String),
-        "positions": Queue(int),
-        "pending": Queue(WorkItem)
+        "keys": Map(int, String),
+        "order": Queue(String),
+        "pending": RenderQueue,
+        "large": RenderQueue,
+        "profiler": Profiler,
+        "in_flight": int,
+        "large_in_flight": int,
+        "interactive": int,
+        "environment": RenderEnvironment,
+        "recent": LinkedList(OpenFile),
+        "index": SpriteIndex,
+        "uri": Uri,
+        "resolver": ContentResolver,
+        "previews": List(Bitmap),
+        "loader": StreamLoader,
+        "progressive": bool,
+        "pool": BitmapPool,
+        "pools": Map(int, BitmapPool),
+        "size": int,
+        "cache_bytes": long,
+        "store": ThumbnailStore,
+        "index_dir": File,
+        "opened": OpenFile,
+        "prerenderer": Prerenderer,
+        "foreground": bool,
+        "last_work": long,
+        "last_position": int
         }
     
+    # The initial preview size and the sizes that previews can be shown at,
+    # in increasing order.
     preview_size = 128
-    cache_size = 20
+    preview_sizes = [64, 128, 256]
+    
+    # The number of bytes of previews kept for each file when the initial
+    # preview size is used, enough for 20 full colour previews or more previews
+    # stored in compact formats. The budget for other sizes is scaled so that
+    # the same number of previews is kept.
+    cache_budget = 1310720
+    
+    # The number of recently opened files whose state is kept.
+    recent_files = 4
+    
+    # Indexes are written for spritefiles with at least this number of sprites.
+    index_threshold = 256
+    
+    # The maximum size of coarse previews and the estimated cost of rendering
+    # one, which is bounded because only a sample of the sprite is decoded.
+    coarse_size = 32
+    coarse_cost = 16384
+    
+    # The number of renders that can be in progress at once in the normal lane
+    # and in the lane for large sprites, and the estimated cost above which
+    # full renders use the large lane. This is roughly the cost of a 512 by 512
+    # sprite with 256 colours.
+    render_limit = 2
+    large_limit = 1
+    large_cost = 786432
+    
+    # The maximum number of unused preview bitmaps kept for reuse.
+    pool_size = 8
+    
+    # The time in milliseconds that the adapter must be idle for before the
+    # previews of the rest of the file are rendered in the background.
+    idle_delay = 2000
     
     def __init__(self):
     
         BaseAdapter.__init__(self)
-        
-        self.handler = Handler()
+        self.init(AsyncRenderEnvironment())
+    
+    """An adapter can also be created with a different environment, allowing
+    the scheduling and caching policies to be exercised without rendering any
+    sprites."""
+    
+    @args(void, [RenderEnvironment])
+    def __init__(self, environment):
+    
+        BaseAdapter.__init__(self)
+        self.init(environment)
+    
+    @args(void, [RenderEnvironment])
+    def init(self, environment):
+    
+        self.environment = environment
+        self.profiler = Profiler()
+        self.pools = {}
+        self.size = self.preview_size
+        self.pool = self.getPool(self.size)
         
         self.spritefile = None
+        self.index = None
+        self.uri = None
+        self.previews = None
+        self.loader = None
         self.items = []
         
         self.cache = {}
-        self.positions = []
-        self.pending = []
+        self.cache_bytes = long(0)
+        self.keys = {}
+        self.order = []
+        self.pending = RenderQueue()
+        self.large = RenderQueue()
+        self.in_flight = 0
+        self.large_in_flight = 0
+        self.interactive = 0
+        self.recent = LinkedList()
+        
+        self.progressive = True
+        
+        self.store = None
+        self.index_dir = None
+        self.opened = None
+        self.prerenderer = None
+        self.foreground = True
+        self.last_work = long(0)
+        self.last_position = 0
     
     def getCount(self):
         return len(self.items)
@@ -111,109 +342,1007 @@ class SpriteAdapter(BaseAdapter):
         layout.setOrientation(LinearLayout.VERTICAL)
         
         imageView = ImageView(context)
+        self.last_position = position
         
-        if self.cache.containsKey(position):
-            entry = self.cache[position]
-            name = entry.name
-            bitmap = entry.bitmap
-            imageView.setImageBitmap(bitmap)
-            
-            if len(self.positions) > self.cache_size:
-                self.cache.remove(self.positions.remove())
+        if self.previews == None:
+            entry = self.cachedEntry(position, self.size)
+        else:
+            entry = None
+        
+        if self.previews != None:
+            # Sprites read from streams have previews for the first sprites,
+            # and placeholders for the rest.
+            name = self.items[position]
+            bitmap = self.previews[position]
+            if bitmap == None:
+                self.pool.show(imageView, self.pool.placeholder)
+            else:
+                self.getPool(self.preview_size).show(imageView, bitmap)
+        
+        elif entry != None:
+            self.profiler.count(Profiler.CACHE_HITS, long(1))
+            name = self.items[position]
+            self.showEntry(imageView, entry)
+            self.trimCache()
         
         else:
-            # Create a placeholder bitmap to put into the view.
-            bitmap = SpriteRenderer.emptyBitmap(self.preview_size,
-                self.preview_size, False)
-            imageView.setImageBitmap(bitmap)
+            self.profiler.count(Profiler.CACHE_MISSES, long(1))
+            
+            # Show the preview of the nearest size if there is one, otherwise
+            # create a placeholder bitmap to put into the view, using the
+            # thumbnail from the index if there is one.
+            nearest = self.nearestEntry(position)
+            if nearest != None:
+                self.showEntry(imageView, nearest)
+            else:
+                self.pool.show(imageView, self.placeholder(position))
             
-            # Schedule the rendering process.
+            # Schedule the rendering process, starting with a coarse preview
+            # unless the index or another size has already supplied one, or
+            # the preview can be loaded from the store. The scheduler also
+            # omits the coarse preview for sprites that are cheap to render.
             name = self.items[position]
-            self.scheduleRender(WorkItem(position, imageView))
+            work = WorkItem(position, imageView, self.size)
+            thumbnails = self.index != None and self.index.thumb_size != 0
+            work.coarse = self.progressive and nearest == None and \
+                          not thumbnails and not self.isStored(position)
+            self.scheduleRender(work)
         
         textView = TextView(context)
         textView.setText(name)
         textView.setGravity(0x01) # center_horizontal
         
-        layout.addView(imageView)
+        # Previews of other sizes are scaled to fit the view.
+        layout.addView(imageView,
+                       LinearLayout.LayoutParams(self.size, self.size))
         layout.addView(textView)
         
         return layout
     
-    """This method is used to tell the adapter which file to examine. We create
-    a `Spritefile` object for the given file and read the names of the sprites
-    it contains. We also clear the structures used to hold cache information."""
+    """The following method returns a placeholder bitmap for the sprite at the
+    given position."""
+    
+    @args(Bitmap, [int])
+    def placeholder(self, position):
+    
+        if self.index != None:
+            thumbnail = self.index.getThumbnail(position)
+            if thumbnail != None:
+                return SpriteRenderer.thumbnailPreview(thumbnail,
+                    self.index.getWidth(position), self.size, self.size)
+        
+        return self.pool.placeholder
+    
+    """The following method returns the cache entry for the sprite at the given
+    position with the given preview size, or `None` if it has not been rendered
+    at that size or is no longer cached."""
+    
+    @args(CacheEntry, [int, int])
+    def cachedEntry(self, position, size):
+    
+        key = self.keys.get(position)
+        if key == None:
+            return None
+        
+        return self.cache.get(self.cacheKey(key, size))
+    
+    """This method returns the cache entry for the sprite at the given position
+    with the preview size nearest to the current one, preferring larger sizes,
+    or `None` if it has not been rendered at any other size."""
+    
+    @args(CacheEntry, [int])
+    def nearestEntry(self, position):
+    
+        current = self.sizeIndex(self.size)
+        nearest = None
+        distance = 0
+        
+        i = len(self.preview_sizes) - 1
+        while i >= 0:
+            entry = self.cachedEntry(position, self.preview_sizes[i])
+            if i != current and entry != None:
+                if nearest == None or Math.abs(i - current) < distance:
+                    nearest = entry
+                    distance = Math.abs(i - current)
+            i -= 1
+        
+        return nearest
+    
+    """The following method returns the key used to cache the preview of the
+    given size of a sprite with the given content key."""
+    
+    @args(String, [String, int])
+    def cacheKey(self, key, size):
+    
+        return String.valueOf(size) + "/" + key
+    
+    """This method returns the key used to identify the contents of the named
+    sprite. Once a sprite has been decoded, the hash of its contents is used so
+    that identical sprites share cache entries. Otherwise its name is used."""
+    
+    @args(String, [String])
+    def contentKey(self, name):
+    
+        if self.spritefile != None:
+            sprite = self.spritefile.sprites.get(name)
+            if sprite != None and sprite.hash != None:
+                return sprite.hash
+        
+        return "name:" + name
+    
+    """This method returns the number of bytes of previews of the given size
+    that may be kept for each file."""
+    
+    @static
+    @args(long, [int])
+    def cacheBudget(size):
+    
+        preview_size = SpriteAdapter.preview_size
+        return (long(SpriteAdapter.cache_budget) * long(size) * long(size)) / \
+               long(preview_size * preview_size)
+    
+    """The following method removes entries from the cache until the bitmaps it
+    holds fit within the budget for the current preview size, using the number
+    of bytes each bitmap actually occupies. Previews of other sizes are not
+    shown once the views have been updated, so the oldest of those are removed
+    first, followed by the oldest previews of the current size."""
+    
+    @args(void, [])
+    def trimCache(self):
+    
+        budget = self.cacheBudget(self.size)
+        
+        it = self.order.iterator()
+        while self.cache_bytes > budget and it.hasNext():
+        
+            key = it.next()
+            entry = self.cache.get(key)
+            if entry != None and entry.size == self.size:
+                continue
+            
+            it.remove()
+            if entry != None:
+                self.cache.remove(key)
+                self.cache_bytes -= long(entry.bitmap.getByteCount())
+                self.release(entry)
+        
+        while self.cache_bytes > budget and not self.order.isEmpty():
+        
+            evicted = self.order.remove()
+            entry = self.cache.remove(evicted)
+            if entry == None:
+                continue
+            
+            self.cache_bytes -= long(entry.bitmap.getByteCount())
+            self.release(entry)
+    
+    """The following method marks a cache entry as evicted, returning its
+    bitmap to the pool if no view is showing it. Otherwise the bitmap is
+    returned when the last view showing it is recycled."""
+    
+    @args(void, [CacheEntry])
+    def release(self, entry):
+    
+        if entry == None:
+            return
+        
+        entry.evicted = True
+        if entry.views == 0:
+            self.releaseBitmap(entry.bitmap)
+    
+    """This method shows the bitmap in a cache entry in a view. The entry shown
+    by each view is recorded in its tag so that the entry's count of views can
+    be updated when the view shows something else or is recycled."""
+    
+    @args(void, [ImageView, CacheEntry])
+    def showEntry(self, view, entry):
+    
+        if view.getTag() != entry:
+            self.hideEntry(view)
+            entry.views += 1
+            view.setTag(entry)
+        
+        self.getPool(entry.size).show(view, entry.bitmap)
+    
+    """The following method records that a view no longer shows the cache entry
+    it was showing, if any, returning the entry's bitmap to the pool if the
+    entry has been evicted and no other view shows it."""
+    
+    @args(void, [View])
+    def hideEntry(self, view):
+    
+        tag = view.getTag()
+        if tag == None:
+            return
+        
+        view.setTag(None)
+        entry = CAST(tag, CacheEntry)
+        entry.views -= 1
+        
+        if entry.evicted and entry.views == 0:
+            self.releaseBitmap(entry.bitmap)
+    
+    """The view showing the adapter's items calls the following method when
+    the layout for an item leaves the screen. The layout is no longer drawn, so
+    the preview it contains no longer needs its bitmap."""
+    
+    def onMovedToScrapHeap(self, view):
+    
+        layout = CAST(view, LinearLayout)
+        self.hideEntry(layout.getChildAt(0))
+    
+    """This method returns a bitmap to the pool for bitmaps of its size."""
+    
+    @args(void, [Bitmap])
+    def releaseBitmap(self, bitmap):
+    
+        if bitmap == None:
+            return
+        
+        pool = self.pools.get(bitmap.getWidth())
+        if pool != None:
+            pool.release(bitmap)
+    
+    """The following method returns the pool of bitmaps for previews of the
+    given size, creating it if necessary. It must be called in the main UI
+    thread."""
+    
+    @args(BitmapPool, [int])
+    def getPool(self, size):
+    
+        pool = self.pools.get(size)
+        if pool == None:
+            pool = BitmapPool(size, size, self.pool_size, self.profiler)
+            self.pools[size] = pool
+        
+        return pool
+    
+    """This method changes the size of the previews shown, returning `True` if
+    the size changed. Cached previews of other sizes are kept, both to be shown
+    until previews of the new size are rendered and in case the size is changed
+    back."""
+    
+    @args(bool, [int])
+    def setPreviewSize(self, size):
+    
+        if size == self.size or self.sizeIndex(size) == -1:
+            return False
+        
+        self.size = size
+        self.pool = self.getPool(size)
+        
+        # Renders waiting to be started were for views of the previous size.
+        self.pending.clear()
+        self.large.clear()
+        self.pausePrerender()
+        
+        self.notifyDataSetChanged()
+        self.scheduleIdle()
+        return True
+    
+    """The following method changes the preview size to the next larger or
+    smaller size, depending on the sign of the given step."""
+    
+    @args(bool, [int])
+    def stepPreviewSize(self, step):
+    
+        i = self.sizeIndex(self.size) + step
+        if i < 0 or i >= len(self.preview_sizes):
+            return False
+        
+        return self.setPreviewSize(self.preview_sizes[i])
+    
+    @args(int, [])
+    def getPreviewSize(self):
+    
+        return self.size
+    
+    @args(int, [int])
+    def sizeIndex(self, size):
+    
+        for i in range(len(self.preview_sizes)):
+            if self.preview_sizes[i] == size:
+                return i
+        
+        return -1
+    
+    """This method is used to tell the adapter which file to examine. If the
+    file was opened recently and has not changed since then, we reuse its
+    state. Otherwise, we create a `Spritefile` object for the given file, read
+    the names of the sprites it contains and start with an empty cache. The
+    least recently opened file is forgotten if too many are being kept.
+    
+    If the file has a valid index, the names and locations of the sprites are
+    obtained from it instead of the file itself. Indexes for large files are
+    only written if the adapter has been given a directory to keep them in."""
     
     @args(void, [File])
     def setFile(self, file):
     
-        try:
-            self.spritefile = Spritefile(file)
-            self.items = LinkedList(self.spritefile.sprites.keySet())
-            Collections.sort(self.items)
-        except:
-            self.items = []
+        # Renders waiting to be started were for views of the previous file.
+        self.pending.clear()
+        self.large.clear()
+        self.stopLoading()
+        self.pausePrerender()
+        
+        opened = self.findRecent(file)
+        
+        if opened == None:
+            try:
+                index = SpriteIndex.open(file, self.index_dir)
+                if index != None:
+                    spritefile = index.createSpritefile(file, self.profiler)
+                    items = index.names()
+                else:
+                    spritefile = Spritefile(file, self.profiler)
+                    items = LinkedList(spritefile.sprites.keySet())
+                    Collections.sort(items)
+                    
+                    if len(items) >= self.index_threshold and \
+                       self.index_dir != None:
+                        SpriteIndexWriter(file, self.index_dir).start()
+            except:
+                self.spritefile = None
+                self.index = None
+                self.opened = None
+                self.items = []
+                self.cache = {}
+                self.cache_bytes = long(0)
+                self.keys = {}
+                self.order = []
+                return
+            
+            opened = OpenFile(file, spritefile, index, items)
+            
+            if len(self.recent) >= self.recent_files:
+                forgotten = self.recent.removeLast()
+                for entry in forgotten.cache.values():
+                    self.release(entry)
         
+        self.recent.addFirst(opened)
+        
+        self.opened = opened
+        self.last_position = 0
+        self.spritefile = opened.spritefile
+        self.index = opened.index
+        self.items = opened.items
+        self.cache = opened.cache
+        self.cache_bytes = self.getCacheBytes()
+        self.keys = opened.keys
+        self.order = opened.order
+        
+        self.scheduleIdle()
+    
+    """This method tells the adapter to read a spritefile from a content URI,
+    starting a `StreamLoader` to read it in the background."""
+    
+    @args(void, [ContentResolver, Uri])
+    def setUri(self, resolver, uri):
+    
+        self.pending.clear()
+        self.large.clear()
+        self.stopLoading()
+        self.pausePrerender()
+        
+        self.spritefile = None
+        self.index = None
+        self.opened = None
+        self.items = []
         self.cache = {}
-        self.positions = []
+        self.cache_bytes = long(0)
+        self.keys = {}
+        self.order = []
+        
+        self.uri = uri
+        self.resolver = resolver
+        self.previews = []
+        self.loader = StreamLoader(self, resolver, uri)
+        self.loader.start()
+    
+    @args(void, [])
+    def stopLoading(self):
+    
+        if self.loader != None:
+            self.loader.cancelled.set(True)
+        
+        self.loader = None
+        self.uri = None
+        self.previews = None
+    
+    """The following method is called in the main UI thread for each sprite
+    read by a `StreamLoader`. Sprites from loaders that have been stopped are
+    ignored."""
+    
+    @args(void, [StreamLoader, String, Bitmap])
+    def spriteLoaded(self, loader, name, bitmap):
+    
+        if loader != self.loader:
+            return
+        
+        self.items.add(name)
+        self.previews.add(bitmap)
+        self.notifyDataSetChanged()
+    
+    """The following method removes the state of the given file from the list
+    of recently opened files and returns it, or returns `None` if the file was
+    not opened recently or has changed since it was opened."""
+    
+    @args(OpenFile, [File])
+    def findRecent(self, file):
+    
+        it = self.recent.iterator()
+        while it.hasNext():
+            opened = it.next()
+            if opened.file.equals(file):
+                it.remove()
+                if opened.isCurrent(file):
+                    return opened
+                else:
+                    return None
+        
+        return None
     
     @args(String, [int])
     def getSpriteName(self, position):
     
-        return self.items[position]
+        return self.items[position]
+    
+    """This method returns the name of the spritefile being shown."""
+    
+    @args(String, [])
+    def getFileName(self):
+    
+        if self.uri != None:
+            return self.uri.getLastPathSegment()
+        
+        return self.spritefile.file.getName()
+    
+    """This method returns the path of the spritefile being shown or, if it was
+    read from a stream, its content URI."""
+    
+    @args(String, [])
+    def getSource(self):
+    
+        if self.uri != None:
+            return self.uri.toString()
+        
+        return self.spritefile.file.getPath()
+    
+    """This method is used to obtain a `Bitmap` for a sprite at a given
+    position in the list of items held by the adapter."""
+    
+    @args(Bitmap, [int])
+    def getSpriteBitmap(self, position):
+    
+        return SpriteRenderer.spriteBitmap(self.getSprite(position))
+    
+    """The following method returns the decoded sprite at a given position.
+    Sprites from streams are obtained by reading the stream again."""
+    
+    @args(Sprite, [int])
+    def getSprite(self, position):
+    
+        if self.uri != None:
+            return StreamLoader.getSprite(self.resolver, self.uri, position)
+        
+        return self.spritefile.getSprite(self.items[position])
+    
+    """The following method schedules a sprite render, estimating its cost and
+    adding it to the queue for the appropriate lane, then starts as many
+    waiting renders as the lanes allow. A coarse preview is only rendered if
+    the full render is estimated to cost more than it, and costs no more than
+    the fixed cost of decoding a sample of the sprite."""
+    
+    @args(void, [WorkItem])
+    def scheduleRender(self, work):
+    
+        self.pausePrerender()
+        
+        work.spritefile = self.spritefile
+        work.cost = self.renderCost(work)
+        
+        if work.coarse:
+            if work.cost > long(self.coarse_cost):
+                work.cost = long(self.coarse_cost)
+            else:
+                work.coarse = False
+        
+        work.large = not work.coarse and work.cost > self.large_cost
+        
+        if work.large:
+            self.large.add(work)
+        else:
+            self.pending.add(work)
+        
+        self.startRenders()
+    
+    """This method starts the cheapest waiting renders in each lane until each
+    lane has as many renders in progress as it allows. Renders are not started
+    while a sprite requested by the user is being decoded."""
+    
+    @args(void, [])
+    def startRenders(self):
+    
+        if self.interactive > 0:
+            return
+        
+        while self.in_flight < self.render_limit and \
+              not self.pending.isEmpty():
+            if not self.startRender(self.pending.remove()):
+                break
+        
+        while self.large_in_flight < self.large_limit and \
+              not self.large.isEmpty():
+            if not self.startRender(self.large.remove()):
+                break
+    
+    """The following method asks the environment to start a render, returning
+    `False` if it could not be started. In that case, the render is queued
+    again and an event is scheduled for later, causing the run method to be
+    called."""
+    
+    @args(bool, [WorkItem])
+    def startRender(self, work):
+    
+        name = self.items[work.position]
+        
+        if self.environment.startRender(self, work, name):
+            if work.large:
+                self.large_in_flight += 1
+            else:
+                self.in_flight += 1
+            return True
+        
+        if work.large:
+            self.large.add(work)
+        else:
+            self.pending.add(work)
+        
+        self.environment.postDelayed(self, long(250)) # 0.25s
+        return False
+    
+    """This method is called when renders that could not be started need to be
+    tried again, and when the adapter may have become idle. If it has been idle
+    for long enough, the rest of the file is rendered in the background."""
+    
+    def run(self):
+    
+        self.startRenders()
+        
+        idle = SystemClock.uptimeMillis() - self.last_work
+        if self.isQuiet() and idle >= long(self.idle_delay):
+            self.startPrerender()
+    
+    """The following method is called when a render has finished, allowing
+    another render in the same lane to be started."""
+    
+    @args(void, [WorkItem])
+    def finished(self, work):
+    
+        if work.large:
+            self.large_in_flight -= 1
+        else:
+            self.in_flight -= 1
+        
+        self.startRenders()
+        self.scheduleIdle()
+    
+    """The following method decodes the sprite at the given position for an
+    action requested by the user, passing it to the listener in the main UI
+    thread. The state needed to find the sprite is captured here so that the
+    request is not affected if another file is opened before it finishes."""
+    
+    @args(void, [int, SpriteListener])
+    def requestSprite(self, position, listener):
+    
+        request = SpriteRequest(self, listener, self.items[position], position)
+        request.spritefile = self.spritefile
+        request.resolver = self.resolver
+        request.uri = self.uri
+        
+        self.pausePrerender()
+        self.interactive += 1
+        request.start()
+    
+    """When a requested sprite has been decoded, or could not be decoded, the
+    following method is called in the main UI thread. Rendering of previews is
+    resumed before the sprite is delivered to the listener."""
+    
+    @args(void, [SpriteRequest])
+    def requestFinished(self, request):
+    
+        self.interactive -= 1
+        self.startRenders()
+        self.scheduleIdle()
+        
+        request.listener.spriteDecoded(request.name, request.sprite)
+    
+    """This method returns the estimated cost of a full render, which is as
+    much as decoding the sprite, as estimated by the spritefile from the size
+    of the sprite's data or from the information in the index. The file is not
+    read, since this method is called in the main UI thread. Previews that can
+    be loaded from the store are given the lowest cost. Renders of sprites
+    whose cost cannot be estimated are given no cost."""
+    
+    @args(long, [WorkItem])
+    def renderCost(self, work):
+    
+        if self.spritefile == None:
+            return long(0)
+        
+        if self.isStored(work.position):
+            return long(1)
+        
+        name = self.items[work.position]
+        
+        try:
+            if self.index != None:
+                cost = self.spritefile.estimateCost(name,
+                    self.index.getWidth(work.position),
+                    self.index.getHeight(work.position),
+                    self.index.getMode(work.position),
+                    self.index.hasMask(work.position))
+            else:
+                cost = self.spritefile.estimateCost(name)
+        except:
+            return long(0)
+        
+        return cost
+    
+    """When a `SpriteRenderer` has finished, it calls the following method in
+    the main UI thread. We update the bitmap cache with the new bitmap, using
+    the preview size of the work item, and add its key to the queue of keys to
+    the cache. Then we update the `ImageView` to show the finished bitmap.
+    Renders started for a different file are not cached, even if it has a
+    sprite with the same name at the same position, and their bitmaps are
+    returned to the pool.
+    
+    If an identical sprite with a different name is already cached, its bitmap
+    is shown and shared instead, and the new bitmap is returned to the pool."""
+    
+    @args(void, [WorkItem, String, Bitmap])
+    def renderFinished(self, work, name, bitmap):
+    
+        self.finished(work)
+        
+        position = work.position
+        view = work.view
+        
+        if work.spritefile != self.spritefile or \
+           position >= len(self.items) or \
+           not self.items[position].equals(name):
+            self.releaseBitmap(bitmap)
+            return
+        
+        self.keys[position] = self.contentKey(name)
+        key = self.cacheKey(self.keys[position], work.size)
+        
+        entry = self.cache.get(key)
+        if entry != None:
+            if entry.bitmap != bitmap:
+                self.releaseBitmap(bitmap)
+            self.showEntry(view, entry)
+            return
+        
+        entry = CacheEntry(name, bitmap, work.size)
+        self.cache[key] = entry
+        self.cache_bytes += long(bitmap.getByteCount())
+        self.order.add(key)
+        self.showEntry(view, entry)
+        self.trimCache()
+    
+    """When a coarse preview has been rendered, the following method is called
+    in the main UI thread to show it and to schedule the full render. If the
+    sprite was small enough to be rendered in full quickly, no coarse preview
+    is supplied. As with full renders, coarse previews of sprites in a file
+    that is no longer shown are discarded."""
+    
+    @args(void, [WorkItem, String, Bitmap])
+    def coarseFinished(self, work, name, bitmap):
+    
+        self.finished(work)
+        
+        position = work.position
+        
+        if work.spritefile != self.spritefile:
+            self.releaseBitmap(bitmap)
+        
+        elif position < len(self.items) and \
+           self.items[position].equals(name) and work.size == self.size:
+            if bitmap != None:
+                self.getPool(work.size).show(work.view, bitmap)
+            self.scheduleRender(WorkItem(position, work.view, work.size))
+    
+    """The following method gives the adapter a store in which the previews of
+    whole files are kept. Without a store, no previews are rendered in the
+    background."""
+    
+    @args(void, [ThumbnailStore])
+    def setStore(self, store):
+    
+        self.store = store
+    
+    """This method gives the adapter a directory in which to keep the indexes
+    it writes for large spritefiles."""
+    
+    @args(void, [File])
+    def setIndexDirectory(self, directory):
+    
+        self.index_dir = directory
+    
+    """This method reports whether the preview of the sprite at the given
+    position is held in the store at the current preview size."""
+    
+    @args(bool, [int])
+    def isStored(self, position):
+    
+        if self.store == None or self.opened == None or self.uri != None:
+            return False
+        
+        return self.store.contains(self.opened.folder, self.size,
+                                   self.items[position])
+    
+    """The following method is called when the application enters or leaves
+    the foreground. Previews are only rendered in the background while it is
+    in the foreground."""
+    
+    @args(void, [bool])
+    def setForeground(self, foreground):
+    
+        self.foreground = foreground
+        
+        if foreground:
+            self.scheduleIdle()
+        else:
+            self.pausePrerender()
+    
+    """This method reports whether the adapter has no renders or requests
+    waiting or in progress."""
+    
+    @args(bool, [])
+    def isQuiet(self):
+    
+        return self.pending.isEmpty() and self.large.isEmpty() and \
+               self.in_flight == 0 and self.large_in_flight == 0 and \
+               self.interactive == 0
+    
+    """The following method records that the adapter has become busy, stopping
+    any background rendering of the file. The prerenderer keeps the previews it
+    has already stored, so it continues from where it stopped when it is
+    started again."""
+    
+    @args(void, [])
+    def pausePrerender(self):
+    
+        self.last_work = SystemClock.uptimeMillis()
+        
+        if self.prerenderer != None:
+            self.prerenderer.cancelled.set(True)
+            self.prerenderer = None
+    
+    """When the adapter has no work left, the following method schedules a
+    check for whether it is still idle after a delay, causing the run method
+    to be called."""
+    
+    @args(void, [])
+    def scheduleIdle(self):
+    
+        if self.store != None and self.foreground and self.isQuiet():
+            self.environment.postDelayed(self, long(self.idle_delay))
+    
+    """This method starts rendering the previews of the current file in the
+    background, beginning with the most recently shown sprite, unless this is
+    already being done or has been done for the current preview size."""
+    
+    @args(void, [])
+    def startPrerender(self):
+    
+        if self.store == None or not self.foreground or \
+           self.opened == None or self.uri != None or \
+           self.prerenderer != None or \
+           self.opened.prerendered.contains(self.size):
+            return
+        
+        self.prerenderer = Prerenderer(self, self.opened, self.size,
+                                       self.last_position)
+        self.prerenderer.start()
+    
+    """When a prerenderer has stored the previews of all the sprites in its
+    file, the following method is called in the main UI thread to record that
+    the file does not need to be rendered again at that size."""
+    
+    @args(void, [Prerenderer])
+    def prerenderFinished(self, prerenderer):
+    
+        prerenderer.opened.prerendered.add(prerenderer.size)
+        
+        if prerenderer == self.prerenderer:
+            self.prerenderer = None
+    
+    """Progressive rendering can be disabled with the following method, causing
+    each sprite to be rendered in a single stage."""
+    
+    @args(void, [bool])
+    def setProgressive(self, progressive):
+    
+        self.progressive = progressive
+    
+    """The following methods report the state of the adapter's rendering
+    queue and cache."""
+    
+    @args(int, [])
+    def getQueueLength(self):
+    
+        return self.pending.size() + self.large.size()
+    
+    @args(int, [])
+    def getInFlight(self):
+    
+        return self.in_flight + self.large_in_flight
+    
+    @args(int, [])
+    def getCacheEntries(self):
+    
+        return len(self.cache)
+    
+    @args(long, [])
+    def getCacheBytes(self):
+    
+        total = long(0)
+        for entry in self.cache.values():
+            total += long(entry.bitmap.getByteCount())
+        
+        return total
+
+
+"""We define an interface for the objects that an adapter uses to start
+rendering sprites and to schedule events for later. The `startRender` method
+returns `False` if the render could not be started. Implementations must call
+the adapter's `renderFinished` method in the main UI thread when a render is
+complete. Renders of large sprites, whose work items are marked as large,
+should not delay other renders."""
+
+class RenderEnvironment:
+
+    @args(bool, [SpriteAdapter, WorkItem, String])
+    def startRender(self, adapter, work, name):
+        pass
+    
+    @args(void, [Runnable, long])
+    def postDelayed(self, runnable, delay):
+        pass
+
+
+"""We define an interface for objects that receive sprites requested using the
+adapter's `requestSprite` method. The `spriteDecoded` method is called in the
+main UI thread with the name of the sprite and the decoded sprite, or `None` if
+it could not be decoded."""
+
+class SpriteListener:
+
+    @args(void, [String, Sprite])
+    def spriteDecoded(self, name, sprite):
+        pass
+
+
+"""The following class is the environment normally used by adapters. It renders
+sprites using `SpriteRenderer` tasks and schedules events using a `Handler`.
+Most renders use the serial executor shared by all tasks, but renders of large
+sprites are performed by a thread of their own. Renderers are given the
+adapter's store, if it has one, so that they can load stored previews."""
+
+class AsyncRenderEnvironment(Object):
+
+    __interfaces__ = [RenderEnvironment]
+    
+    __fields__ = {"handler": Handler, "large_executor": Executor}
+    
+    def __init__(self):
+    
+        Object.__init__(self)
+        self.handler = Handler()
+        self.large_executor = Executors.newSingleThreadExecutor()
+    
+    @args(bool, [SpriteAdapter, WorkItem, String])
+    def startRender(self, adapter, work, name):
+    
+        renderer = SpriteRenderer(adapter, adapter.spritefile, name, work)
+        renderer.pool = adapter.getPool(work.size)
+        
+        if adapter.store != None and adapter.opened != None:
+            renderer.store = adapter.store
+            renderer.folder = adapter.opened.folder
+        try:
+            # Create a list then convert it to an array. The initial list
+            # creation causes the items to be wrapped in Integer objects.
+            params = array([work.size, work.size, work.position])
+            if work.large:
+                renderer.executeOnExecutor(self.large_executor, params)
+            else:
+                renderer.execute(params)
+            return True
+        except:
+            return False
+    
+    @args(void, [Runnable, long])
+    def postDelayed(self, runnable, delay):
+    
+        self.handler.postDelayed(runnable, delay)
+
+
+"""The following class describes a sprite to be rendered for a view at a given
+preview size. Its `coarse` field indicates whether only a coarse preview is
+required. The spritefile that the render was scheduled for, the estimated
+cost of the render and whether it uses the lane for large sprites are recorded
+when it is scheduled, so that results for a file that is no longer shown can be
+recognised."""
+
+class WorkItem(Object):
+
+    __fields__ = {"position": int, "view": ImageView, "size": int,
+                  "coarse": bool, "cost": long, "large": bool,
+                  "spritefile": Spritefile}
+    
+    @args(void, [int, ImageView, int])
+    def __init__(self, position, view, size):
+    
+        Object.__init__(self)
+        self.position = position
+        self.view = view
+        self.size = size
+        self.coarse = False
+        self.cost = long(0)
+        self.large = False
+        self.spritefile = None
+
+
+"""The following class holds work items waiting to be rendered in order of
+increasing cost. Items with the same cost are kept in the order in which they
+were added, so renders whose costs cannot be estimated are performed in the
+order in which they were requested. The queue only holds the renders for the
+views on screen, so it is kept in a list that is searched when items are
+added."""
+
+class RenderQueue(Object):
+
+    __fields__ = {"items": List(WorkItem)}
+    
+    def __init__(self):
+    
+        Object.__init__(self)
+        self.items = []
     
-    """This method is used to obtain a `Bitmap` for a sprite at a given
-    position in the list of items held by the adapter."""
+    @args(void, [WorkItem])
+    def add(self, work):
     
-    @args(Bitmap, [int])
-    def getSpriteBitmap(self, position):
+        # Insert the item after all others with the same or a lower cost.
+        i = len(self.items)
+        while i > 0 and self.items[i - 1].cost > work.cost:
+            i -= 1
+        
+        self.items.add(i, work)
     
-        name = self.items[position]
-        return SpriteRenderer.getSpriteBitmap(self.spritefile, name)
+    """This method removes and returns the cheapest item in the queue."""
     
-    """The following method schedules a sprite render, either performing it
-    immediately or, if too many sprites are already being rendered, schedules
-    it for later."""
+    @args(WorkItem, [])
+    def remove(self):
     
-    @args(void, [WorkItem])
-    def scheduleRender(self, work):
+        return self.items.remove(0)
     
-        name = self.items[work.position]
-        renderer = SpriteRenderer(self.spritefile, name, work.view,
-                                  self.cache, self.positions)
-        try:
-            # Create a list then convert it to an array. The initial list
-            # creation causes the items to be wrapped in Integer objects.
-            renderer.execute(array([self.preview_size, self.preview_size,
-                                    work.position]))
-        except:
-            # The sprite couldn't be rendered immediately. Add this item of
-            # work to a queue and schedule an event for later. This will cause
-            # the run method to be called.
-            self.pending.add(work)
-            self.handler.postDelayed(self, long(250)) # 0.25s
+    @args(bool, [])
+    def isEmpty(self):
     
-    """This method is called when a sprite render scheduled for later needs to
-    be performed. We simply check that there is at least one sprite in the
-    queue and try to schedule it again."""
+        return self.items.isEmpty()
     
-    def run(self):
+    @args(int, [])
+    def size(self):
     
-        if not self.pending.isEmpty():
-            work = self.pending.remove()
-            self.scheduleRender(work)
-
-
-class WorkItem(Object):
-
-    __fields__ = {"position": int, "view": ImageView}
+        return len(self.items)
     
-    @args(void, [int, ImageView])
-    def __init__(self, position, view):
+    @args(void, [])
+    def clear(self):
     
-        Object.__init__(self)
-        self.position = position
-        self.view = view
+        self.items.clear()
 
 
 """The following class is used to render each sprite asynchronously in a
@@ -224,20 +1353,28 @@ class SpriteRenderer(AsyncTask):
 
     __item_types__ = [int, Bitmap, Bitmap]
     
-    """The `__init__` method accepts the sprite to render, the `ImageView` used
-    to display the resulting bitmap, a `Map` that contains cached bitmaps for
-    sprites already rendered, and a queue of keys for bitmaps in the cache."""
+    __fields__ = {"store": ThumbnailStore, "folder": String}
+    
+    """The `__init__` method accepts the adapter to report the result to, the
+    sprite to render and the work item describing the render, which holds the
+    `ImageView` used to display the resulting bitmap. Previews are drawn into
+    bitmaps from the adapter's current pool unless the environment supplies
+    the pool for another size. Previews are loaded from a store instead of
+    being rendered if the environment supplies one that holds them."""
     
-    @args(void, [Spritefile, String, ImageView, Map(int, CacheEntry), Queue(int)])
-    def __init__(self, spritefile, name, imageView, cache, queue):
+    @args(void, [SpriteAdapter, Spritefile, String, WorkItem])
+    def __init__(self, adapter, spritefile, name, work):
     
         AsyncTask.__init__(self)
         
+        self.adapter = adapter
         self.spritefile = spritefile
         self.name = name
-        self.imageView = imageView
-        self.cache = cache
-        self.queue = queue
+        self.work = work
+        self.coarse = work.coarse
+        self.pool = adapter.pool
+        self.store = None
+        self.folder = None
         
         self.paint = Paint()
         self.paint.setXfermode(PorterDuffXfermode(PorterDuff.Mode.SRC_OVER))
@@ -249,35 +1386,43 @@ class SpriteRenderer(AsyncTask):
     @args(Bitmap, [int, int, bool])
     def emptyBitmap(width, height, ready):
     
-        bitmap = Bitmap.createBitmap(width, height, Bitmap.Config.ARGB_8888)
-        canvas = Canvas(bitmap)
-        paint = Paint()
-        paint.setXfermode(PorterDuffXfermode(PorterDuff.Mode.SRC))
+        return BitmapPool.chequered(width, height, ready)
+    
+    """The following method creates a placeholder bitmap from a thumbnail held
+    in an index. The thumbnail is scaled to the size that the rendered sprite
+    will have, which is found using the width of the sprite and the aspect
+    ratio of the thumbnail."""
+    
+    @static
+    @args(Bitmap, [Bitmap, int, int, int])
+    def thumbnailPreview(thumbnail, sprite_width, w, h):
+    
+        width = Math.max(1, sprite_width)
+        height = Math.max(1, (width * thumbnail.getHeight()) /
+                             thumbnail.getWidth())
         
-        if ready:
-            b1 = Color.argb(255, 96, 96, 96)
-            b2 = Color.argb(255, 128, 128, 128)
-        else:
-            b1 = Color.argb(255, 32, 32, 32)
-            b2 = Color.argb(255, 64, 64, 64)
+        scale = Math.min(w/float(width), h/float(height))
         
-        i = 0
-        for y in range(0, height, 16):
+        if 0 < scale < 1:
+            sw = Math.max(1, scale * width)
+            sh = Math.max(1, scale * height)
+        elif scale >= 2:
+            s = Math.min(int(Math.floor(scale)), 3)
+            sw = s * width
+            sh = s * height
+        else:
+            sw = width
+            sh = height
         
-            j = 1 - i
-            
-            for x in range(0, width, 16):
-                if j == 0:
-                    paint.setColor(b1)
-                else:
-                    paint.setColor(b2)
-                
-                canvas.drawRect(x, y, x + 16, y + 16, paint)
-                j = 1 - j
-            
-            i = 1 - i
+        preview = SpriteRenderer.emptyBitmap(w, h, False)
+        left = (w - sw)/2
+        top = (h - sh)/2
         
-        return bitmap
+        canvas = Canvas(preview)
+        canvas.drawBitmap(thumbnail, None,
+                          Rect(left, top, left + sw, top + sh),
+                          Paint(Paint.FILTER_BITMAP_FLAG))
+        return preview
     
     """We define a method to obtain a sprite from the spritefile. This is
     potentially a slow operation, which is why it is called by the
@@ -297,32 +1442,101 @@ class SpriteRenderer(AsyncTask):
     @args(Bitmap, [Spritefile, String])
     def getSpriteBitmap(spritefile, name):
     
-        sprite = spritefile.getSprite(name)
-        
+        return SpriteRenderer.spriteBitmap(spritefile.getSprite(name))
+    
+    """The following method creates a `Bitmap` for a decoded sprite, correcting
+    its aspect ratio if its pixels are not square."""
+    
+    @static
+    @args(Bitmap, [Sprite])
+    def spriteBitmap(sprite):
+    
         bitmap = Bitmap.createBitmap(sprite.width, sprite.height, Bitmap.Config.ARGB_8888)
         bitmap.copyPixelsFromBuffer(ByteBuffer.wrap(sprite.rgba))
         
-        if sprite.ydpi < sprite.xdpi:
+        if 0 < sprite.ydpi < sprite.xdpi:
             yscale = sprite.xdpi/sprite.ydpi
             bitmap = Bitmap.createScaledBitmap(bitmap, bitmap.getWidth(),
                 bitmap.getHeight() * yscale, False)
         
         return bitmap
     
-    """The following method performs work in a background thread. It accepts
-    an array of the `Params` type, which we defined above as `int`, so it will
+    """The following method performs work in a background thread. It accepts an
+    array of the `Params` type, which we defined above as `int`, so it will
     receive an array of integers which describe the width and height of each
     bitmap to create, as well as the position of the bitmap in the adapter that
     uses the `SpriteRenderer`. The position is used as a key into the `Map` we
-    use as a cache."""
+    use as a cache. Sprites that cannot be decoded or drawn are represented by
+    the pool's failure image, which the adapter shows in their place."""
     
     @args(Result, [[Params]])
     def doInBackground(self, params):
     
         w, h, self.position = params
         
-        bitmap = self.getSpriteBitmap()
+        if self.coarse:
+            return self.coarsePreview(w, h)
+        
+        profiler = self.spritefile.profiler
+        
+        if self.store != None:
+            stored = self.store.load(self.folder, w, self.name)
+            if stored != None:
+                profiler.count(Profiler.STORE_HITS, long(1))
+                return self.pool.compact(stored)
+        
+        started = System.nanoTime()
+        pool = self.pool
+        
+        try:
+            bitmap = self.getSpriteBitmap()
+        except:
+            return pool.failure
+        
+        start = profiler.begin(Profiler.RENDER)
+        
+        try:
+            preview = pool.compact(self.drawPreview(bitmap, pool.acquire(),
+                                                    self.paint))
+        except:
+            preview = pool.failure
         
+        profiler.end(Profiler.RENDER, start)
+        profiler.sample(System.nanoTime() - started)
+        
+        return preview
+    
+    """The following method renders a coarse preview of the sprite, scaled to
+    the size of the full preview, or returns `None` if the sprite does not need
+    one or cannot be decoded."""
+    
+    @args(Bitmap, [int, int])
+    def coarsePreview(self, w, h):
+    
+        try:
+            sprite = self.spritefile.getCoarseSprite(self.name,
+                                                     SpriteAdapter.coarse_size)
+            if sprite == None:
+                return None
+            
+            width = self.spritefile.row_width(sprite)
+            return self.thumbnailPreview(self.spriteBitmap(sprite), width,
+                                         w, h)
+        except:
+            # The full render will report any problems with the sprite.
+            return None
+    
+    """This method scales a sprite's bitmap to fit within a preview bitmap,
+    enlarging small sprites by a whole number of times, and draws it on the
+    preview, which should already contain a background. The preview is
+    returned."""
+    
+    @static
+    @args(Bitmap, [Bitmap, Bitmap, Paint])
+    def drawPreview(bitmap, preview, paint):
+    
+        w = preview.getWidth()
+        h = preview.getHeight()
         width = bitmap.getWidth()
         height = bitmap.getHeight()
         
@@ -342,11 +1556,9 @@ class SpriteRenderer(AsyncTask):
             sh = Math.max(1, s * height)
             bitmap = Bitmap.createScaledBitmap(bitmap, sw, sh, False)
         
-        preview = self.emptyBitmap(w, h, True)
-        
         canvas = Canvas(preview)
         canvas.drawBitmap(bitmap, (w - bitmap.getWidth())/2,
-            (h - bitmap.getHeight())/2, self.paint)
+            (h - bitmap.getHeight())/2, paint)
         
         return preview
     
@@ -361,72 +1573,505 @@ class SpriteRenderer(AsyncTask):
     
     """When all processing has finished, the following method is called by the
     application framework to allow the final result to be handled in the main
-    UI thread. We update the bitmap cache with the new bitmap and add its
-    position to the queue of keys to the cache. Then we update the `ImageView`
-    to show the finished bitmap."""
+    UI thread. We pass the result to the adapter that started this task."""
     
     @args(void, [Result])
     def onPostExecute(self, result):
     
-        self.cache[self.position] = CacheEntry(self.name, result)
-        self.queue.add(self.position)
-        self.imageView.setImageBitmap(result)
+        if self.coarse:
+            self.adapter.coarseFinished(self.work, self.name, result)
+        else:
+            self.adapter.renderFinished(self.work, self.name, result)
+
+
+"""The following class reads a spritefile from a content URI in a background
+thread, decoding each sprite in turn and passing its name and preview to the
+adapter in the main UI thread. Only the first sprites are decoded, until their
+previews occupy the adapter's cache budget; the names of the remaining sprites
+are read without decoding them. Previews are always drawn at the initial
+preview size and are scaled to fit views of other sizes."""
+
+class StreamLoader(Thread):
+
+    __fields__ = {
+        "adapter": SpriteAdapter,
+        "resolver": ContentResolver,
+        "uri": Uri,
+        "pool": BitmapPool,
+        "cancelled": AtomicBoolean
+        }
+    
+    @args(void, [SpriteAdapter, ContentResolver, Uri])
+    def __init__(self, adapter, resolver, uri):
+    
+        Thread.__init__(self)
+        
+        self.adapter = adapter
+        self.resolver = resolver
+        self.uri = uri
+        self.pool = adapter.getPool(SpriteAdapter.preview_size)
+        self.cancelled = AtomicBoolean(False)
+    
+    def run(self):
+    
+        paint = Paint()
+        paint.setXfermode(PorterDuffXfermode(PorterDuff.Mode.SRC_OVER))
+        
+        try:
+            stream = SpriteStream(BufferedInputStream(
+                self.resolver.openInputStream(self.uri)))
+        except:
+            return
+        
+        used = long(0)
+        
+        while not self.cancelled.get():
+        
+            try:
+                data = stream.read_sprite()
+            except:
+                break
+            
+            if data == None:
+                break
+            
+            name = stream.read_name(data)
+            preview = None
+            
+            if used < SpriteAdapter.cacheBudget(self.pool.width):
+                try:
+                    bitmap = SpriteRenderer.spriteBitmap(stream.decode(data))
+                    pool = self.pool
+                    preview = pool.compact(SpriteRenderer.drawPreview(bitmap,
+                        pool.acquire(), paint))
+                    used += long(preview.getByteCount())
+                except:
+                    # Sprites that cannot be decoded are shown with a
+                    # placeholder.
+                    pass
+            
+            self.adapter.environment.postDelayed(
+                LoadedSprite(self.adapter, self, name, preview), long(0))
+        
+        stream.close()
+    
+    """The following method reads the stream for a content URI again to obtain
+    the sprite at the given position, skipping the sprites before it."""
+    
+    @static
+    @args(Sprite, [ContentResolver, Uri, int])
+    def getSprite(resolver, uri, position):
+    
+        stream = SpriteStream(BufferedInputStream(
+            resolver.openInputStream(uri)))
+        
+        for i in range(position):
+            stream.skipSprite()
+        
+        sprite = stream.next()
+        stream.close()
+        
+        return sprite
+
+
+"""The following class decodes a sprite requested by the user in a background
+thread. Unlike the threads used by `AsyncTask`, it runs with the same priority
+as the thread that created it, so it is not slowed down by renders of
+previews. The result is passed to the adapter in the main UI thread."""
+
+class SpriteRequest(Thread):
+
+    __fields__ = {
+        "adapter": SpriteAdapter, "listener": SpriteListener,
+        "name": String, "position": int,
+        "spritefile": Spritefile, "resolver": ContentResolver, "uri": Uri,
+        "sprite": Sprite
+        }
+    
+    @args(void, [SpriteAdapter, SpriteListener, String, int])
+    def __init__(self, adapter, listener, name, position):
+    
+        Thread.__init__(self)
+        
+        self.adapter = adapter
+        self.listener = listener
+        self.name = name
+        self.position = position
+        self.spritefile = None
+        self.resolver = None
+        self.uri = None
+        self.sprite = None
+    
+    def run(self):
+    
+        try:
+            if self.uri != None:
+                self.sprite = StreamLoader.getSprite(self.resolver, self.uri,
+                                                     self.position)
+            else:
+                self.sprite = self.spritefile.getSprite(self.name)
+        except:
+            self.sprite = None
+        
+        self.adapter.environment.postDelayed(RequestedSprite(self), long(0))
+
+
+"""This class passes a requested sprite to the adapter in the UI thread."""
+
+class RequestedSprite(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"request": SpriteRequest}
+    
+    @args(void, [SpriteRequest])
+    def __init__(self, request):
+    
+        Object.__init__(self)
+        self.request = request
+    
+    def run(self):
+    
+        self.request.adapter.requestFinished(self.request)
+
+
+"""This class passes a sprite read by a `StreamLoader` to the adapter in the
+main UI thread."""
+
+class LoadedSprite(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"adapter": SpriteAdapter, "loader": StreamLoader,
+                  "name": String, "bitmap": Bitmap}
+    
+    @args(void, [SpriteAdapter, StreamLoader, String, Bitmap])
+    def __init__(self, adapter, loader, name, bitmap):
+    
+        Object.__init__(self)
+        self.adapter = adapter
+        self.loader = loader
+        self.name = name
+        self.bitmap = bitmap
+    
+    def run(self):
+    
+        self.adapter.spriteLoaded(self.loader, self.name, self.bitmap)
+
+
+"""The following class renders the previews of all the sprites in a file at a
+given size in a low priority background thread, keeping them in the adapter's
+`ThumbnailStore`. Sprites are visited in order, starting at a given position
+and wrapping around to the start of the file, and sprites whose previews are
+already stored are skipped. Each sprite is decoded without being kept by the
+spritefile, so the amount of memory used does not grow with the size of the
+file.
+
+The adapter stops the prerenderer by setting its `cancelled` flag, which is
+checked before and after each sprite is decoded. Since prerenderers are often
+stopped before they finish, the store is trimmed when each one starts and
+after every few previews it saves, as well as when it finishes. A prerenderer
+that finishes without being stopped tells the adapter in the main UI thread."""
+
+class Prerenderer(Thread):
+
+    __fields__ = {
+        "adapter": SpriteAdapter,
+        "opened": OpenFile,
+        "names": List(String),
+        "store": ThumbnailStore,
+        "pool": BitmapPool,
+        "size": int,
+        "start_position": int,
+        "cancelled": AtomicBoolean
+        }
+    
+    # The number of previews saved between each trim of the store.
+    trim_interval = 16
+    
+    @args(void, [SpriteAdapter, OpenFile, int, int])
+    def __init__(self, adapter, opened, size, start_position):
+    
+        Thread.__init__(self)
+        
+        self.adapter = adapter
+        self.opened = opened
+        self.names = ArrayList(opened.items)
+        self.store = adapter.store
+        self.pool = adapter.getPool(size)
+        self.size = size
+        self.start_position = start_position
+        self.cancelled = AtomicBoolean(False)
+        
+        # Threads used to decode bands of large sprites inherit this priority.
+        self.setPriority(Thread.MIN_PRIORITY)
+    
+    def run(self):
+    
+        folder = self.opened.folder
+        self.store.scan(folder)
+        self.store.trim(folder)
+        
+        paint = Paint()
+        paint.setXfermode(PorterDuffXfermode(PorterDuff.Mode.SRC_OVER))
+        
+        count = len(self.names)
+        saved = 0
+        
+        for i in range(count):
+        
+            if self.cancelled.get():
+                return
+            
+            name = self.names[(self.start_position + i) % count]
+            if self.store.contains(folder, self.size, name):
+                continue
+            
+            try:
+                sprite = self.opened.spritefile.decodeCopy(name)
+                if self.cancelled.get():
+                    return
+                
+                preview = SpriteRenderer.drawPreview(
+                    SpriteRenderer.spriteBitmap(sprite), self.pool.acquire(),
+                    paint)
+                self.store.save(folder, self.size, name, preview)
+                self.pool.release(preview)
+                
+                saved += 1
+                if saved % self.trim_interval == 0:
+                    self.store.trim(folder)
+            except:
+                # Sprites that cannot be decoded are reported when they are
+                # rendered for a view.
+                pass
+        
+        self.store.trim(folder)
+        self.adapter.environment.postDelayed(PrerenderFinished(self), long(0))
+
+
+"""This class tells the adapter in the main UI thread that a prerenderer has
+finished."""
+
+class PrerenderFinished(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"prerenderer": Prerenderer}
+    
+    @args(void, [Prerenderer])
+    def __init__(self, prerenderer):
+    
+        Object.__init__(self)
+        self.prerenderer = prerenderer
+    
+    def run(self):
+    
+        self.prerenderer.adapter.prerenderFinished(self.prerenderer)
 
 
 """The following class provides a `View` that encapsulates both the adapter
 that supplies rendered sprites and a grid in which to display them. It also
-exposes information about sprites held by an adapter to other components."""
+exposes information about sprites held by an adapter to other components.
 
-class SpriteBrowser(LinearLayout):
+The browser can also show an overlay on top of the grid that reports the state
+of the adapter's rendering queue and cache, updating it periodically while it
+is visible. The class implements the `Runnable` interface so that it can
+schedule these updates.
 
-    __fields__ = {"bitmap": Bitmap}
+Pinching the grid changes the size of the previews, and the number of columns
+with it. Touch events are examined before they reach the grid so that a pinch
+can be recognised without interfering with scrolling."""
+
+class SpriteBrowser(FrameLayout):
+
+    __interfaces__ = [Runnable, ScaleGestureDetector.OnScaleGestureListener]
+    
+    __fields__ = {"bitmap": Bitmap, "overlay": TextView,
+                  "overlay_visible": bool, "was_profiling": bool,
+                  "scaler": ScaleGestureDetector, "zoom": float}
+    
+    # The interval between overlay updates in milliseconds.
+    overlay_interval = 500
+    
+    # The factor by which a pinch must enlarge or shrink the grid before the
+    # preview size changes.
+    zoom_step = 1.5
     
     @args(void, [Context])
     def __init__(self, context):
     
-        LinearLayout.__init__(self, context)
+        FrameLayout.__init__(self, context)
         
+        self.handler = Handler()
         self.spriteAdapter = SpriteAdapter()
         
+        # Previews of whole files and indexes written by the application are
+        # kept in its cache directory.
+        self.spriteAdapter.setStore(ThumbnailStore(
+            File(context.getCacheDir(), "thumbnails")))
+        self.spriteAdapter.setIndexDirectory(
+            File(context.getCacheDir(), "indexes"))
+        
         self.grid = GridView(context)
         self.grid.setHorizontalSpacing(8)
         self.grid.setVerticalSpacing(8)
         self.grid.setNumColumns(3)
         self.grid.setAdapter(self.spriteAdapter)
+        self.grid.setRecyclerListener(self.spriteAdapter)
         self.addView(self.grid)
+        
+        # The overlay is placed in the top-right corner of the frame, above the
+        # grid, so it does not affect the layout of the grid.
+        self.overlay = TextView(context)
+        self.overlay.setBackgroundColor(Color.argb(160, 0, 0, 0))
+        self.overlay.setTextColor(Color.WHITE)
+        self.overlay.setTypeface(Typeface.MONOSPACE)
+        self.overlay.setPadding(8, 8, 8, 8)
+        self.overlay.setVisibility(View.GONE)
+        self.addView(self.overlay, FrameLayout.LayoutParams(
+            ViewGroup.LayoutParams.WRAP_CONTENT,
+            ViewGroup.LayoutParams.WRAP_CONTENT,
+            Gravity.TOP | Gravity.RIGHT))
+        
+        self.overlay_visible = False
+        self.was_profiling = False
+        
+        self.scaler = ScaleGestureDetector(context, self)
+        self.zoom = 1.0
     
     @args(GridView, [])
     def getGrid(self):
     
         return self.grid
     
-    """The following two methods return the bitmap or name of a sprite at a
-    given position in the grid view."""
+    """The following method returns the profiler used to measure the time spent
+    reading and rendering sprites."""
+    
+    @args(Profiler, [])
+    def getProfiler(self):
+    
+        return self.spriteAdapter.profiler
+    
+    """The following method shows or hides the performance overlay. The overlay
+    relies on measurements made by the profiler, so we enable it while the
+    overlay is visible, restoring its previous state afterwards."""
+    
+    @args(void, [bool])
+    def setOverlayVisible(self, visible):
+    
+        if visible == self.overlay_visible:
+            return
+        
+        self.overlay_visible = visible
+        profiler = self.getProfiler()
+        
+        if visible:
+            self.was_profiling = profiler.enabled
+            profiler.setEnabled(True)
+            self.overlay.setVisibility(View.VISIBLE)
+            self.run()
+        else:
+            profiler.setEnabled(self.was_profiling)
+            self.overlay.setVisibility(View.GONE)
+            self.handler.removeCallbacks(self)
+    
+    @args(bool, [])
+    def isOverlayVisible(self):
+    
+        return self.overlay_visible
+    
+    """This method is called periodically while the overlay is visible to
+    update its contents with the render queue depth, number of renders in
+    progress, cache size and hit rate, and render latency percentiles."""
+    
+    def run(self):
+    
+        if not self.overlay_visible:
+            return
+        
+        adapter = self.spriteAdapter
+        profiler = adapter.profiler
+        
+        hits = profiler.getCount(Profiler.CACHE_HITS)
+        total = hits + profiler.getCount(Profiler.CACHE_MISSES)
+        if total > long(0):
+            hit_rate = (hits * long(100)) / total
+        else:
+            hit_rate = long(0)
+        
+        kilobytes = adapter.getCacheBytes() / long(1024)
+        p50 = profiler.percentile(50) / long(1000000)
+        p95 = profiler.percentile(95) / long(1000000)
+        
+        text = "queue " + String.valueOf(adapter.getQueueLength()) + \
+               ", rendering " + String.valueOf(adapter.getInFlight()) + \
+               "\ncache " + String.valueOf(adapter.getCacheEntries()) + \
+               " entries, " + String.valueOf(kilobytes) + " KB\n" + \
+               "hit rate " + String.valueOf(hit_rate) + "%\n" + \
+               "latency p50 " + String.valueOf(p50) + " ms, p95 " + \
+               String.valueOf(p95) + " ms"
+        
+        self.overlay.setText(text)
+        self.handler.postDelayed(self, long(self.overlay_interval))
+    
+    """The following methods return the bitmap, decoded sprite or name of a
+    sprite at a given position in the grid view."""
     
     @args(Bitmap, [int])
     def getSpriteBitmap(self, position):
     
         return self.spriteAdapter.getSpriteBitmap(position)
     
+    @args(Sprite, [int])
+    def getSprite(self, position):
+    
+        return self.spriteAdapter.getSprite(position)
+    
     @args(String, [int])
     def getSpriteName(self, position):
     
         return self.spriteAdapter.getSpriteName(position)
     
-    """The following method returns the name of the spritefile that is
-    currently open in the browser."""
+    """This method decodes the sprite at a given position in the background,
+    ahead of any previews waiting to be rendered, and passes it to the given
+    listener when it is ready."""
+    
+    @args(void, [int, SpriteListener])
+    def requestSprite(self, position, listener):
+    
+        self.spriteAdapter.requestSprite(position, listener)
+    
+    """This method scrolls the grid to show the sprite with the given name if
+    it is in the file currently open in the browser."""
+    
+    @args(void, [String])
+    def showSprite(self, name):
+    
+        position = self.spriteAdapter.items.indexOf(name)
+        if position != -1:
+            self.grid.setSelection(position)
+    
+    """The following methods return the name of the spritefile that is
+    currently open in the browser and the path or URI it was opened from."""
     
     @args(String, [])
     def getSpriteFileName(self):
     
-        return self.spriteAdapter.spritefile.file.getName()
+        return self.spriteAdapter.getFileName()
+    
+    @args(String, [])
+    def getSpriteSource(self):
+    
+        return self.spriteAdapter.getSource()
     
     """This method ensures that the view displays a reasonable number of
     columns in the grid when it is first shown."""
     
     def onSizeChanged(self, width, height, oldWidth, oldHeight):
     
-        self.grid.setNumColumns(width/SpriteAdapter.preview_size)
+        size = self.spriteAdapter.getPreviewSize()
+        self.grid.setNumColumns(Math.max(1, width/size))
     
     """This method is used to help the view adapt to configuration changes
     due to reorientation of the device running the application. It simply
@@ -435,7 +2080,56 @@ class SpriteBrowser(LinearLayout):
     @args(void, [int])
     def updateLayout(self, screenWidthDp):
     
-        self.grid.setNumColumns(screenWidthDp/SpriteAdapter.preview_size)
+        size = self.spriteAdapter.getPreviewSize()
+        self.grid.setNumColumns(Math.max(1, screenWidthDp/size))
+    
+    """Touch events are passed to the pinch detector before the grid receives
+    them. Once a pinch has started, the remaining events of the gesture are
+    intercepted so that the grid does not scroll."""
+    
+    def onInterceptTouchEvent(self, event):
+    
+        self.scaler.onTouchEvent(event)
+        return self.scaler.isInProgress()
+    
+    def onTouchEvent(self, event):
+    
+        self.scaler.onTouchEvent(event)
+        return True
+    
+    """The following method accumulates the scale factor of a pinch, changing
+    the preview size each time it passes the zoom step. The number of columns
+    is updated to fit the new size."""
+    
+    @args(bool, [ScaleGestureDetector])
+    def onScale(self, detector):
+    
+        self.zoom *= detector.getScaleFactor()
+        
+        if self.zoom >= self.zoom_step:
+            step = 1
+        elif self.zoom <= 1.0/self.zoom_step:
+            step = -1
+        else:
+            return True
+        
+        self.zoom = 1.0
+        
+        if self.spriteAdapter.stepPreviewSize(step):
+            self.grid.setNumColumns(Math.max(1,
+                self.getWidth()/self.spriteAdapter.getPreviewSize()))
+        
+        return True
+    
+    @args(bool, [ScaleGestureDetector])
+    def onScaleBegin(self, detector):
+    
+        self.zoom = 1.0
+        return True
+    
+    @args(void, [ScaleGestureDetector])
+    def onScaleEnd(self, detector):
+        pass
     
     """The main activity calls this method to tell the browser to display the
     contents of the given file. We simply update the adapter to use the new
@@ -446,3 +2140,26 @@ class SpriteBrowser(LinearLayout):
     
         self.spriteAdapter.setFile(file)
         self.grid.setAdapter(self.spriteAdapter)
+    
+    """This method is called to display the contents of a spritefile obtained
+    from a content URI, such as one supplied by another application."""
+    
+    @args(void, [Uri])
+    def openUri(self, uri):
+    
+        self.spriteAdapter.setUri(self.getContext().getContentResolver(), uri)
+        self.grid.setAdapter(self.spriteAdapter)
+    
+    """The main activity calls the following methods when it leaves and enters
+    the foreground so that previews are only rendered in the background while
+    the user can see the application."""
+    
+    @args(void, [])
+    def pause(self):
+    
+        self.spriteAdapter.setForeground(False)
+    
+    @args(void, [])
+    def resume(self):
+    
+        self.spriteAdapter.setForeground(True)
@@ -17,10 +17,16 @@
 
 We import the classes necessary to read, decode and store sprite data."""
 
-from java.io import File, IOException, RandomAccessFile
-from java.lang import Exception, Object, String
+from java.io import File, InputStream, IOException, RandomAccessFile
+from java.lang import Exception, Math, Object, Runtime, String, System, \
+                      Thread
+from java.math import BigInteger
 from java.nio import ByteBuffer, ByteOrder
+from java.security import MessageDigest
 from java.util import List, Map
+from java.util.concurrent import ConcurrentHashMap, Semaphore
+
+from profiling import Profiler
 
 """We define a custom exception to report problems with spritefiles."""
 
@@ -35,13 +41,18 @@ class SpritefileError(Exception):
 
 """The following class represents a sprite and contains all the relevant
 information required to display and modify it. It also defines a `decoded`
-field that indicates whether the sprite has been decoded."""
+field that indicates whether the sprite has been decoded and, once it has been
+read, a hash of its contents that is shared by identical sprites. The number
+of bytes the sprite occupies in its file is recorded when its name is read, and
+the estimated cost of decoding the sprite is recorded once it has been
+estimated."""
 
 class Sprite(Object):
 
     __fields__ = {
         "name": String,
         "decoded": bool, "offset": int,
+        "image_ptr": int, "mask_ptr": int,
         "h_words": int, "v_lines": int,
         "first_bit": int, "last_bit": int,
         "bpp": int, "log2bpp": int,
@@ -49,13 +60,19 @@ class Sprite(Object):
         "width": int, "height": int,
         "mode": String,
         "palette": Palette,
-        "rgba": [byte]
+        "rgba": [byte],
+        "hash": String,
+        "mode_word": int,
+        "record_size": int,
+        "cost": long
         }
     
     def __init__(self):
     
         Object.__init__(self)
         self.decoded = False
+        self.hash = None
+        self.cost = long(0)
 
 """The following class represents a palette that can be associated with a
 sprite. Instances of this class are initially populated when their
@@ -106,25 +123,153 @@ class PaletteEntry(Object):
         self.primary = primary
         self.secondary = secondary
 
+"""The following class holds the information in the header at the start of a
+spritefile: the number of sprites, and the offsets of the first sprite and of
+the free space after the last sprite within the file. It is used to quickly
+check whether a file is likely to be a spritefile without reading the rest of
+it."""
+
+class SpritefileHeader(Object):
+
+    __fields__ = {"number": int, "offset": int, "free": int, "length": long}
+    
+    # The smallest possible size of a sprite header.
+    SPRITE_HEADER = 44
+    
+    @args(void, [int, int, int, long])
+    def __init__(self, number, offset, free, length):
+    
+        Object.__init__(self)
+        self.number = number
+        self.offset = offset
+        self.free = free
+        self.length = length
+    
+    """This method reads the header of the given file, returning `None` if the
+    file cannot be read or the header is inconsistent with the length of the
+    file. As in the `Spritefile.read` method, the offsets are adjusted to
+    account for the word that precedes the header in memory but is not stored
+    in files."""
+    
+    @static
+    @args(SpritefileHeader, [File])
+    def read(file):
+    
+        length = file.length()
+        if length < long(12):
+            return None
+        
+        buf = ByteBuffer.allocate(12)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        
+        try:
+            f = RandomAccessFile(file, "r")
+        except IOException:
+            return None
+        
+        # Close the file whether or not the header can be read.
+        try:
+            f.readFully(buf.array())
+        except IOException:
+            f.close()
+            return None
+        
+        f.close()
+        
+        number = buf.getInt()
+        offset = buf.getInt() - 4
+        free = buf.getInt() - 4
+        
+        if number < 0 or offset < 12 or free < offset or long(free) > length:
+            return None
+        
+        # Each sprite needs at least a complete header.
+        if (free - offset) / SpritefileHeader.SPRITE_HEADER < number:
+            return None
+        
+        if number == 0 and free != offset:
+            return None
+        
+        return SpritefileHeader(number, offset, free, length)
+
+
 """The following class represents a spritefile that can contain zero or more
 sprites. The class can either be instantiated with a `File`, in which case the
 contents of that file will be read and decoded, or without. The contents of a
 file can later be read into a `Spritefile` object by calling its `read` method,
-replacing its existing contents."""
+replacing its existing contents.
+
+Spritefiles often contain identical sprites with different names. Decoded
+pixels are kept in a table keyed by a hash of the data that describes each
+sprite, so that each distinct sprite is only decoded once. A sprite requested
+by one thread while another thread is decoding it is not decoded a second time;
+the second thread waits for the first to finish instead.
+
+Each instance uses a `Profiler` object to record the time spent in each phase
+of reading and decoding sprites. Unless a profiler is passed to the
+constructor, a disabled one is used."""
 
 class Spritefile(Object):
 
     __fields__ = {
         "file": File,
-        "sprites": Map(String, Sprite)
+        "sprites": Map(String, Sprite),
+        "profiler": Profiler,
+        "pixels": ConcurrentHashMap(String, [byte]),
+        "decoding": ConcurrentHashMap(String, Semaphore)
         }
     
+    # The following tables describe the sprite formats. They are shared by all
+    # instances instead of being created for each spritefile.
+    
+    # The number of bits per pixel, as a power of two, and the horizontal and
+    # vertical resolutions in dots per inch for each of the old screen modes.
+    # Old modes have a maximum of 90 dots per inch, except for mode 22 which
+    # has twice the horizontal resolution.
+    mode_log2bpp = [
+        0, 1, 2, 1, 0, 1, 1, 2, 1, 2,
+        3, 1, 2, 3, 2, 3, 2, 2, 0, 1,
+        2, 3, 2, 0, 3, 0, 1, 2, 3, 0,
+        1, 2, 3, 0, 1, 2, 3, 0, 1, 2,
+        3, 0, 1, 2, 0, 1, 2, 3, 2, 3
+        ]
+    mode_xdpi = [
+        90, 45, 30, 90, 45, 30, 45, 45, 90, 45,
+        30, 90, 90, 45, 90, 90, 90, 90, 90, 90,
+        90, 90, 180, 90, 90, 90, 90, 90, 90, 90,
+        90, 90, 90, 90, 90, 90, 90, 90, 90, 90,
+        90, 90, 90, 90, 90, 90, 90, 45, 45, 45
+        ]
+    mode_ydpi = [
+        45, 45, 45, 45, 45, 45, 45, 45, 45, 45,
+        45, 45, 45, 45, 45, 45, 45, 45, 90, 90,
+        90, 90, 90, 90, 45, 90, 90, 90, 90, 90,
+        90, 90, 90, 45, 45, 45, 45, 45, 45, 45,
+        45, 45, 45, 45, 45, 45, 45, 45, 90, 90
+        ]
+    
+    # The number of bits per pixel and its logarithm for each sprite type used
+    # by new format sprites. Type 0 is used for sprites in old screen modes.
+    type_bpp = [0, 1, 2, 4, 8, 16, 32, 32]
+    type_log2bpp = [0, 0, 1, 2, 3, 4, 5, 5]
+    
+    # The standard 16 desktop colours and the greyscales used by sprites with
+    # 4 and 2 bits per pixel that have no palette, as 0xRRGGBB values.
+    palette16 = [
+        0xffffff, 0xdddddd, 0xbbbbbb, 0x999999,
+        0x777777, 0x555555, 0x333333, 0x000000,
+        0x004499, 0xeeee00, 0x00cc00, 0xdd0000,
+        0xeeeebb, 0x558800, 0xffbb00, 0x00bbff
+        ]
+    palette4 = [0xffffff, 0xbbbbbb, 0x777777, 0x000000]
+    
     @args(void, [])
     def __init__(self):
     
         Object.__init__(self)
         
         self.file = None
+        self.profiler = Profiler()
         self.init()
     
     @args(void, [File])
@@ -133,11 +278,25 @@ class Spritefile(Object):
         Object.__init__(self)
         
         self.file = file
+        self.profiler = Profiler()
+        self.init()
+        self.read(file)
+    
+    @args(void, [File, Profiler])
+    def __init__(self, file, profiler):
+    
+        Object.__init__(self)
+        
+        self.file = file
+        self.profiler = profiler
         self.init()
         self.read(file)
     
     def init(self):
     
+        self.pixels = ConcurrentHashMap()
+        self.decoding = ConcurrentHashMap()
+        
         # Define scaling factors for 8 bits per pixel and 16 bits per pixel colour.
         self.scale8  = 255.0/15.0
         self.scale16 = 255.0/31.0
@@ -145,136 +304,144 @@ class Spritefile(Object):
         # Constants
         self.HEADER = 60
         
-        # Mode information dictionary (log2bpp, x scale, y scale)
-        self.mode_info = {
-            0: (0, 1, 2), 1: (1, 2, 2), 2: (2, 3, 2), 3: (1, 1, 2),
-            4: (0, 2, 2), 5: (1, 3, 2), 6: (1, 2, 2), 7: (2, 2, 2),
-            8: (1, 1, 2), 9: (2, 2, 2), 10: (3, 3, 2), 11: (1, 1, 2),
-            12: (2, 1, 2), 13: (3, 2, 2), 14: (2, 1, 2), 15: (3, 1, 2),
-            16: (2, 1, 2), 17: (2, 1, 2), 18: (0, 1, 1), 19: (1, 1, 1),
-            20: (2, 1, 1), 21: (3, 1, 1), 22: (2, 0, 1), 23: (0, 1, 1),
-            24: (3, 1, 2), 25: (0, 1, 1), 26: (1, 1, 1), 27: (2, 1, 1),
-            28: (3, 1, 1), 29: (0, 1, 1), 30: (1, 1, 1), 31: (2, 1, 1),
-            32: (3, 1, 1), 33: (0, 1, 2), 34: (1, 1, 2), 35: (2, 1, 2),
-            36: (3, 1, 2), 37: (0, 1, 2), 38: (1, 1, 2), 39: (2, 1, 2),
-            40: (3, 1, 2), 41: (0, 1, 2), 42: (1, 1, 2), 43: (2, 1, 2),
-            44: (0, 1, 2), 45: (1, 1, 2), 46: (2, 1, 2), 47: (3, 2, 2),
-            48: (2, 2, 1), 49: (3, 2, 1)
-            }
-        
-        self.palette16 = [
-            (0xff, 0xff, 0xff), (0xdd, 0xdd, 0xdd),
-            (0xbb, 0xbb, 0xbb), (0x99, 0x99, 0x99),
-            (0x77, 0x77, 0x77), (0x55, 0x55, 0x55),
-            (0x33, 0x33, 0x33), (0x00, 0x00, 0x00),
-            (0x00, 0x44, 0x99), (0xee, 0xee, 0x00),
-            (0x00, 0xcc, 0x00), (0xdd, 0x00, 0x00),
-            (0xee, 0xee, 0xbb), (0x55, 0x88, 0x00),
-            (0xff, 0xbb, 0x00), (0x00, 0xbb, 0xff)
-            ]
-        
-        self.palette4 = [
-            (0xff, 0xff, 0xff), (0xbb, 0xbb, 0xbb),
-            (0x77, 0x77, 0x77), (0x00, 0x00, 0x00)
-            ]
-        
-        self.bit_depths = {
-            1: (1, 0), 2: (2, 1), 3: (4, 2), 4: (8, 3),
-            5: (16, 4), 6: (32, 5), 7: (32, 5)
-            }
-    
-    def new(self):
-    
-        self.sprites = {}
-    
-    @args(int, [int, RandomAccessFile])
-    def str2num(self, size, f):
-    
-        i = 0
-        n = 0
-        
-        buf = ByteBuffer.allocate(4)
-        buf.order(ByteOrder.LITTLE_ENDIAN)
+        # Sprites with at least this number of pixels are decoded in bands
+        # using several threads.
+        self.BAND_THRESHOLD = 512 * 1024
         
-        read = 0
-        while read < size:
-            r = f.read(buf.array(), read, size - read)
-            if r == -1:
-                raise IOException()
-            read += r
+        # Sprites with more than this number of pixels are not decoded, and
+        # palettes are limited to the largest number of entries that can be
+        # used.
+        self.MAX_PIXELS = 16 * 1024 * 1024
+        self.MAX_PALETTE = 256
         
-        while read < 4:
-            buf.put(read, byte(0))
-            read += 1
+        # The number of bytes read for the header and palette of a sprite in
+        # a file, enough for the largest palette.
+        self.HEADER_BLOCK = 44 + (self.MAX_PALETTE * 8)
         
-        return buf.getInt()
+        self.decode_threads = Runtime.getRuntime().availableProcessors()
     
-    @args(int, [RandomAccessFile])
-    def read_byte(self, f):
+    def new(self):
     
-        v = int(f.read())
-        if v < 0: v += 256
-        return v
+        self.sprites = {}
     
     @args(int, [RandomAccessFile, int])
     def read_name(self, f, offset):
     
-        # Go to the start of this sprite.
+        start = self.profiler.begin(Profiler.READ_NAME)
+        
+        # Go to the start of this sprite and read the offset of the next
+        # sprite and the name of this one.
         f.seek(offset)
+        self.profiler.count(Profiler.SEEKS, long(1))
         
-        next = self.str2num(4, f)
+        data = array(byte, 16)
+        f.readFully(data)
+        self.profiler.count(Profiler.BYTES_READ, long(16))
         
-        name = array(byte, 12)
-        f.read(name)
+        buf = ByteBuffer.wrap(data)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        next = buf.getInt(0)
         
-        for i in range(12):
-            if name[i] == 0:
-                name = name[:i]
-                break
+        length = 0
+        while length < 12 and data[4 + length] != 0:
+            length += 1
         
         sprite = Sprite()
-        sprite.name = String(name, "ASCII")
+        sprite.name = String(data, 4, length, "ASCII")
         sprite.offset = offset
+        sprite.record_size = next
         
         self.sprites[sprite.name] = sprite
         
+        self.profiler.end(Profiler.READ_NAME, start)
+        
         return next
     
+    """The following method reads the header and palette of a sprite, then
+    decodes its image and mask data into RGBA form."""
+    
     @args(void, [RandomAccessFile, Sprite])
     def read_details(self, f, sprite):
     
+        self.read_header(f, sprite)
+        self.decode(f, sprite)
+    
+    """This method reads the header and palette of a sprite without decoding
+    its pixels, recording the locations of its image and mask data in the
+    sprite. The header and the largest possible palette are read in a single
+    operation and decoded from memory, so the cost of reading a header does not
+    depend on the number of fields or palette entries it contains."""
+    
+    @args(void, [RandomAccessFile, Sprite])
+    def read_header(self, f, sprite):
+    
+        start = self.profiler.begin(Profiler.READ_DETAILS)
+        
+        length = f.length()
+        size = int(Math.min(long(self.HEADER_BLOCK),
+                            length - long(sprite.offset)))
+        if size < 44:
+            raise SpritefileError('Incomplete sprite header.')
+        
         # Go to the start of this sprite.
-        offset = sprite.offset
-        f.seek(offset)
+        f.seek(sprite.offset)
+        self.profiler.count(Profiler.SEEKS, long(1))
         
-        # Skip the next offset and name.
-        f.skipBytes(16)
+        data = array(byte, size)
+        f.readFully(data)
+        self.profiler.count(Profiler.BYTES_READ, long(size))
         
-        # Read width of sprite in words and height in scan lines.
-        # These are stored in the Spritefile as width-1 and height-1.
-        h_words = self.str2num(4, f) + 1
-        v_lines = self.str2num(4, f) + 1
-
-        sprite.h_words = h_words
-        sprite.v_lines = v_lines
+        self.parse_fields(sprite, data, length)
         
-        # The bits used in each word.
-        first_bit_used = self.str2num(4, f)
-        last_bit_used   = self.str2num(4, f)
-
-        sprite.first_bit = first_bit_used
-        sprite.last_bit = last_bit_used
+        self.profiler.end(Profiler.READ_DETAILS, start)
+    
+    """The following method checks that the values read from the header of a
+    sprite describe data that can be decoded, before any memory is allocated
+    for it. The image and mask must start after the header and within the
+    given length of the file or stream, and neither can be larger than the file
+    itself, though data missing from the end of a truncated file is tolerated.
+    The number of pixels, including those added when the sprite is stretched to
+    correct its aspect ratio, is also limited so that a corrupt header cannot
+    cause an enormous array to be allocated."""
+    
+    @args(void, [Sprite, long])
+    def validate(self, sprite, length):
+    
+        if sprite.h_words < 1 or sprite.v_lines < 1 or \
+           sprite.first_bit < 0 or sprite.first_bit > 31 or \
+           sprite.last_bit < 0 or sprite.last_bit > 31 or sprite.width < 1:
+            raise SpritefileError('Invalid sprite dimensions.')
+        
+        stretch = 1
+        if 0 < sprite.ydpi < sprite.xdpi:
+            stretch = sprite.xdpi / sprite.ydpi
         
-        # The pointers to the image and mask are found from the offsets
-        # relative to the start of the sprite; i.e. from the next sprite
-        # offset.
-        image_ptr = offset + self.str2num(4, f)
-        mask_ptr  = offset + self.str2num(4, f)
+        if long(sprite.width) * long(sprite.height) * long(stretch) > \
+           long(self.MAX_PIXELS):
+            raise SpritefileError('Sprite too large.')
         
-        # The mode number of the sprite.
-        mode = self.str2num(4, f)
+        header_end = long(sprite.offset) + long(44)
+        image_size = long(sprite.h_words) * long(4) * long(sprite.v_lines)
         
-        bpp = (mode >> 27)
+        if long(sprite.image_ptr) < header_end or \
+           long(sprite.image_ptr) > length or image_size > length:
+            raise SpritefileError('Invalid image offset or size.')
+        
+        if sprite.mask_ptr != sprite.image_ptr:
+            mask_size = long(self.mask_row_words(sprite)) * long(4) * \
+                        long(sprite.height)
+            if long(sprite.mask_ptr) < header_end or \
+               long(sprite.mask_ptr) > length or mask_size > length:
+                raise SpritefileError('Invalid mask offset or size.')
+    
+    """The following method decodes the mode word of a sprite, recording its
+    colour depth, resolution and the form its decoded pixels will take."""
+    
+    @args(void, [Sprite, int])
+    def set_mode(self, sprite, mode):
+    
+        # The sprite type is held in the top five bits of the mode word.
+        bpp = (mode >> 27) & 0x1f
         log2bpp = xdpi = ydpi = 0
         
         if bpp == 0:
@@ -282,29 +449,28 @@ class Spritefile(Object):
             mode = mode & 0x3f
             
             # Information on commonly used modes
-            try:
-                log2bpp, xscale, yscale = self.mode_info[mode]
-                # Old modes have a maximum of 90 dots per inch.
-                xdpi = int(90/xscale)
-                ydpi = int(90/yscale)
-                bpp = 1 << log2bpp
-                
-                # Sprites for old screen modes are all converted to RGB format.
-                sprite.mode = 'RGB'
-            
-            except KeyError:
+            if mode >= len(self.mode_log2bpp):
                 raise SpritefileError('Unknown mode number.')
+            
+            log2bpp = self.mode_log2bpp[mode]
+            xdpi = self.mode_xdpi[mode]
+            ydpi = self.mode_ydpi[mode]
+            bpp = 1 << log2bpp
+            
+            # Sprites for old screen modes are all converted to RGB format.
+            sprite.mode = 'RGB'
         else:
             if bpp < 7:
                 sprite.mode = 'RGB'
             else:
                 sprite.mode = 'CMYK'
             
-            try:
-                bpp, log2bpp = self.bit_depths[bpp]
-            except:
+            if bpp >= len(self.type_bpp):
                 raise SpritefileError('Unknown number of bits per pixel.')
             
+            log2bpp = self.type_log2bpp[bpp]
+            bpp = self.type_bpp[bpp]
+            
             xdpi = ((mode >> 1) & 0x1fff)
             ydpi = ((mode >> 14) & 0x1fff)
         
@@ -312,28 +478,14 @@ class Spritefile(Object):
         sprite.log2bpp = log2bpp
         sprite.xdpi = xdpi
         sprite.ydpi = ydpi
-        
-        has_palette = False
-        
-        palette = Palette()
-        
-        # Read palette, if present, putting the values into a list
-        while f.getFilePointer() < image_ptr:
-        
-            f.skipBytes(1)
-            # First entry (red, green, blue)
-            entry1 = [self.read_byte(f),
-                      self.read_byte(f),
-                      self.read_byte(f)]
-            
-            f.skipBytes(1)
-            # Second entry (red, green, blue)
-            entry2 = [self.read_byte(f),
-                      self.read_byte(f),
-                      self.read_byte(f)]
-            
-            palette.add(PaletteEntry(entry1, entry2))
-        
+    
+    """This method expands a palette read from a sprite with 8 bits per pixel
+    and fewer than 256 palette entries to a full 256 colour palette, returning
+    the palette or `None` if it has no entries."""
+    
+    @args(Palette, [Palette, int])
+    def expand_palette(self, palette, bpp):
+    
         if palette.hasEntries():
         
             if bpp == 8 and len(palette) < 256:
@@ -389,98 +541,660 @@ class Spritefile(Object):
                                                  [red, green, blue])
                             palette.add(entry)
             
-            sprite.palette = palette
+            return palette
         else:
-            sprite.palette = None
-        
+            return None
+    
+    """We calculate the dimensions of a sprite in pixels from the information
+    in its header."""
+    
+    @args(void, [Sprite])
+    def set_size(self, sprite):
+    
+        sprite.width = self.row_width(sprite)
+        sprite.height = sprite.v_lines
+    
+    """This method returns the number of pixels in each row of a sprite, found
+    from the layout of its rows in memory."""
+    
+    @args(int, [Sprite])
+    def row_width(self, sprite):
+    
         # The width of the sprite is the number of words used divided by the
         # bits per pixel of the sprite. Additionally, the parts of the sprite
         # unused at the ends are subtracted.
-        width = (h_words * (32 >> sprite.log2bpp)) - \
-                (first_bit_used >> sprite.log2bpp) - \
-                ((31-last_bit_used) >> sprite.log2bpp)
-        height = v_lines
+        return (sprite.h_words * (32 >> sprite.log2bpp)) - \
+               (sprite.first_bit >> sprite.log2bpp) - \
+               ((31 - sprite.last_bit) >> sprite.log2bpp)
+    
+    """The following method estimates the cost of decoding a sprite whose
+    header has been read and drawing a preview of it, in units roughly
+    equivalent to reading one byte. The image and mask are read in full, each
+    pixel is converted, using a palette unless it has 16 or 32 bits, and
+    combined with its mask value, then each pixel is drawn."""
+    
+    @args(long, [Sprite])
+    def decode_cost(self, sprite):
+    
+        pixels = long(sprite.width) * long(sprite.height)
+        cost = long(sprite.h_words) * long(sprite.v_lines) * long(4)
         
-        sprite.width = width
-        sprite.height = height
+        if sprite.bpp >= 16:
+            cost += pixels * long(3)
+        else:
+            cost += pixels * long(2)
         
-        # Obtain image data
-        f.seek(image_ptr)
+        if sprite.mask_ptr != sprite.image_ptr:
+            cost += long(self.mask_row_words(sprite)) * long(sprite.height) * \
+                    long(4)
+            cost += pixels
+        
+        return cost
+    
+    """The following method reads the header and palette of a sprite from an
+    array containing all of its data, as read from a stream, instead of from a
+    file. The offsets recorded in the sprite are relative to the position of
+    the sprite in the stream given by its `offset` field."""
+    
+    @args(void, [Sprite, [byte]])
+    def parse_header(self, sprite, data):
+    
+        start = self.profiler.begin(Profiler.READ_DETAILS)
+        self.parse_fields(sprite, data, long(sprite.offset) + long(len(data)))
+        self.profiler.end(Profiler.READ_DETAILS, start)
+    
+    """This method decodes the header and palette of a sprite from an array
+    that starts at the beginning of the sprite, using a single little-endian
+    view of the array. The palette is read from the part of the array before
+    the image data. The length of the file or stream containing the sprite is
+    used to check the offsets found in the header."""
+    
+    @args(void, [Sprite, [byte], long])
+    def parse_fields(self, sprite, data, length):
+    
+        buf = ByteBuffer.wrap(data)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        
+        # The width of the sprite in words and its height in scan lines are
+        # stored as width-1 and height-1, followed by the bits used in the
+        # first and last words of each row.
+        sprite.h_words = buf.getInt(16) + 1
+        sprite.v_lines = buf.getInt(20) + 1
+        sprite.first_bit = buf.getInt(24)
+        sprite.last_bit = buf.getInt(28)
         
-        if sprite.mode == 'RGB':
-            self.sprite2rgb(f, sprite)
+        # The image and mask are found using offsets from the start of the
+        # sprite.
+        image_start = buf.getInt(32)
+        mask_start = buf.getInt(36)
         
-        elif sprite.mode == 'CMYK':
-            self.sprite2cmyk(f, sprite)
+        if image_start < 44 or mask_start < 44:
+            raise SpritefileError('Invalid image or mask offset.')
+        
+        sprite.image_ptr = sprite.offset + image_start
+        sprite.mask_ptr = sprite.offset + mask_start
+        
+        sprite.mode_word = buf.getInt(40)
+        self.set_mode(sprite, sprite.mode_word)
+        self.set_size(sprite)
+        self.validate(sprite, length)
+        
+        palette = Palette()
+        end = Math.min(image_start, len(data))
+        
+        i = 44
+        while i + 8 <= end and palette.size() < self.MAX_PALETTE:
+            entry1 = [data[i + 1] & 0xff, data[i + 2] & 0xff,
+                      data[i + 3] & 0xff]
+            entry2 = [data[i + 5] & 0xff, data[i + 6] & 0xff,
+                      data[i + 7] & 0xff]
+            palette.add(PaletteEntry(entry1, entry2))
+            i += 8
+        
+        sprite.palette = self.expand_palette(palette, sprite.bpp)
+    
+    """The following method reads the image and mask data of a sprite whose
+    header has already been read, decoding them into an array of RGBA values.
+    Each row of the image can be decoded independently of the others, so large
+    sprites are split into bands of rows that are decoded by separate threads,
+    each writing into its own part of the output array."""
+    
+    @args(void, [RandomAccessFile, Sprite])
+    def decode(self, f, sprite):
+    
+        self.decode(f, sprite, True)
+    
+    """Sprites decoded for callers that do not keep them are not shared, so
+    their pixels are not held by the spritefile."""
+    
+    @args(void, [RandomAccessFile, Sprite, bool])
+    def decode(self, f, sprite, shared):
+    
+        # Obtain image data
+        image = self.read_block(f, sprite.image_ptr,
+                                sprite.h_words * 4 * sprite.v_lines)
         
         # Obtain mask data
-        if mask_ptr != image_ptr:
+        if sprite.mask_ptr != sprite.image_ptr:
+            mask_size = self.mask_row_words(sprite) * 4 * sprite.height
+            mask = self.read_block(f, sprite.mask_ptr, mask_size)
+        else:
+            mask = None
+        
+        if shared:
+            self.decode_shared(sprite, image, mask)
+        else:
+            self.decode_data(sprite, image, mask)
+    
+    """The following method decodes image and mask data unless an identical
+    sprite has already been decoded, in which case its pixels are used
+    instead. Sprites are only identical if their headers, palettes, images and
+    masks are the same, so the hash is calculated from all of these."""
+    
+    @args(void, [Sprite, [byte], [byte]])
+    def decode_shared(self, sprite, image, mask):
+    
+        sprite.hash = self.content_hash(sprite, image, mask)
+        
+        rgba = self.pixels.get(sprite.hash)
+        if rgba != None:
+            self.profiler.count(Profiler.SHARED_DECODES, long(1))
+            sprite.rgba = rgba
+            if mask != None:
+                sprite.mode = 'RGBA'
+            sprite.decoded = True
+            return
+        
+        self.decode_data(sprite, image, mask)
+        self.pixels.put(sprite.hash, sprite.rgba)
+    
+    """This method returns a hash of the information used to decode a sprite:
+    the fields from its header that determine its layout and colour depth, the
+    colours in its palette, and its image and mask data."""
+    
+    @args(String, [Sprite, [byte], [byte]])
+    def content_hash(self, sprite, image, mask):
+    
+        digest = MessageDigest.getInstance("SHA-1")
+        
+        buf = ByteBuffer.allocate(28)
+        buf.putInt(sprite.h_words)
+        buf.putInt(sprite.v_lines)
+        buf.putInt(sprite.first_bit)
+        buf.putInt(sprite.last_bit)
+        buf.putInt(sprite.bpp)
+        buf.putInt(sprite.xdpi)
+        buf.putInt(sprite.ydpi)
+        digest.update(buf.array())
+        
+        if sprite.palette != None:
+            colours = array(byte, sprite.palette.size() * 6)
+            i = 0
+            for entry in sprite.palette.entries:
+                for j in range(3):
+                    colours[i + j] = byte(entry.primary[j])
+                    colours[i + j + 3] = byte(entry.secondary[j])
+                i += 6
+            digest.update(colours)
+        
+        digest.update(image)
         
-            f.seek(mask_ptr)
+        # Distinguish sprites with masks from those without.
+        if mask != None:
+            digest.update(byte(1))
+            digest.update(mask)
+        else:
+            digest.update(byte(0))
+        
+        return BigInteger(1, digest.digest()).toString(16)
+    
+    """This method decodes image and mask data that has already been read into
+    memory, storing the RGBA values in the sprite."""
+    
+    @args(void, [Sprite, [byte], [byte]])
+    def decode_data(self, sprite, image, mask):
+    
+        rgba = array(byte, sprite.width * sprite.height * 4)
+        self.profiler.count(Profiler.ALLOCATED,
+                            long(sprite.width * sprite.height * 4))
+        
+        bands = self.bands_for(sprite)
+        
+        if bands <= 1:
+            self.decode_rows(sprite, image, mask, rgba, 0, sprite.height)
+        else:
+            rows = (sprite.height + bands - 1) / bands
+            workers = array(DecodeBand, bands)
             
-            self.mask2rgba(f, sprite)
+            start = 0
+            for i in range(bands):
+                end = Math.min(start + rows, sprite.height)
+                workers[i] = DecodeBand(self, sprite, image, mask, rgba,
+                                        start, end)
+                workers[i].start()
+                start = end
             
+            failed = False
+            for i in range(bands):
+                workers[i].join()
+                if workers[i].failed:
+                    failed = True
+            
+            if failed:
+                raise SpritefileError('Failed to decode sprite.')
+        
+        sprite.rgba = rgba
+        
+        if mask != None:
             # The image is stored in RGBA form.
             sprite.mode = 'RGBA'
         
         sprite.decoded = True
     
+    """We define a method to decide how many bands to split a sprite into when
+    decoding it. Small sprites are decoded in the calling thread because the
+    cost of starting threads would outweigh any benefit."""
+    
+    @args(int, [Sprite])
+    def bands_for(self, sprite):
+    
+        if self.decode_threads <= 1:
+            return 1
+        
+        if sprite.width * sprite.height < self.BAND_THRESHOLD:
+            return 1
+        
+        return Math.min(self.decode_threads, sprite.height)
+    
+    """The number of threads used to decode large sprites defaults to the
+    number of available processors but can be changed with the following
+    method. Passing 1 causes all sprites to be decoded in the calling
+    thread."""
+    
+    @args(void, [int])
+    def setDecodeThreads(self, threads):
+    
+        self.decode_threads = Math.max(1, threads)
+    
+    """This method decodes the rows from `start` up to, but not including,
+    `end` into the corresponding part of the `rgba` array, applying the mask to
+    each row if one is supplied. It only reads from the image and mask arrays
+    and writes to its own rows of the output, so it can be called from several
+    threads at once."""
+    
+    @args(void, [Sprite, [byte], [byte], [byte], int, int])
+    def decode_rows(self, sprite, image, mask, rgba, start, end):
+    
+        started = self.profiler.begin(Profiler.DECODE_PIXELS)
+        
+        if sprite.mode == 'CMYK':
+            self.sprite2cmyk(image, sprite, rgba, start, end)
+        else:
+            self.sprite2rgb(image, sprite, rgba, start, end)
+        
+        self.profiler.end(Profiler.DECODE_PIXELS, started)
+        
+        if mask != None:
+            started = self.profiler.begin(Profiler.DECODE_MASK)
+            self.mask2rgba(mask, sprite, rgba, start, end)
+            self.profiler.end(Profiler.DECODE_MASK, started)
+    
+    """We read blocks of image and mask data in a single operation. Data
+    missing from the end of a truncated file is left as zeros."""
+    
+    @args([byte], [RandomAccessFile, int, int])
+    def read_block(self, f, offset, length):
+    
+        data = array(byte, length)
+        self.profiler.count(Profiler.ALLOCATED, long(length))
+        
+        f.seek(offset)
+        self.profiler.count(Profiler.SEEKS, long(1))
+        
+        read = 0
+        while read < length:
+            r = f.read(data, read, length - read)
+            if r == -1:
+                break
+            read += r
+        
+        self.profiler.count(Profiler.BYTES_READ, long(read))
+        
+        return data
+    
+    """The following method copies a block of image or mask data from an array
+    containing the data for a whole sprite, leaving any data missing from the
+    end of the array as zeros."""
+    
+    @args([byte], [[byte], int, int])
+    def copy_block(self, data, offset, length):
+    
+        block = array(byte, length)
+        self.profiler.count(Profiler.ALLOCATED, long(length))
+        
+        n = Math.max(0, Math.min(length, len(data) - offset))
+        System.arraycopy(data, offset, block, 0, n)
+        
+        return block
+    
+    """Masks for sprites with fewer than 16 bits per pixel have the same layout
+    as the image data. Sprites with deeper colour use masks with one bit per
+    pixel, with each row padded to a whole number of words."""
+    
+    @args(int, [Sprite])
+    def mask_row_words(self, sprite):
+    
+        if sprite.bpp >= 16:
+            return (sprite.width + 31) >> 5
+        else:
+            return sprite.h_words
+    
     @args(void, [File])
     def read(self, file):
     
         f = RandomAccessFile(file, "r")
+        length = f.length()
         
         # Examine the sprites
-        number = self.str2num(4, f)
-        offset = self.str2num(4, f) - 4
-        free   = self.str2num(4, f) - 4
+        header = array(byte, 12)
+        try:
+            f.readFully(header)
+        except IOException:
+            f.close()
+            raise SpritefileError('Incomplete spritefile header.')
+        
+        self.profiler.count(Profiler.BYTES_READ, long(12))
+        
+        buf = ByteBuffer.wrap(header)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        number = buf.getInt(0)
+        offset = buf.getInt(4) - 4
+        free   = buf.getInt(8) - 4
+        
+        if offset < 12 or free < offset or long(free) > length:
+            f.close()
+            raise SpritefileError('Invalid spritefile header.')
         
         self.sprites = {}
         
-        o = offset
-        while offset < free:
-            offset += self.read_name(f, offset)
+        # Each sprite must be at least as large as a sprite header and lie
+        # within the space used by sprites, so the number of sprites examined
+        # is limited by the length of the file. A corrupt offset ends the list
+        # of sprites instead of causing the same sprites to be read again.
+        failed = False
+        try:
+            while offset < free:
+                next = self.read_name(f, offset)
+                if next < 44 or next > free - offset:
+                    break
+                offset += next
+        except:
+            failed = True
+        
+        f.close()
+        
+        if failed:
+            raise SpritefileError('Failed to read sprite names.')
+    
+    """The following method returns the named sprite, decoding it if necessary.
+    Each sprite being decoded has a semaphore that is released when its decode
+    finishes, so that other threads requesting it can wait for the result. If
+    that decode fails, the waiting thread tries again itself."""
     
     @args(Sprite, [String])
     def getSprite(self, name):
     
+        sprite = self.sprites[name]
+        if sprite.decoded:
+            return sprite
+        
+        gate = Semaphore(0)
+        running = self.decoding.putIfAbsent(name, gate)
+        
+        if running != None:
+            # Wait for the other decode, then pass the permit on to any other
+            # thread waiting for it.
+            running.acquireUninterruptibly()
+            running.release()
+            if sprite.decoded:
+                return sprite
+        
+        failed = False
+        try:
+            f = RandomAccessFile(self.file, "r")
+            try:
+                self.read_details(f, sprite)
+            except:
+                failed = True
+            f.close()
+        except:
+            failed = True
+        
+        if running == None:
+            self.decoding.remove(name)
+            gate.release()
+        
+        if failed:
+            raise SpritefileError('Failed to decode sprite.')
+        
+        return sprite
+    
+    """The following method decodes the named sprite into a separate object
+    that is not kept by the spritefile, returning the sprite itself if it has
+    already been decoded. It lets every sprite in a file be decoded in turn in
+    the background without the pixels of all of them being kept in memory."""
+    
+    @args(Sprite, [String])
+    def decodeCopy(self, name):
+    
+        sprite = self.sprites[name]
+        if sprite.decoded:
+            return sprite
+        
+        copy = Sprite()
+        copy.name = sprite.name
+        copy.offset = sprite.offset
+        
+        failed = False
         f = RandomAccessFile(self.file, "r")
+        try:
+            self.read_header(f, copy)
+            self.decode(f, copy, False)
+        except:
+            failed = True
+        
+        f.close()
+        
+        if failed:
+            raise SpritefileError('Failed to decode sprite.')
         
+        return copy
+    
+    """The following method returns a reduced version of the named sprite for
+    use as a quick preview, no larger than the given size in either direction.
+    It returns `None` if the sprite has already been decoded or is small enough
+    to be decoded quickly in full. The header is read into a separate object so
+    that the sprite can be decoded in full by another thread at the same time.
+    The reduced sprite keeps the row layout of the full sprite, so the width of
+    the full sprite can be found using the `row_width` method."""
+    
+    @args(Sprite, [String, int])
+    def getCoarseSprite(self, name, size):
+    
         sprite = self.sprites[name]
-        if not sprite.decoded:
-            self.read_details(f, sprite)
+        if sprite.decoded:
+            return None
         
-        return sprite
+        header = Sprite()
+        header.name = sprite.name
+        header.offset = sprite.offset
+        
+        coarse = None
+        failed = False
+        f = RandomAccessFile(self.file, "r")
+        try:
+            self.read_header(f, header)
+            step = (Math.max(header.width, header.height) + size - 1) / size
+            if step >= 2:
+                coarse = self.decode_coarse(f, header, step)
+        except:
+            failed = True
+        
+        f.close()
+        
+        if failed:
+            raise SpritefileError('Failed to decode sprite.')
+        
+        return coarse
     
-    @args(void, [RandomAccessFile, Sprite])
-    def sprite2rgb(self, f, sprite):
+    """The following methods return the estimated cost of decoding the named
+    sprite, recording it in the sprite so that it is only estimated once. Both
+    can be called in the main UI thread because neither reads the file. The
+    first method uses the number of bytes occupied by the sprite, which is
+    known once its name has been read, and estimates the cost of decoding that
+    many bytes of pixels with 8 bits per pixel. The second uses the dimensions,
+    mode and mask information held in an index. Sprites whose sizes or headers
+    are invalid are given the lowest cost so that their errors are reported
+    quickly."""
+    
+    @args(long, [String])
+    def estimateCost(self, name):
+    
+        sprite = self.sprites[name]
+        if sprite.cost != long(0):
+            return sprite.cost
+        
+        if sprite.record_size < 44:
+            sprite.cost = long(1)
+        else:
+            # Each byte is read once and each pixel is converted and stored.
+            sprite.cost = Math.max(long(1),
+                                   long(sprite.record_size - 44) * long(3))
+        
+        return sprite.cost
+    
+    @args(long, [String, int, int, int, bool])
+    def estimateCost(self, name, width, height, mode, masked):
+    
+        sprite = self.sprites[name]
+        if sprite.cost != long(0):
+            return sprite.cost
+        
+        header = Sprite()
+        try:
+            self.set_mode(header, mode)
+            header.width = width
+            header.height = height
+            header.h_words = ((width << header.log2bpp) + 31) >> 5
+            header.v_lines = height
+            if masked:
+                header.mask_ptr = header.image_ptr + 1
+            sprite.cost = Math.max(long(1), self.decode_cost(header))
+        except SpritefileError:
+            sprite.cost = long(1)
+        
+        return sprite.cost
+    
+    """This method decodes every `step`th row and column of a sprite whose
+    header has been read, returning a new sprite containing the result. Only
+    the rows that are needed are read from the file."""
+    
+    @args(Sprite, [RandomAccessFile, Sprite, int])
+    def decode_coarse(self, f, sprite, step):
+    
+        rows = (sprite.height + step - 1) / step
+        columns = (sprite.width + step - 1) / step
+        row_bytes = sprite.h_words * 4
+        mask_bytes = self.mask_row_words(sprite) * 4
+        
+        image = array(byte, rows * row_bytes)
+        if sprite.mask_ptr != sprite.image_ptr:
+            mask = array(byte, rows * mask_bytes)
+        else:
+            mask = None
+        
+        for i in range(rows):
+            self.read_row(f, sprite.image_ptr + (i * step * row_bytes),
+                          image, i * row_bytes, row_bytes)
+            if mask != None:
+                self.read_row(f, sprite.mask_ptr + (i * step * mask_bytes),
+                              mask, i * mask_bytes, mask_bytes)
+        
+        # Describe the selected rows as a sprite with the same layout as the
+        # original and decode them.
+        coarse = Sprite()
+        coarse.name = sprite.name
+        coarse.h_words = sprite.h_words
+        coarse.v_lines = rows
+        coarse.first_bit = sprite.first_bit
+        coarse.last_bit = sprite.last_bit
+        coarse.bpp = sprite.bpp
+        coarse.log2bpp = sprite.log2bpp
+        coarse.xdpi = sprite.xdpi
+        coarse.ydpi = sprite.ydpi
+        coarse.mode = sprite.mode
+        coarse.palette = sprite.palette
+        coarse.width = sprite.width
+        coarse.height = rows
+        
+        decoded = array(byte, sprite.width * rows * 4)
+        self.decode_rows(coarse, image, mask, decoded, 0, rows)
+        
+        # Select every step-th pixel from each row.
+        rgba = array(byte, columns * rows * 4)
+        k = 0
+        for i in range(rows):
+            j = i * sprite.width * 4
+            for x in range(columns):
+                System.arraycopy(decoded, j, rgba, k, 4)
+                j += step * 4
+                k += 4
+        
+        coarse.width = columns
+        coarse.rgba = rgba
+        if mask != None:
+            coarse.mode = 'RGBA'
+        coarse.decoded = True
+        
+        return coarse
+    
+    """This method reads a row of image or mask data into part of an array,
+    leaving any data missing from the end of a truncated file as zeros."""
+    
+    @args(void, [RandomAccessFile, int, [byte], int, int])
+    def read_row(self, f, offset, data, start, length):
+    
+        f.seek(offset)
+        self.profiler.count(Profiler.SEEKS, long(1))
+        
+        read = 0
+        while read < length:
+            r = f.read(data, start + read, length - read)
+            if r == -1:
+                break
+            read += r
+        
+        self.profiler.count(Profiler.BYTES_READ, long(read))
+    
+    @args(void, [[byte], Sprite, [byte], int, int])
+    def sprite2rgb(self, image, sprite, rgb, start, end):
     
         # Convert sprite to RGB values
         
         has_palette = (sprite.palette != None) and sprite.palette.hasEntries()
         
-        rgb = array(byte, sprite.width * sprite.height * 4)
-        ptr = f.getFilePointer() * 8    # bit offset
-        rgb_i = 0
+        row_bytes = sprite.h_words * 4
+        rgb_i = start * sprite.width * 4
         
-        bits_to_read = sprite.width * sprite.bpp
-        row = array(byte, sprite.h_words * 4)
+        i = start
+        while i < end:
         
-        i = 0
-        while i < sprite.height:
-        
-            i += 1
-            
-            # bit offset into the image
-            row_ptr = ptr
-            
-            ### To be updated when shr_long instruction generation is fixed.
-            f.seek(int(row_ptr) >> 3)
-            
-            f.read(row)
+            # byte offset into the image and bit offset into that byte
+            k = (i * row_bytes) + (sprite.first_bit >> 3)
+            shift = sprite.first_bit & 7
             
+            i += 1
             j = 0
-            k = sprite.first_bit / 8
             
             while j < sprite.width:
             
@@ -488,17 +1202,17 @@ class Spritefile(Object):
                 
                 # Conversion depends on bpp value
                 if sprite.bpp == 32:
-
-                    red = int(row[k])
-                    green = int(row[k + 1])
-                    blue = int(row[k + 2])
+                
+                    red = int(image[k])
+                    green = int(image[k + 1])
+                    blue = int(image[k + 2])
                     k += 4
                 
                 elif sprite.bpp == 16:
                 
-                    low = int(row[k])
+                    low = int(image[k])
                     if low < 0: low += 256
-                    high = int(row[k + 1])
+                    high = int(image[k + 1])
                     if high < 0: high += 256
                     value = low | (high << 8)
                     red   = int((value & 0x1f) * self.scale16)
@@ -508,9 +1222,10 @@ class Spritefile(Object):
                 
                 elif sprite.bpp == 8:
                 
+                    value = int(image[k]) & 0xff
+                    
                     if not has_palette:
                         # Standard VIDC 256 colours
-                        value = int(row[k])
                         red   = ((value & 0x10) >> 1) | (value & 7)
                         green = ((value & 0x40) >> 3) | \
                                 ((value & 0x20) >> 3) | (value & 3)
@@ -521,45 +1236,52 @@ class Spritefile(Object):
                         blue  = int(blue * self.scale8)
                     else:
                         # 256 entry palette
-                        value = int(row[k])
                         red, green, blue = sprite.palette.getEntry(value).primary
                     
                     k += 1
                 
                 elif sprite.bpp == 4:
                 
-                    value = (row[k] >> (int(row_ptr) % 8)) & 0xf
+                    value = (image[k] >> shift) & 0xf
                     
                     if not has_palette:
                         # Standard 16 desktop colours
                         # Look up the value in the standard palette.
-                        red, green, blue = self.palette16[value]
+                        colour = self.palette16[value]
+                        red = (colour >> 16) & 0xff
+                        green = (colour >> 8) & 0xff
+                        blue = colour & 0xff
                     else:
                         # 16 entry palette
                         red, green, blue = sprite.palette.getEntry(value).primary
                     
-                    row_ptr += 4
-                    if row_ptr % 8 == 0:
+                    shift += 4
+                    if shift == 8:
+                        shift = 0
                         k += 1
                 
                 elif sprite.bpp == 2:
                 
-                    value = (row[k] >> (int(row_ptr) % 8)) & 0x3
+                    value = (image[k] >> shift) & 0x3
                     
                     if not has_palette:
                         # Greyscales
-                        red, green, blue = self.palette4[value]
+                        colour = self.palette4[value]
+                        red = (colour >> 16) & 0xff
+                        green = (colour >> 8) & 0xff
+                        blue = colour & 0xff
                     else:
                         # 4 entry palette
                         red, green, blue = sprite.palette.getEntry(value).primary
                     
-                    row_ptr += 2
-                    if row_ptr % 8 == 0:
+                    shift += 2
+                    if shift == 8:
+                        shift = 0
                         k += 1
                 
                 elif sprite.bpp == 1:
                 
-                    value = (row[k] >> (int(row_ptr) % 8)) & 1
+                    value = (image[k] >> shift) & 1
                     
                     if not has_palette:
                         # Black and white
@@ -568,8 +1290,9 @@ class Spritefile(Object):
                         # 2 entry palette
                         red, green, blue = sprite.palette.getEntry(value).primary
                     
-                    row_ptr += 1
-                    if row_ptr % 8 == 0:
+                    shift += 1
+                    if shift == 8:
+                        shift = 0
                         k += 1
                 else:
                     red = green = blue = 0
@@ -579,73 +1302,50 @@ class Spritefile(Object):
                 rgb[rgb_i + 2] = blue
                 rgb[rgb_i + 3] = 255
                 rgb_i += 4
-            
-            ptr = ptr + (sprite.h_words * 32)
-        
-        sprite.rgba = rgb
     
-    @args(void, [RandomAccessFile, Sprite])
-    def sprite2cmyk(self, f, sprite):
-
+    @args(void, [[byte], Sprite, [byte], int, int])
+    def sprite2cmyk(self, image, sprite, rgb, start, end):
+    
         # Read a CMYK sprite - currently just reuse the data verbatim.
-
-        ptr = f.getFilePointer() * 8    # bit offset
-        
-        rgb = array(byte, sprite.width * sprite.height * 4)
-        rgb_i = 0
         
-        for j in range(sprite.height):
-
-            for i in range(sprite.width):
-
-                rgb[rgb_i] = self.read_byte(f)
-                rgb[rgb_i + 1] = self.read_byte(f)
-                rgb[rgb_i + 2] = self.read_byte(f)
-                rgb[rgb_i + 3] = self.read_byte(f)
-                rgb_i += 4
+        row_bytes = sprite.h_words * 4
         
-        sprite.rgba = rgb
+        for j in range(start, end):
+            System.arraycopy(image, j * row_bytes, rgb, j * sprite.width * 4,
+                             sprite.width * 4)
     
-    @args(void, [RandomAccessFile, Sprite])
-    def mask2rgba(self, f, sprite):
+    @args(void, [[byte], Sprite, [byte], int, int])
+    def mask2rgba(self, mask, sprite, rgba, start, end):
     
-        rgba = array(byte, sprite.width * sprite.height * 4)
-        
         # Colour depths below 16 bpp have the same number of bpp in the mask.
         bpp = sprite.bpp
         
         if bpp == 32 or bpp == 16:
             bpp = 1
         
-        bits = bpp * sprite.width
+        row_bytes = self.mask_row_words(sprite) * 4
+        image_ptr = start * sprite.width * 4
         
-        row_size = bits >> 5        # number of 32-bit words
-        if bits % 32 != 0:
-            row_size = row_size + 1
+        for j in range(start, end):
         
-        ptr = f.getFilePointer() * 8    # bit offset
-        image_ptr = 0
-        
-        for j in range(sprite.height):
-        
-            # bit offset into the image
-            row_ptr = int(ptr) + sprite.first_bit
+            # bit offset into the mask
+            row_ptr = (j * row_bytes * 8) + sprite.first_bit
             
             for i in range(sprite.width):
             
-                f.seek(row_ptr >> 3)
+                byte_value = int(mask[row_ptr >> 3]) & 0xff
                 
                 # Conversion depends on bpp value
                 if bpp == 8:
                 
-                    value = self.read_byte(f)
+                    value = byte_value
                     if value != 255:
                         value = 0
                     row_ptr += 8
                 
                 elif bpp == 4:
                 
-                    value = (self.read_byte(f) >> (row_ptr % 8)) & 0xf
+                    value = (byte_value >> (row_ptr % 8)) & 0xf
                     if value == 15:
                         value = 0xff
                     else:
@@ -654,7 +1354,7 @@ class Spritefile(Object):
                 
                 elif bpp == 2:
                 
-                    value = (self.read_byte(f) >> (row_ptr % 8)) & 0x3
+                    value = (byte_value >> (row_ptr % 8)) & 0x3
                     if value == 3:
                         value = 0xff
                     else:
@@ -662,9 +1362,9 @@ class Spritefile(Object):
                     row_ptr += 2
                 
                 elif bpp == 1:
-
+                
                     # Black and white
-                    value = (self.read_byte(f) >> (row_ptr % 8)) & 1
+                    value = (byte_value >> (row_ptr % 8)) & 1
                     value = value * 0xff
                     row_ptr += 1
                 else:
@@ -676,18 +1376,230 @@ class Spritefile(Object):
                 # because the Android API requires that the components are
                 # pre-multiplied which, for this case, simply means multiplying
                 # by 0 or 1.
-                if value != 0:
-                    red, green, blue, x = sprite.rgba[image_ptr:image_ptr + 4]
-                else:
-                    red = green = blue = byte(0)
+                if value == 0:
+                    rgba[image_ptr] = byte(0)
+                    rgba[image_ptr + 1] = byte(0)
+                    rgba[image_ptr + 2] = byte(0)
                 
-                rgba[image_ptr] = red
-                rgba[image_ptr + 1] = green
-                rgba[image_ptr + 2] = blue
                 rgba[image_ptr + 3] = value
                 
                 image_ptr += 4
-            
-            ptr += row_size * 32
+
+
+"""The following class reads sprites from a stream in the order in which they
+occur, such as a stream obtained from a content provider, a zip file or a pipe.
+Only the data for the sprite being read is held in memory. Each call to the
+`next` method returns the next sprite, decoded into RGBA form, or `None` when
+there are no more sprites. Sprites can also be skipped without decoding them.
+
+A `Spritefile` object that is not associated with a file is used to decode the
+sprites, so sprites read from streams are decoded in the same way as those read
+from files."""
+
+class SpriteStream(Object):
+
+    __fields__ = {
+        "stream": InputStream,
+        "spritefile": Spritefile,
+        "number": int,
+        "count": int,
+        "position": long,
+        "free": long
+        }
+    
+    # The length of a stream is not known in advance, so sprites larger than
+    # this are not read into memory.
+    max_sprite_size = 67108864
+    
+    @args(void, [InputStream])
+    def __init__(self, stream):
+    
+        Object.__init__(self)
         
-        sprite.rgba = rgba
+        self.stream = stream
+        self.spritefile = Spritefile()
+        
+        # Read the header at the start of the stream, containing the number of
+        # sprites and the offsets of the first sprite and the free space after
+        # the last sprite.
+        header = self.read_fully(12)
+        buf = ByteBuffer.wrap(header)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        
+        self.number = buf.getInt(0)
+        offset = buf.getInt(4) - 4
+        self.free = long(buf.getInt(8) - 4)
+        self.position = long(12)
+        self.count = 0
+        
+        if self.number < 0 or offset < 12 or long(offset) > self.free:
+            raise SpritefileError('Invalid spritefile header.')
+        
+        self.skip(long(offset - 12))
+    
+    """The following method returns the next sprite in the stream, or `None` if
+    there are no more sprites."""
+    
+    @args(Sprite, [])
+    def next(self):
+    
+        data = self.read_sprite()
+        if data == None:
+            return None
+        
+        return self.decode(data)
+    
+    """This method decodes a sprite from the data returned by the `read_sprite`
+    method. It must be called before the next sprite is read."""
+    
+    @args(Sprite, [[byte]])
+    def decode(self, data):
+    
+        sprite = Sprite()
+        sprite.offset = int(self.position - long(len(data)))
+        sprite.name = self.read_name(data)
+        
+        spritefile = self.spritefile
+        spritefile.parse_header(sprite, data)
+        
+        image = spritefile.copy_block(data, sprite.image_ptr - sprite.offset,
+                                      sprite.h_words * 4 * sprite.v_lines)
+        
+        if sprite.mask_ptr != sprite.image_ptr:
+            mask = spritefile.copy_block(data, sprite.mask_ptr - sprite.offset,
+                spritefile.mask_row_words(sprite) * 4 * sprite.height)
+        else:
+            mask = None
+        
+        spritefile.decode_shared(sprite, image, mask)
+        return sprite
+    
+    """This method skips the next sprite in the stream, returning its name or
+    `None` if there are no more sprites."""
+    
+    @args(String, [])
+    def skipSprite(self):
+    
+        data = self.read_sprite()
+        if data == None:
+            return None
+        
+        return self.read_name(data)
+    
+    @args(void, [])
+    def close(self):
+    
+        self.stream.close()
+    
+    """The following method reads all the data for the next sprite, returning
+    `None` if the end of the sprites has been reached. Each sprite starts with
+    its own length, which is also the offset of the next sprite."""
+    
+    @args([byte], [])
+    def read_sprite(self):
+    
+        if self.count >= self.number or self.position >= self.free:
+            return None
+        
+        start = self.position
+        
+        size_data = self.read_fully(4)
+        buf = ByteBuffer.wrap(size_data)
+        buf.order(ByteOrder.LITTLE_ENDIAN)
+        size = buf.getInt(0)
+        
+        if size < 44 or size > self.max_sprite_size or \
+           start + long(size) > self.free:
+            raise SpritefileError('Invalid sprite size.')
+        
+        data = array(byte, size)
+        System.arraycopy(size_data, 0, data, 0, 4)
+        self.read_into(data, 4, size - 4)
+        self.count += 1
+        
+        return data
+    
+    @args(String, [[byte]])
+    def read_name(self, data):
+    
+        length = 0
+        while length < 12 and data[4 + length] != 0:
+            length += 1
+        
+        return String(data, 4, length, "ASCII")
+    
+    """These methods read a given number of bytes from the stream, raising an
+    exception if the stream ends before they have all been read, and skip a
+    given number of bytes."""
+    
+    @args([byte], [int])
+    def read_fully(self, length):
+    
+        data = array(byte, length)
+        self.read_into(data, 0, length)
+        return data
+    
+    @args(void, [[byte], int, int])
+    def read_into(self, data, offset, length):
+    
+        read = 0
+        while read < length:
+            r = self.stream.read(data, offset + read, length - read)
+            if r == -1:
+                raise IOException()
+            read += r
+        
+        self.position += long(length)
+        self.spritefile.profiler.count(Profiler.BYTES_READ, long(length))
+    
+    @args(void, [long])
+    def skip(self, length):
+    
+        remaining = length
+        while remaining > long(0):
+            skipped = self.stream.skip(remaining)
+            if skipped <= long(0):
+                # Some streams cannot skip, so read the data instead.
+                if self.stream.read() == -1:
+                    raise IOException()
+                skipped = long(1)
+            remaining -= skipped
+        
+        self.position += length
+
+
+"""The following class decodes a band of rows of a sprite in its own thread,
+recording whether an error occurred so that the thread that started it can
+report the failure."""
+
+class DecodeBand(Thread):
+
+    __fields__ = {
+        "spritefile": Spritefile, "sprite": Sprite,
+        "image": [byte], "mask": [byte], "rgba": [byte],
+        "first_row": int, "last_row": int,
+        "failed": bool
+        }
+    
+    @args(void, [Spritefile, Sprite, [byte], [byte], [byte], int, int])
+    def __init__(self, spritefile, sprite, image, mask, rgba, start, end):
+    
+        Thread.__init__(self)
+        
+        self.spritefile = spritefile
+        self.sprite = sprite
+        self.image = image
+        self.mask = mask
+        self.rgba = rgba
+        self.first_row = start
+        self.last_row = end
+        self.failed = False
+    
+    def run(self):
+    
+        try:
+            self.spritefile.decode_rows(self.sprite, self.image, self.mask,
+                                        self.rgba, self.first_row,
+                                        self.last_row)
+        except:
+            self.failed = True
@@ -0,0 +1,532 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `spriteindex` module contains classes for reading and writing index
+files that describe the sprites in a spritefile, allowing large spritefiles to
+be opened without reading the header of each sprite.
+
+An index supplied with a spritefile is stored next to it in a file with the
+same name and an additional `.sprindex` suffix. Indexes written by the
+application are kept in a directory of its own, usually its cache directory, so
+that no files are created in the user's directories. All values are stored in
+little-endian order. The index begins with a header of 40 bytes:
+
+ * the characters `SPRX`
+ * the format version (1)
+ * the length of the spritefile (8 bytes)
+ * a checksum of the start and end of the spritefile
+ * the number of sprites
+ * the width and height of the square each thumbnail fits into, or 0 if the
+   index contains no thumbnails
+ * the offset of the first sprite record
+ * the offset of the first thumbnail
+ * a stamp derived from the modification time of the spritefile, or 0 if the
+   modification time was not recorded
+
+The header is followed by one 40 byte record for each sprite, sorted by name:
+
+ * the name, padded with zeros to 12 bytes
+ * the offset of the sprite in the spritefile
+ * the width and height of the sprite in pixels
+ * the mode word of the sprite
+ * the CRC-32 checksum of the palette, or 0 if the sprite has no palette
+ * flags, where bit 0 indicates that the sprite has a mask
+ * the width of the thumbnail in the low 16 bits of a word and its height in
+   the high 16 bits
+
+Thumbnails follow the records, each occupying a fixed amount of space so that
+the thumbnail for any sprite can be found without reading the others. Each one
+contains RGBA pixel data for its width and height.
+
+Indexes can also be written without thumbnails by the `sprindex.py` tool
+supplied with the application's sources. These do not record the modification
+time of the spritefile, so they remain valid when spritefiles are copied
+between systems."""
+
+from java.io import BufferedOutputStream, File, FileInputStream, \
+                    FileOutputStream, RandomAccessFile
+from java.lang import Integer, Math, Object, String, Thread
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+from java.util import Collections, LinkedList, List
+from java.util.zip import CRC32
+
+from android.graphics import Bitmap
+
+from profiling import Profiler
+from spritefile import Sprite, Spritefile
+
+"""The following class provides access to an index that has been mapped into
+memory. Instances are obtained using the static `open` method, which checks
+that the index describes the spritefile as it is now."""
+
+class SpriteIndex(Object):
+
+    __fields__ = {
+        "buffer": ByteBuffer,
+        "count": int,
+        "thumb_size": int,
+        "records": int,
+        "thumbs": int
+        }
+    
+    SUFFIX = ".sprindex"
+    MAGIC = 0x58525053 # SPRX
+    VERSION = 1
+    HEADER = 40
+    RECORD = 40
+    
+    # The amount of data at each end of a spritefile that is checked to
+    # determine whether an index still describes it.
+    SAMPLE = 65536
+    
+    @args(void, [ByteBuffer])
+    def __init__(self, buffer):
+    
+        Object.__init__(self)
+        
+        self.buffer = buffer
+        self.count = buffer.getInt(20)
+        self.thumb_size = buffer.getInt(24)
+        self.records = buffer.getInt(28)
+        self.thumbs = buffer.getInt(32)
+    
+    """This method returns the index file supplied with the given
+    spritefile."""
+    
+    @static
+    @args(File, [File])
+    def sidecar(file):
+    
+        return File(file.getPath() + SpriteIndex.SUFFIX)
+    
+    """This method returns the file in the given directory that holds the index
+    written by the application for the given spritefile. The name of the file
+    is derived from the path of the spritefile."""
+    
+    @static
+    @args(File, [File, File])
+    def cached(file, directory):
+    
+        return File(directory, file.getName() + "-" + \
+                    Integer.toHexString(file.getPath().hashCode()) + \
+                    SpriteIndex.SUFFIX)
+    
+    """The following method returns the stamp recorded in an index for a
+    spritefile with the given modification time."""
+    
+    @static
+    @args(int, [long])
+    def stamp(mtime):
+    
+        return int(mtime ^ (mtime >> 32))
+    
+    """The following method maps the index for the given spritefile into
+    memory, returning `None` if there is no index or if the index is invalid
+    or out of date. The index supplied with the spritefile is used if there is
+    one, otherwise the index written by the application in the given directory
+    is used."""
+    
+    @static
+    @args(SpriteIndex, [File, File])
+    def open(file, directory):
+    
+        index = SpriteIndex.open(file, SpriteIndex.sidecar(file))
+        if index == None and directory != None:
+            index = SpriteIndex.open(file, SpriteIndex.cached(file, directory))
+        
+        return index
+    
+    """This method maps the given index file into memory if it describes the
+    given spritefile. An index is out of date if the length of the spritefile
+    or the checksum of its first and last blocks has changed. If the index
+    records the modification time of the spritefile, it is also out of date if
+    that has changed, so that changes in the middle of the file are noticed."""
+    
+    @static
+    @args(SpriteIndex, [File, File])
+    def open(file, index_file):
+    
+        if not index_file.isFile():
+            return None
+        
+        try:
+            stream = FileInputStream(index_file)
+            channel = stream.getChannel()
+            size = channel.size()
+            buffer = channel.map(FileChannel.MapMode.READ_ONLY, long(0), size)
+            stream.close()
+        except:
+            return None
+        
+        buffer.order(ByteOrder.LITTLE_ENDIAN)
+        
+        if size < long(SpriteIndex.HEADER):
+            return None
+        
+        if buffer.getInt(0) != SpriteIndex.MAGIC or \
+           buffer.getInt(4) != SpriteIndex.VERSION:
+            return None
+        
+        if buffer.getLong(8) != file.length():
+            return None
+        
+        stamp = buffer.getInt(36)
+        if stamp != 0 and stamp != SpriteIndex.stamp(file.lastModified()):
+            return None
+        
+        try:
+            if buffer.getInt(16) != SpriteIndex.checksum(file):
+                return None
+        except:
+            return None
+        
+        index = SpriteIndex(buffer)
+        
+        if index.count < 0 or index.thumb_size < 0 or \
+           index.records < SpriteIndex.HEADER:
+            return None
+        
+        end = long(index.records) + long(index.count * SpriteIndex.RECORD)
+        if end > size:
+            return None
+        
+        if index.thumb_size > 0:
+            end = long(index.thumbs) + \
+                  long(index.count) * long(index.thumbBytes())
+            if index.thumbs < index.records or end > size:
+                return None
+        
+        return index
+    
+    """This method calculates the checksum of the first and last blocks of a
+    spritefile that is stored in an index."""
+    
+    @static
+    @args(int, [File])
+    def checksum(file):
+    
+        length = file.length()
+        crc = CRC32()
+        f = RandomAccessFile(file, "r")
+        
+        n = int(Math.min(length, long(SpriteIndex.SAMPLE)))
+        data = array(byte, n)
+        f.readFully(data)
+        crc.update(data, 0, n)
+        
+        f.seek(length - long(n))
+        f.readFully(data)
+        crc.update(data, 0, n)
+        
+        f.close()
+        return int(crc.getValue())
+    
+    @args(int, [])
+    def thumbBytes(self):
+    
+        return self.thumb_size * self.thumb_size * 4
+    
+    """The following methods return the information held in the record for the
+    sprite at the given position in the sorted list of sprites."""
+    
+    @args(String, [int])
+    def getName(self, i):
+    
+        base = self.records + (i * self.RECORD)
+        name = array(byte, 12)
+        length = 0
+        
+        while length < 12:
+            b = self.buffer.get(base + length)
+            if b == 0:
+                break
+            name[length] = b
+            length += 1
+        
+        return String(name, 0, length, "ASCII")
+    
+    @args(int, [int])
+    def getOffset(self, i):
+    
+        return self.buffer.getInt(self.records + (i * self.RECORD) + 12)
+    
+    @args(int, [int])
+    def getWidth(self, i):
+    
+        return self.buffer.getInt(self.records + (i * self.RECORD) + 16)
+    
+    @args(int, [int])
+    def getHeight(self, i):
+    
+        return self.buffer.getInt(self.records + (i * self.RECORD) + 20)
+    
+    @args(int, [int])
+    def getMode(self, i):
+    
+        return self.buffer.getInt(self.records + (i * self.RECORD) + 24)
+    
+    @args(int, [int])
+    def getPaletteHash(self, i):
+    
+        return self.buffer.getInt(self.records + (i * self.RECORD) + 28)
+    
+    @args(bool, [int])
+    def hasMask(self, i):
+    
+        flags = self.buffer.getInt(self.records + (i * self.RECORD) + 32)
+        return (flags & 1) != 0
+    
+    """This method returns the thumbnail for the sprite at the given position,
+    or `None` if the index does not contain one."""
+    
+    @args(Bitmap, [int])
+    def getThumbnail(self, i):
+    
+        if self.thumb_size == 0:
+            return None
+        
+        size = self.buffer.getInt(self.records + (i * self.RECORD) + 36)
+        width = size & 0xffff
+        height = (size >> 16) & 0xffff
+        
+        if width <= 0 or height <= 0 or width > self.thumb_size or \
+           height > self.thumb_size:
+            return None
+        
+        start = self.thumbs + (i * self.thumbBytes())
+        pixels = self.buffer.duplicate()
+        pixels.position(start)
+        pixels.limit(start + (width * height * 4))
+        
+        bitmap = Bitmap.createBitmap(width, height, Bitmap.Config.ARGB_8888)
+        bitmap.copyPixelsFromBuffer(pixels)
+        return bitmap
+    
+    """The following method returns the names of the sprites in the order in
+    which they are stored in the index."""
+    
+    @args(List(String), [])
+    def names(self):
+    
+        names = LinkedList()
+        for i in range(self.count):
+            names.add(self.getName(i))
+        
+        return names
+    
+    """This method creates a `Spritefile` for the given file using the sprite
+    offsets held in the index instead of reading the file. The headers of the
+    sprites are read when they are decoded, as usual."""
+    
+    @args(Spritefile, [File, Profiler])
+    def createSpritefile(self, file, profiler):
+    
+        spritefile = Spritefile()
+        spritefile.file = file
+        spritefile.profiler = profiler
+        spritefile.new()
+        
+        for i in range(self.count):
+            sprite = Sprite()
+            sprite.name = self.getName(i)
+            sprite.offset = self.getOffset(i)
+            spritefile.sprites[sprite.name] = sprite
+        
+        return spritefile
+
+
+"""The following class writes an index for a spritefile in a background thread,
+including a thumbnail of each sprite. The index is written to the given
+directory, which is created if necessary, and is found there by the
+`SpriteIndex.open` method. It is written to a temporary file that replaces any
+existing index when it is complete, so a partially written index is never
+used. Failures are ignored."""
+
+class SpriteIndexWriter(Thread):
+
+    __fields__ = {"file": File, "directory": File, "thumb_size": int}
+    
+    # The default size of the square that each thumbnail is scaled to fit.
+    default_thumb_size = 32
+    
+    @args(void, [File, File])
+    def __init__(self, file, directory):
+    
+        Thread.__init__(self)
+        self.file = file
+        self.directory = directory
+        self.thumb_size = self.default_thumb_size
+    
+    def run(self):
+    
+        try:
+            self.directory.mkdirs()
+            self.write(SpriteIndex.cached(self.file, self.directory))
+        except:
+            pass
+    
+    """This method writes the index to the given file. The modification time
+    of the spritefile is recorded before it is read, so the index is not used
+    if the file changes while it is being written."""
+    
+    @args(void, [File])
+    def write(self, target):
+    
+        mtime = self.file.lastModified()
+        spritefile = Spritefile(self.file)
+        names = LinkedList(spritefile.sprites.keySet())
+        Collections.sort(names)
+        count = len(names)
+        
+        thumb_bytes = self.thumb_size * self.thumb_size * 4
+        records = SpriteIndex.HEADER
+        thumbs = records + (count * SpriteIndex.RECORD)
+        
+        header = ByteBuffer.allocate(SpriteIndex.HEADER)
+        header.order(ByteOrder.LITTLE_ENDIAN)
+        header.putInt(SpriteIndex.MAGIC)
+        header.putInt(SpriteIndex.VERSION)
+        header.putLong(self.file.length())
+        header.putInt(SpriteIndex.checksum(self.file))
+        header.putInt(count)
+        header.putInt(self.thumb_size)
+        header.putInt(records)
+        header.putInt(thumbs)
+        header.putInt(SpriteIndex.stamp(mtime))
+        
+        # The records and thumbnails are written to separate files that are
+        # combined afterwards so that each sprite is only decoded once.
+        temp = File(target.getPath() + ".tmp")
+        thumb_temp = File(target.getPath() + ".thumbs")
+        
+        stream = BufferedOutputStream(FileOutputStream(temp))
+        stream.write(header.array())
+        thumb_stream = BufferedOutputStream(FileOutputStream(thumb_temp))
+        
+        record = ByteBuffer.allocate(SpriteIndex.RECORD)
+        record.order(ByteOrder.LITTLE_ENDIAN)
+        pixels = ByteBuffer.allocate(thumb_bytes)
+        
+        f = RandomAccessFile(self.file, "r")
+        
+        for name in names:
+        
+            sprite = spritefile.sprites[name]
+            record.clear()
+            pixels.clear()
+            
+            encoded = name.getBytes("ASCII")
+            for i in range(12):
+                if i < len(encoded):
+                    record.put(encoded[i])
+                else:
+                    record.put(byte(0))
+            
+            record.putInt(sprite.offset)
+            
+            thumb_width = 0
+            thumb_height = 0
+            
+            try:
+                spritefile.read_header(f, sprite)
+                
+                record.putInt(sprite.width)
+                record.putInt(sprite.height)
+                record.putInt(sprite.mode_word)
+                record.putInt(self.paletteHash(spritefile, f, sprite))
+                if sprite.mask_ptr != sprite.image_ptr:
+                    record.putInt(1)
+                else:
+                    record.putInt(0)
+                
+                thumbnail = self.thumbnail(spritefile, f, sprite)
+                thumbnail.copyPixelsToBuffer(pixels)
+                thumb_width = thumbnail.getWidth()
+                thumb_height = thumbnail.getHeight()
+            
+            except:
+                # Sprites that cannot be decoded are described by their names
+                # and offsets alone.
+                record.position(16)
+                for i in range(5):
+                    record.putInt(0)
+            
+            record.putInt((thumb_height << 16) | thumb_width)
+            stream.write(record.array())
+            thumb_stream.write(pixels.array())
+            
+            # Release the decoded pixels.
+            sprite.rgba = None
+            sprite.decoded = False
+        
+        f.close()
+        thumb_stream.close()
+        
+        # Append the thumbnails to the records.
+        data = array(byte, 65536)
+        thumb_input = FileInputStream(thumb_temp)
+        while True:
+            n = thumb_input.read(data)
+            if n == -1:
+                break
+            stream.write(data, 0, n)
+        
+        thumb_input.close()
+        stream.close()
+        thumb_temp.delete()
+        
+        if not temp.renameTo(target):
+            temp.delete()
+    
+    """The following method returns the checksum of the palette data of a
+    sprite whose header has been read, or 0 if it has no palette."""
+    
+    @args(int, [Spritefile, RandomAccessFile, Sprite])
+    def paletteHash(self, spritefile, f, sprite):
+    
+        length = sprite.image_ptr - (sprite.offset + 44)
+        if length <= 0:
+            return 0
+        
+        crc = CRC32()
+        crc.update(spritefile.read_block(f, sprite.offset + 44, length))
+        return int(crc.getValue())
+    
+    """This method decodes a sprite and scales it to fit the thumbnail size,
+    correcting its aspect ratio in the same way as the sprite browser."""
+    
+    @args(Bitmap, [Spritefile, RandomAccessFile, Sprite])
+    def thumbnail(self, spritefile, f, sprite):
+    
+        spritefile.decode(f, sprite)
+        
+        bitmap = Bitmap.createBitmap(sprite.width, sprite.height,
+                                     Bitmap.Config.ARGB_8888)
+        bitmap.copyPixelsFromBuffer(ByteBuffer.wrap(sprite.rgba))
+        
+        width = sprite.width
+        height = sprite.height
+        if sprite.ydpi < sprite.xdpi:
+            height = height * (sprite.xdpi / sprite.ydpi)
+        
+        scale = Math.min(self.thumb_size / float(width),
+                         self.thumb_size / float(height))
+        scale = Math.min(scale, 1.0)
+        
+        tw = Math.max(1, int(width * scale))
+        th = Math.max(1, int(height * scale))
+        
+        return Bitmap.createScaledBitmap(bitmap, tw, th, True)
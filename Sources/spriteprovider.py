@@ -0,0 +1,313 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `spriteprovider` module provides a content provider that lets other
+applications read sprites as PNG images without them being written to files."""
+
+from java.io import BufferedInputStream, ByteArrayOutputStream, File, \
+                    FileNotFoundException, OutputStream
+from java.lang import String, Thread
+from java.util.concurrent import ConcurrentHashMap, ConcurrentLinkedQueue
+from java.util.concurrent.atomic import AtomicInteger
+
+from android.content import ContentProvider
+from android.database import MatrixCursor
+from android.graphics import Bitmap
+from android.net import Uri
+from android.os import ParcelFileDescriptor
+from android.provider import OpenableColumns
+
+from spritebrowser import SpriteRenderer
+from spritefile import Sprite, Spritefile, SpriteStream
+
+"""The following class serves sprites using URIs with two path segments: the
+spritefile containing the sprite, given as a file path or as the content URI it
+was opened from, and the name of the sprite. Each sprite is encoded as a PNG
+image in a background thread as the receiving application reads it from a
+pipe, so the image is never written to storage.
+
+The sprite is decoded before the pipe is returned, so that a request for a
+sprite that does not exist or cannot be decoded fails instead of producing an
+empty image.
+
+The most recently served images are kept so that a sprite can be read again,
+by the same application or another one, without being decoded and encoded a
+second time. The total size of the images kept is limited. Images are cached
+using keys that include the modification time and length of the spritefile,
+so images of sprites in files that have changed are not served."""
+
+class SpriteProvider(ContentProvider):
+
+    __fields__ = {
+        "cache": ConcurrentHashMap(String, [byte]),
+        "keys": ConcurrentLinkedQueue(String),
+        "cache_bytes": AtomicInteger
+        }
+    
+    AUTHORITY = "uk.org.boddie.spriteviewer.sprites"
+    
+    # The maximum number of bytes of encoded images kept.
+    cache_budget = 4194304
+    
+    def __init__(self):
+    
+        ContentProvider.__init__(self)
+    
+    def onCreate(self):
+    
+        self.cache = ConcurrentHashMap()
+        self.keys = ConcurrentLinkedQueue()
+        self.cache_bytes = AtomicInteger(0)
+        return True
+    
+    """The following method returns a URI that refers to the sprite with the
+    given name in the spritefile with the given path or content URI."""
+    
+    @static
+    @args(Uri, [String, String])
+    def uriFor(source, name):
+    
+        builder = Uri.Builder()
+        builder.scheme("content")
+        builder.authority(SpriteProvider.AUTHORITY)
+        builder.appendPath(source)
+        builder.appendPath(name)
+        return builder.build()
+    
+    def getType(self, uri):
+    
+        return "image/png"
+    
+    """Receiving applications query the provider for a display name and, if the
+    image has already been encoded, its size."""
+    
+    def query(self, uri, projection, selection, selectionArgs, sortOrder):
+    
+        name = uri.getLastPathSegment() + ".png"
+        data = self.cache.get(self.cacheKey(uri))
+        
+        if data != None:
+            cursor = MatrixCursor(array([OpenableColumns.DISPLAY_NAME,
+                                         OpenableColumns.SIZE]))
+            cursor.addRow(array([name, String.valueOf(len(data))]))
+        else:
+            cursor = MatrixCursor(array([OpenableColumns.DISPLAY_NAME]))
+            cursor.addRow(array([name]))
+        
+        return cursor
+    
+    """The provider is read-only, so the following methods do nothing."""
+    
+    def insert(self, uri, values):
+        return None
+    
+    def update(self, uri, values, selection, selectionArgs):
+        return 0
+    
+    def delete(self, uri, selection, selectionArgs):
+        return 0
+    
+    """This method returns the reading end of a pipe and starts a thread that
+    writes the image to the other end, either from the cache or by encoding
+    the sprite. If the image is not cached, the sprite is decoded first and a
+    `FileNotFoundException` is thrown if it cannot be found or decoded."""
+    
+    def openFile(self, uri, mode):
+    
+        segments = uri.getPathSegments()
+        if len(segments) != 2:
+            raise FileNotFoundException(uri.toString())
+        
+        key = self.cacheKey(uri)
+        data = self.getCached(key)
+        sprite = None
+        
+        if data == None:
+            try:
+                sprite = self.loadSprite(segments[0], segments[1])
+            except:
+                sprite = None
+            
+            if sprite == None:
+                raise FileNotFoundException(uri.toString())
+        
+        pipe = ParcelFileDescriptor.createPipe()
+        output = ParcelFileDescriptor.AutoCloseOutputStream(pipe[1])
+        
+        SpriteEncoder(self, key, data, sprite, output).start()
+        return pipe[0]
+    
+    """The following method returns the key used to cache the image for the
+    given URI. It includes the modification time and length of the spritefile
+    or, for spritefiles given as content URIs, whichever of these the
+    application that supplied the spritefile reports."""
+    
+    @args(String, [Uri])
+    def cacheKey(self, uri):
+    
+        source = uri.getPathSegments()[0]
+        
+        if not source.startsWith("content:"):
+            file = File(source)
+            return uri.toString() + "#" + \
+                   String.valueOf(file.lastModified()) + "-" + \
+                   String.valueOf(file.length())
+        
+        key = uri.toString() + "#"
+        
+        try:
+            resolver = self.getContext().getContentResolver()
+            cursor = resolver.query(Uri.parse(source), None, None, None, None)
+            if cursor != None:
+                if cursor.moveToFirst():
+                    # Document providers report modification times in this
+                    # column.
+                    i = cursor.getColumnIndex("last_modified")
+                    if i != -1:
+                        key += cursor.getString(i)
+                    i = cursor.getColumnIndex(OpenableColumns.SIZE)
+                    if i != -1:
+                        key += "-" + cursor.getString(i)
+                cursor.close()
+        except:
+            pass
+        
+        return key
+    
+    """The following methods look up and add images in the cache. The oldest
+    images are discarded when the cache is too large."""
+    
+    @args([byte], [String])
+    def getCached(self, key):
+    
+        return self.cache.get(key)
+    
+    @args(void, [String, [byte]])
+    def addCached(self, key, data):
+    
+        if len(data) > self.cache_budget:
+            return
+        
+        if self.cache.putIfAbsent(key, data) != None:
+            return
+        
+        self.keys.add(key)
+        
+        if self.cache_bytes.addAndGet(len(data)) > self.cache_budget:
+            while self.cache_bytes.get() > self.cache_budget:
+                evicted = self.keys.poll()
+                if evicted == None:
+                    break
+                removed = self.cache.remove(evicted)
+                if removed != None:
+                    self.cache_bytes.addAndGet(-len(removed))
+    
+    """This method decodes the named sprite from a spritefile, reading it from
+    a stream if the spritefile is given as a content URI."""
+    
+    @args(Sprite, [String, String])
+    def loadSprite(self, source, name):
+    
+        if not source.startsWith("content:"):
+            return Spritefile(File(source)).getSprite(name)
+        
+        resolver = self.getContext().getContentResolver()
+        stream = SpriteStream(BufferedInputStream(
+            resolver.openInputStream(Uri.parse(source))))
+        sprite = None
+        
+        while True:
+            data = stream.read_sprite()
+            if data == None:
+                break
+            elif stream.read_name(data).equals(name):
+                sprite = stream.decode(data)
+                break
+        
+        stream.close()
+        return sprite
+
+
+"""The following class writes a PNG image of a sprite to the pipe returned by
+the provider, either from an image that was cached or by encoding a decoded
+sprite. Newly encoded images are written to the pipe as they are produced and
+are also collected so that they can be added to the provider's cache."""
+
+class SpriteEncoder(Thread):
+
+    __fields__ = {"provider": SpriteProvider, "key": String, "data": [byte],
+                  "sprite": Sprite, "output": OutputStream}
+    
+    @args(void, [SpriteProvider, String, [byte], Sprite, OutputStream])
+    def __init__(self, provider, key, data, sprite, output):
+    
+        Thread.__init__(self)
+        self.provider = provider
+        self.key = key
+        self.data = data
+        self.sprite = sprite
+        self.output = output
+    
+    def run(self):
+    
+        try:
+            if self.data != None:
+                self.output.write(self.data)
+            else:
+                copy = ByteArrayOutputStream()
+                bitmap = SpriteRenderer.spriteBitmap(self.sprite)
+                bitmap.compress(Bitmap.CompressFormat.PNG, 50,
+                                CopyingStream(self.output, copy))
+                self.provider.addCached(self.key, copy.toByteArray())
+        except:
+            # The receiver stopped reading, so it will only see the data
+            # written so far.
+            pass
+        
+        try:
+            self.output.close()
+        except:
+            pass
+
+
+"""The following class passes data written to it to another stream, keeping a
+copy of it."""
+
+class CopyingStream(OutputStream):
+
+    __fields__ = {"output": OutputStream, "copy": ByteArrayOutputStream}
+    
+    @args(void, [OutputStream, ByteArrayOutputStream])
+    def __init__(self, output, copy):
+    
+        OutputStream.__init__(self)
+        self.output = output
+        self.copy = copy
+    
+    @args(void, [int])
+    def write(self, value):
+    
+        self.output.write(value)
+        self.copy.write(value)
+    
+    @args(void, [[byte], int, int])
+    def write(self, data, offset, length):
+    
+        self.output.write(data, offset, length)
+        self.copy.write(data, offset, length)
+    
+    def flush(self):
+    
+        self.output.flush()
@@ -16,21 +16,29 @@
 """The `spriteviewer` module provides the main activity class for the Sprite
 Viewer application."""
 
-from java.lang import String
+from java.lang import CharSequence, Object, String
 from java.io import BufferedOutputStream, File, FileOutputStream
+from java.util import List
 
-from android.content import Intent
+from android.app import AlertDialog
+from android.content import DialogInterface, Intent
 from android.graphics import Bitmap
 from android.os import Environment
-from android.net import Uri
 from android.view import Menu
-from android.widget import AdapterView, Toast
+from android.widget import AdapterView, EditText, Toast
 
 from serpentine.activities import Activity
 from serpentine.files import Files
 
+from benchmark import BenchmarkTask
+from fuzz import FuzzTask
+from catalogue import Catalogue, CatalogueEntry, CatalogueIndexer
 from filebrowser import FileBrowser, FileOpenInterface
-from spritebrowser import SpriteBrowser
+from simulation import SimulationRunner
+from spritebrowser import SpriteBrowser, SpriteListener, SpriteRenderer
+from spritefile import Sprite
+from spriteprovider import SpriteProvider
+from tileview import TileView
 
 """The `SpriteViewerActivity` class represents the application and defines the
 high level parts of the user interface using classes from the
@@ -42,19 +50,34 @@ class SpriteViewerActivity(Activity):
 
     __interfaces__ = [FileOpenInterface]
     
-    __fields__ = {"temp_file": File}
+    __fields__ = {
+        "tileView": TileView,
+        "fileBrowser": FileBrowser,
+        "spriteBrowser": SpriteBrowser,
+        "catalogue": Catalogue,
+        "profile": bool,
+        "trace": bool
+        }
     
     def __init__(self):
     
         Activity.__init__(self)
         self.showing = "files"
-        self.temp_file = None
+        self.tileView = None
+        self.fileBrowser = None
+        self.spriteBrowser = None
+        self.catalogue = None
     
     """We reimplement the `onCreate` method to provide a user interface for the
     application and to record how the application was started. If it was
     launched normally, it will show a file browser. If it was run as the result
     of opening a spritefile in a file manager application, it will show the
-    sprites contained in that spritefile."""
+    sprites contained in that spritefile, reading it directly from a stream if
+    it was supplied as a content URI.
+    
+    Only the browser that is shown first is created here, so that the first
+    frame is not delayed by building views that the user may never see. The
+    other browser is created when it is first needed."""
     
     def onCreate(self, bundle):
     
@@ -62,18 +85,16 @@ class SpriteViewerActivity(Activity):
         
         self.resources = self.getResources()
         
-        self.fileBrowser = FileBrowser(self)
-        self.fileBrowser.setHandler(self)
-        
-        self.spriteBrowser = SpriteBrowser(self)
-        self.registerForContextMenu(self.spriteBrowser.getGrid())
-        
-        self.setContentView(self.fileBrowser)
-        
         # Obtain the intent that caused the activity to be started and define
         # the initial view to be displayed.
         intent = self.getIntent()
         
+        # Enable profiling if requested, optionally reporting each phase of
+        # sprite reading and rendering as a section in system traces. The
+        # options are applied when the sprite browser is created.
+        self.profile = intent.getBooleanExtra("profile", False)
+        self.trace = intent.getBooleanExtra("trace", False)
+        
         self.initial_view = "files"
         
         # If the application was started with an intent requesting a view
@@ -85,24 +106,103 @@ class SpriteViewerActivity(Activity):
             if uri.getScheme() == "file":
                 self.initial_view = "sprites"
                 self.handleFileOpen(File(uri.getPath()))
+            
+            # Content URIs are read as streams instead of being copied to
+            # files first.
+            elif uri.getScheme() == "content":
+                self.initial_view = "sprites"
+                self.getSpriteBrowser().openUri(uri)
+                self.showing = "sprites"
+                self.setContentView(self.spriteBrowser)
+        
+        if self.initial_view == "files":
+            self.setContentView(self.getFileBrowser())
+        
+        # If the intent asks for the decoder benchmark to be run then generate
+        # a corpus of spritefiles in the cache directory and measure how
+        # quickly they are read, logging the results.
+        if intent.getBooleanExtra("benchmark", False):
+            BenchmarkTask(File(self.getCacheDir(), "benchmark")).start()
+        
+        # Check that corrupt spritefiles are rejected or read within fixed
+        # limits on time and memory if requested.
+        if intent.getBooleanExtra("fuzz", False):
+            FuzzTask(File(self.getCacheDir(), "fuzz")).start()
+        
+        # Similarly, run the simulation of the sprite adapter's scheduling and
+        # caching policies for different ways of scrolling if requested.
+        if intent.getBooleanExtra("simulate", False):
+            SimulationRunner(self).start()
+    
+    """The following methods create the file browser, the sprite browser and
+    the catalogue when they are first needed. The catalogue is kept up to date
+    with the spritefiles that the file browser finds, so that sprites can be
+    found by name."""
+    
+    @args(FileBrowser, [])
+    def getFileBrowser(self):
+    
+        if self.fileBrowser == None:
+            self.fileBrowser = FileBrowser(self)
+            self.fileBrowser.setHandler(self)
+            self.fileBrowser.addDiscoveryListener(
+                CatalogueIndexer(self.getCatalogue()))
+        
+        return self.fileBrowser
+    
+    @args(SpriteBrowser, [])
+    def getSpriteBrowser(self):
+    
+        if self.spriteBrowser == None:
+            self.spriteBrowser = SpriteBrowser(self)
+            self.registerForContextMenu(self.spriteBrowser.getGrid())
+            
+            profiler = self.spriteBrowser.getProfiler()
+            profiler.setEnabled(self.profile)
+            profiler.setTracing(self.trace)
+            if profiler.tracing:
+                profiler.setEnabled(True)
+        
+        return self.spriteBrowser
+    
+    @args(Catalogue, [])
+    def getCatalogue(self):
+    
+        if self.catalogue == None:
+            self.catalogue = Catalogue(self)
+        
+        return self.catalogue
+    
+    """The file browser watches for changes to the directory it shows while the
+    activity is in the foreground. If it has not been created, there is nothing
+    to watch. Similarly, the sprite browser only renders previews in the
+    background while the activity is in the foreground."""
     
     def onResume(self):
     
         Activity.onResume(self)
+        if self.fileBrowser != None:
+            self.fileBrowser.rescan()
+        if self.spriteBrowser != None:
+            self.spriteBrowser.resume()
     
     def onPause(self):
     
         Activity.onPause(self)
+        if self.fileBrowser != None:
+            self.fileBrowser.stopWatching()
+        if self.spriteBrowser != None:
+            self.spriteBrowser.pause()
     
-    """The reimplementation of the `onStop` method checks for the presence of
-    a temporary file and deletes it."""
+    """The reimplementation of the `onStop` method writes any profiling
+    measurements to the system log."""
     
     def onStop(self):
     
         Activity.onStop(self)
         
-        if self.temp_file != None:
-            self.temp_file.delete()
+        if self.spriteBrowser != None:
+            self.spriteBrowser.getProfiler().dump("SpriteViewer")
     
     """The following method is used to respond to configuration changes, such
     as those caused by an orientation change, calling a custom method in the
@@ -111,21 +211,27 @@ class SpriteViewerActivity(Activity):
     def onConfigurationChanged(self, config):
     
         Activity.onConfigurationChanged(self, config)
-        self.spriteBrowser.updateLayout(config.screenWidthDp)
+        if self.spriteBrowser != None:
+            self.spriteBrowser.updateLayout(config.screenWidthDp)
     
     """We reimplement the `onBackPressed` method to change the usual behaviour
     of the interface. If the view being displayed is the same as the one shown
-    when the application started then the standard behaviour is used. Otherwise
-    we show the file browser."""
+    when the application started then the standard behaviour is used. A sprite
+    shown at full size is replaced by the sprite browser. Otherwise we show the
+    file browser."""
     
     def onBackPressed(self):
     
+        if self.showing == "sprite":
+            self.showing = "sprites"
+            self.setContentView(self.spriteBrowser)
+        
         # If showing the initial view then exit, otherwise show the file browser.
-        if self.showing == self.initial_view:
+        elif self.showing == self.initial_view:
             Activity.onBackPressed(self)
         else:
             self.showing = "files"
-            self.fileBrowser.rescan()
+            self.getFileBrowser().rescan()
             self.setContentView(self.fileBrowser)
     
     """The following method is used to handle file open requests from the
@@ -134,60 +240,168 @@ class SpriteViewerActivity(Activity):
     
     def handleFileOpen(self, file):
     
-        self.spriteBrowser.openFile(file)
+        self.getSpriteBrowser().openFile(file)
         self.showing = "sprites"
         self.setContentView(self.spriteBrowser)
     
+    """We provide an options menu containing an item that lets the user search
+    for sprites by name and an item that toggles the performance overlay shown
+    on top of the sprite grid."""
+    
+    def onCreateOptionsMenu(self, menu):
+    
+        self.findItem = menu.add(Menu.NONE, 4, Menu.NONE, "Find sprite")
+        self.overlayItem = menu.add(Menu.NONE, 3, Menu.NONE,
+                                    "Performance overlay")
+        self.overlayItem.setCheckable(True)
+        return True
+    
+    def onOptionsItemSelected(self, item):
+    
+        if item.getItemId() == self.findItem.getItemId():
+            self.showSearch()
+            return True
+        
+        elif item.getItemId() == self.overlayItem.getItemId():
+            visible = not self.getSpriteBrowser().isOverlayVisible()
+            self.spriteBrowser.setOverlayVisible(visible)
+            item.setChecked(visible)
+            return True
+        
+        return False
+    
+    """The following method shows a dialog that asks the user for the start of
+    the name of a sprite to search for."""
+    
+    def showSearch(self):
+    
+        text = EditText(self)
+        text.setSingleLine(True)
+        
+        builder = AlertDialog.Builder(self)
+        builder.setTitle("Find sprite")
+        builder.setView(text)
+        builder.setPositiveButton("Find", SearchListener(self, text))
+        builder.setNegativeButton("Cancel", None)
+        builder.show()
+    
+    """This method searches the catalogue for sprites whose names start with
+    the given text, showing the results in a dialog that lets the user open the
+    file containing one of them."""
+    
+    @args(void, [String])
+    def findSprites(self, text):
+    
+        results = self.getCatalogue().search(text, 200)
+        
+        if len(results) == 0:
+            Toast.makeText(self, "No sprites found", Toast.LENGTH_SHORT).show()
+            return
+        
+        labels = array(CharSequence, len(results))
+        i = 0
+        for entry in results:
+            labels[i] = entry.name + " (" + File(entry.path).getName() + \
+                ", " + String.valueOf(entry.width) + "x" + \
+                String.valueOf(entry.height) + ")"
+            i += 1
+        
+        builder = AlertDialog.Builder(self)
+        builder.setTitle("Sprites")
+        builder.setItems(labels, ResultListener(self, results))
+        builder.show()
+    
+    """The following method opens the file containing a sprite found by a
+    search and scrolls the sprite browser to show it."""
+    
+    @args(void, [File, String])
+    def showSprite(self, file, name):
+    
+        self.handleFileOpen(file)
+        self.spriteBrowser.showSprite(name)
+    
     """We support the creation of a context menu with the following method
-    which defines two menu items, storing them for later checks when a menu
+    which defines three menu items, storing them for later checks when a menu
     item is selected by the user."""
     
     def onCreateContextMenu(self, menu, view, menuInfo):
     
         self.viewItem = menu.add(Menu.NONE, 1, Menu.NONE, "Show full size")
         self.saveItem = menu.add(Menu.NONE, 2, Menu.NONE, "Save as PNG")
+        self.shareItem = menu.add(Menu.NONE, 3, Menu.NONE, "Share")
     
-    """When a menu item is selected, we check it against the two defined items
-    and either show the current sprite in an external application or save it to
-    a file, depending on which item was selected."""
+    """When a menu item is selected, we check it against the defined items and
+    either show the current sprite at full size, save it to a file or share it
+    with another application, depending on which item was selected. Sprites to
+    be shown or saved are decoded in the background, ahead of any previews
+    being rendered, and the action is performed when the sprite is ready."""
     
     def onContextItemSelected(self, item):
     
         menuInfo = CAST(item.getMenuInfo(), AdapterView.AdapterContextMenuInfo)
         position = menuInfo.position
         
-        if item.getItemId() == self.viewItem.getItemId():
-            self.viewSprite(self.spriteBrowser.getSpriteBitmap(position))
+        if item.getItemId() == self.viewItem.getItemId() or \
+           item.getItemId() == self.saveItem.getItemId():
+            self.spriteBrowser.requestSprite(position, SpriteAction(self,
+                item.getItemId(), self.spriteBrowser.getSpriteFileName()))
             return True
         
-        elif item.getItemId() == self.saveItem.getItemId():
-            self.saveSprite(self.spriteBrowser.getSpriteFileName(),
-                            self.spriteBrowser.getSpriteName(position),
-                            self.spriteBrowser.getSpriteBitmap(position))
+        elif item.getItemId() == self.shareItem.getItemId():
+            self.shareSprite(self.spriteBrowser.getSpriteSource(),
+                             self.spriteBrowser.getSpriteName(position))
             return True
         
         return False
     
-    """The following method is used to handle sprite view requests. It saves
-    the `Bitmap` passed to the method to a PNG file in the device's external
-    storage. Finally, it broadcasts an intent to request that the newly saved
-    file be displayed by a suitable application."""
+    """The following method is called when a sprite requested from the context
+    menu has been decoded. Sprites to be shown are only shown if the user is
+    still looking at the sprites in the file."""
     
-    @args(void, [Bitmap])
-    def viewSprite(self, bitmap):
+    @args(void, [int, String, String, Sprite])
+    def spriteDecoded(self, action, spritefileName, name, sprite):
     
-        self.temp_file = Files.createExternalFile(Environment.DIRECTORY_DOWNLOADS,
-            "SpriteViewer", ".temp", "", ".png")
+        if sprite == None:
+            Toast.makeText(self, "Cannot read " + name,
+                           Toast.LENGTH_SHORT).show()
         
-        stream = BufferedOutputStream(FileOutputStream(self.temp_file))
-        bitmap.compress(Bitmap.CompressFormat.PNG, 50, stream)
-        stream.flush()
-        # Closing the file with close() will cause an exception.
+        elif action == self.viewItem.getItemId():
+            if self.showing == "sprites":
+                self.viewSprite(sprite)
+        
+        else:
+            self.saveSprite(spritefileName, name,
+                            SpriteRenderer.spriteBitmap(sprite))
+    
+    """The following method is used to handle sprite view requests. It shows
+    the decoded sprite in a view that lets the user pan and zoom it, creating
+    the view when it is first needed. The view draws the sprite directly from
+    its decoded pixels, so no image file needs to be written or read."""
+    
+    @args(void, [Sprite])
+    def viewSprite(self, sprite):
+    
+        if self.tileView == None:
+            self.tileView = TileView(self)
         
-        intent = Intent()
-        intent.setAction(Intent.ACTION_VIEW)
-        intent.setDataAndType(Uri.parse("file://" + self.temp_file.getPath()), "image/png")
-        self.startActivity(intent)
+        self.tileView.setSprite(sprite)
+        self.showing = "sprite"
+        self.setContentView(self.tileView)
+    
+    """The following method lets the user send a sprite to another application.
+    The sprite is referred to by a URI handled by the application's content
+    provider, which encodes it as a PNG image while the receiving application
+    reads it, so no file needs to be written first."""
+    
+    @args(void, [String, String])
+    def shareSprite(self, source, name):
+    
+        intent = Intent(Intent.ACTION_SEND)
+        intent.setType("image/png")
+        intent.putExtra(Intent.EXTRA_STREAM,
+                        SpriteProvider.uriFor(source, name))
+        intent.addFlags(Intent.FLAG_GRANT_READ_URI_PERMISSION)
+        self.startActivity(Intent.createChooser(intent, "Share " + name))
     
     """This method saves a PNG file to a subdirectory of the `SpriteViewer`
     directory in the device's external storage. It shows a transient message
@@ -208,3 +422,75 @@ class SpriteViewerActivity(Activity):
         stream.flush()
         
         Toast.makeText(self, "Saved " + outputFile.getPath(), Toast.LENGTH_LONG).show()
+
+
+"""The following class responds to the button in the search dialog by asking
+the activity to search for sprites using the text entered by the user."""
+
+class SearchListener(Object):
+
+    __interfaces__ = [DialogInterface.OnClickListener]
+    
+    __fields__ = {"activity": SpriteViewerActivity, "text": EditText}
+    
+    @args(void, [SpriteViewerActivity, EditText])
+    def __init__(self, activity, text):
+    
+        Object.__init__(self)
+        self.activity = activity
+        self.text = text
+    
+    @args(void, [DialogInterface, int])
+    def onClick(self, dialog, which):
+    
+        self.activity.findSprites(self.text.getText().toString())
+
+
+"""The following class receives a sprite requested from the context menu and
+passes it to the activity together with the menu action that requested it and
+the name of the file that contains it."""
+
+class SpriteAction(Object):
+
+    __interfaces__ = [SpriteListener]
+    
+    __fields__ = {"activity": SpriteViewerActivity, "action": int,
+                  "spritefileName": String}
+    
+    @args(void, [SpriteViewerActivity, int, String])
+    def __init__(self, activity, action, spritefileName):
+    
+        Object.__init__(self)
+        self.activity = activity
+        self.action = action
+        self.spritefileName = spritefileName
+    
+    @args(void, [String, Sprite])
+    def spriteDecoded(self, name, sprite):
+    
+        self.activity.spriteDecoded(self.action, self.spritefileName, name,
+                                    sprite)
+
+
+"""This class responds to the selection of a sprite in the list of search
+results by asking the activity to show it."""
+
+class ResultListener(Object):
+
+    __interfaces__ = [DialogInterface.OnClickListener]
+    
+    __fields__ = {"activity": SpriteViewerActivity,
+                  "results": List(CatalogueEntry)}
+    
+    @args(void, [SpriteViewerActivity, List(CatalogueEntry)])
+    def __init__(self, activity, results):
+    
+        Object.__init__(self)
+        self.activity = activity
+        self.results = results
+    
+    @args(void, [DialogInterface, int])
+    def onClick(self, dialog, which):
+    
+        entry = self.results[which]
+        self.activity.showSprite(File(entry.path), entry.name)
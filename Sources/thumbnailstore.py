@@ -0,0 +1,249 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `thumbnailstore` module provides a class for keeping previews of sprites
+in the application's storage so that they can be shown again without decoding
+the sprites."""
+
+from java.io import BufferedOutputStream, File, FileOutputStream
+from java.lang import Integer, Long, Object, String, System
+from java.util.concurrent import ConcurrentHashMap
+
+from android.graphics import Bitmap, BitmapFactory
+from android.net import Uri
+
+"""The following class stores previews as PNG images in a directory, usually
+in the application's cache directory so that the system can remove them when
+it needs space. The previews of each spritefile are kept in a subdirectory
+whose name is derived from the path, modification time and length of the
+file, so previews of a file that has changed are not used. Each preview size
+has its own directory within that.
+
+Spritefiles are referred to by the names of their subdirectories, which are
+obtained using the `folderName` method when each file is opened. The store
+keeps a table of the previews it holds so that views can find out whether a
+preview is stored without accessing storage. The previews of a spritefile are
+added to the table by the `scan` method, which should be called in a
+background thread. Previews can be stored and loaded from any thread.
+
+The total size of the stored previews is limited. When it is exceeded, the
+previews of the spritefiles that were least recently scanned are removed."""
+
+class ThumbnailStore(Object):
+
+    __fields__ = {
+        "directory": File,
+        "files": ConcurrentHashMap(String, File),
+        "listed": ConcurrentHashMap(String, File)
+        }
+    
+    # The maximum number of bytes of stored previews.
+    budget = 33554432
+    
+    @args(void, [File])
+    def __init__(self, directory):
+    
+        Object.__init__(self)
+        
+        self.directory = directory
+        self.files = ConcurrentHashMap()
+        self.listed = ConcurrentHashMap()
+    
+    """The following method returns the name of the subdirectory that holds
+    the previews of the given spritefile with the given modification time and
+    length."""
+    
+    @static
+    @args(String, [File, long, long])
+    def folderName(file, mtime, length):
+    
+        return Integer.toHexString(file.getPath().hashCode()) + "-" + \
+               Long.toHexString(mtime) + "-" + Long.toHexString(length)
+    
+    """This method returns the key used to refer to the preview of the named
+    sprite with the given size in the subdirectory with the given name."""
+    
+    @args(String, [String, int, String])
+    def key(self, folder, size, name):
+    
+        return folder + "/" + String.valueOf(size) + "/" + name
+    
+    """The following method adds the previews already stored for a spritefile
+    to the table, if they have not been added before, and marks them as the
+    most recently used."""
+    
+    @args(void, [String])
+    def scan(self, folder):
+    
+        folderDir = File(self.directory, folder)
+        folderDir.setLastModified(System.currentTimeMillis())
+        
+        if self.listed.putIfAbsent(folder, folderDir) != None:
+            return
+        
+        sizeDirs = folderDir.listFiles()
+        if sizeDirs == None:
+            return
+        
+        for sizeDir in sizeDirs:
+        
+            stored = sizeDir.listFiles()
+            if stored == None:
+                continue
+            
+            try:
+                size = Integer.parseInt(sizeDir.getName())
+            except:
+                continue
+            
+            for storedFile in stored:
+                fileName = storedFile.getName()
+                if fileName.endsWith(".png"):
+                    name = Uri.decode(fileName.substring(0, len(fileName) - 4))
+                    self.files.put(self.key(folder, size, name), storedFile)
+    
+    """This method reports whether the preview of the named sprite in the given
+    spritefile is stored with the given size. Only previews in the table are
+    found."""
+    
+    @args(bool, [String, int, String])
+    def contains(self, folder, size, name):
+    
+        return self.files.containsKey(self.key(folder, size, name))
+    
+    """The following method returns a mutable bitmap containing the stored
+    preview of a sprite, or `None` if it is not stored or cannot be read."""
+    
+    @args(Bitmap, [String, int, String])
+    def load(self, folder, size, name):
+    
+        key = self.key(folder, size, name)
+        stored = self.files.get(key)
+        if stored == None:
+            return None
+        
+        options = BitmapFactory.Options()
+        options.inMutable = True
+        bitmap = BitmapFactory.decodeFile(stored.getPath(), options)
+        
+        if bitmap == None:
+            self.files.remove(key)
+        
+        return bitmap
+    
+    """This method stores the preview of a sprite. The image is written to a
+    temporary file that is renamed when it is complete, so a preview that is
+    only partly written is never loaded."""
+    
+    @args(void, [String, int, String, Bitmap])
+    def save(self, folder, size, name, bitmap):
+    
+        sizeDir = File(File(self.directory, folder), String.valueOf(size))
+        sizeDir.mkdirs()
+        
+        fileName = Uri.encode(name)
+        temp = File(sizeDir, fileName + ".tmp")
+        stored = File(sizeDir, fileName + ".png")
+        
+        stream = BufferedOutputStream(FileOutputStream(temp))
+        bitmap.compress(Bitmap.CompressFormat.PNG, 100, stream)
+        stream.close()
+        
+        if temp.renameTo(stored):
+            self.files.put(self.key(folder, size, name), stored)
+        else:
+            temp.delete()
+    
+    """The following method removes the previews of the least recently scanned
+    spritefiles until the stored previews fit within the budget. The previews
+    in the given subdirectory are kept."""
+    
+    @args(void, [String])
+    def trim(self, keep):
+    
+        folderDirs = self.directory.listFiles()
+        if folderDirs == None:
+            return
+        
+        total = long(0)
+        sizes = array(long, len(folderDirs))
+        
+        for i in range(len(folderDirs)):
+            sizes[i] = self.folderBytes(folderDirs[i])
+            total += sizes[i]
+        
+        while total > long(self.budget):
+        
+            # Find the least recently scanned folder that can be removed.
+            oldest = -1
+            for i in range(len(folderDirs)):
+                if folderDirs[i] == None or \
+                   folderDirs[i].getName().equals(keep):
+                    continue
+                if oldest == -1 or folderDirs[i].lastModified() < \
+                                   folderDirs[oldest].lastModified():
+                    oldest = i
+            
+            if oldest == -1:
+                break
+            
+            self.remove(folderDirs[oldest])
+            total -= sizes[oldest]
+            folderDirs[oldest] = None
+    
+    """This method returns the number of bytes used by the files in a
+    folder."""
+    
+    @args(long, [File])
+    def folderBytes(self, folderDir):
+    
+        total = long(0)
+        
+        sizeDirs = folderDir.listFiles()
+        if sizeDirs == None:
+            return total
+        
+        for sizeDir in sizeDirs:
+            stored = sizeDir.listFiles()
+            if stored != None:
+                for storedFile in stored:
+                    total += storedFile.length()
+        
+        return total
+    
+    """The following method deletes a folder and the previews it contains,
+    removing them from the table."""
+    
+    @args(void, [File])
+    def remove(self, folderDir):
+    
+        folder = folderDir.getName()
+        self.listed.remove(folder)
+        
+        it = self.files.keySet().iterator()
+        while it.hasNext():
+            if it.next().startsWith(folder + "/"):
+                it.remove()
+        
+        sizeDirs = folderDir.listFiles()
+        if sizeDirs != None:
+            for sizeDir in sizeDirs:
+                stored = sizeDir.listFiles()
+                if stored != None:
+                    for storedFile in stored:
+                        storedFile.delete()
+                sizeDir.delete()
+        
+        folderDir.delete()
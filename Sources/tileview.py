@@ -0,0 +1,469 @@
+# Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The `tileview` module provides a view for showing a single sprite at full
+size, allowing the user to pan and zoom it."""
+
+from java.lang import Math, Object, Runnable
+from java.nio import ByteBuffer
+from java.util import HashSet, Map, Queue, Set
+from java.util.concurrent import Executor, Executors
+from java.util.concurrent.atomic import AtomicInteger
+
+from android.content import Context
+from android.graphics import Bitmap, Canvas, Color, Paint, Rect
+from android.view import GestureDetector, MotionEvent, \
+                         ScaleGestureDetector, View
+
+from spritefile import Sprite
+
+"""The following class displays a decoded sprite, letting the user drag it
+around and pinch to zoom in and out. Instead of creating a bitmap for the whole
+sprite at its current size, the view divides the sprite into square tiles for
+each zoom level and only creates the tiles that are visible. Tiles are made
+directly from the pixels of the decoded sprite and are kept in a cache, keyed
+by zoom level and position, so that they can be reused as the user pans.
+
+Tiles are made in a background thread so that showing a large sprite or
+changing the zoom level does not delay drawing. Until a tile is ready, the
+part of the sprite it covers is drawn using the cached tile from the level
+above it, if there is one, and otherwise the background is left showing.
+Requests for tiles of a sprite or zoom level that is no longer shown are
+skipped.
+
+Zoom levels are powers of two. Between levels, the tiles for the level below
+the current scale are drawn slightly enlarged. Pixels are never smoothed, so
+the sprite's pixels remain sharp at large scales."""
+
+class TileView(View):
+
+    __interfaces__ = [GestureDetector.OnGestureListener,
+                      ScaleGestureDetector.OnScaleGestureListener]
+    
+    __fields__ = {
+        "sprite": Sprite, "yscale": int,
+        "scale": float, "min_scale": float,
+        "x": float, "y": float,
+        "tiles": Map(long, Bitmap), "keys": Queue(long), "capacity": int,
+        "pending": Set(long), "executor": Executor,
+        "generation": AtomicInteger, "level": int,
+        "gestures": GestureDetector, "scaler": ScaleGestureDetector,
+        "paint": Paint, "source": Rect, "target": Rect
+        }
+    
+    # The size of tiles in pixels and the largest scale that can be used.
+    tile_size = 256
+    max_scale = 32.0
+    
+    @args(void, [Context])
+    def __init__(self, context):
+    
+        View.__init__(self, context)
+        
+        self.sprite = None
+        self.tiles = {}
+        self.keys = []
+        self.capacity = 16
+        
+        self.pending = HashSet()
+        self.executor = Executors.newSingleThreadExecutor()
+        self.generation = AtomicInteger(0)
+        self.level = 0
+        
+        self.gestures = GestureDetector(context, self)
+        self.scaler = ScaleGestureDetector(context, self)
+        
+        self.paint = Paint()
+        self.paint.setFilterBitmap(False)
+        self.source = Rect()
+        self.target = Rect()
+        
+        self.setBackgroundColor(Color.argb(255, 32, 32, 32))
+    
+    """The following method sets the sprite to be shown, discarding the tiles
+    of any previous sprite and scaling the new one to fit the view."""
+    
+    @args(void, [Sprite])
+    def setSprite(self, sprite):
+    
+        self.sprite = sprite
+        self.tiles.clear()
+        self.keys.clear()
+        self.pending.clear()
+        self.generation.incrementAndGet()
+        
+        # Sprites with rectangular pixels are stretched vertically.
+        if 0 < sprite.ydpi < sprite.xdpi:
+            self.yscale = sprite.xdpi/sprite.ydpi
+        else:
+            self.yscale = 1
+        
+        self.reset()
+    
+    """This method scales the sprite to fit the view, without enlarging small
+    sprites by more than a whole number of times, and centres it."""
+    
+    @args(void, [])
+    def reset(self):
+    
+        if self.sprite == None or self.getWidth() == 0:
+            return
+        
+        fit = Math.min(self.getWidth()/float(self.sprite.width),
+                       self.getHeight()/float(self.sprite.height *
+                                              self.yscale))
+        
+        if fit > 1:
+            self.scale = float(Math.floor(fit))
+        else:
+            self.scale = fit
+        
+        self.min_scale = Math.min(self.scale, float(1))
+        
+        self.x = 0.0
+        self.y = 0.0
+        self.constrain()
+        self.invalidate()
+    
+    """The number of tiles kept depends on the size of the view, with enough
+    room for those covering the view twice."""
+    
+    def onSizeChanged(self, width, height, oldWidth, oldHeight):
+    
+        across = (width/self.tile_size) + 2
+        down = (height/self.tile_size) + 2
+        self.capacity = 2 * across * down
+        self.reset()
+    
+    """The following method keeps the sprite centred in each direction in which
+    it is smaller than the view, and otherwise prevents it from being dragged
+    away from the edges of the view."""
+    
+    @args(void, [])
+    def constrain(self):
+    
+        width = self.sprite.width * self.scale
+        height = self.sprite.height * self.yscale * self.scale
+        
+        if width <= self.getWidth():
+            self.x = (self.getWidth() - width)/2
+        else:
+            self.x = Math.max(self.getWidth() - width,
+                              Math.min(float(0), self.x))
+        
+        if height <= self.getHeight():
+            self.y = (self.getHeight() - height)/2
+        else:
+            self.y = Math.max(self.getHeight() - height,
+                              Math.min(float(0), self.y))
+    
+    """We draw the tiles of the zoom level below the current scale that cover
+    the view, requesting any that are not already cached. When the level
+    changes, requests for tiles of the previous level are abandoned."""
+    
+    def onDraw(self, canvas):
+    
+        if self.sprite == None:
+            return
+        
+        level = int(Math.floor(Math.log(self.scale)/Math.log(2.0)))
+        level_scale = Math.pow(2.0, level)
+        factor = self.scale/level_scale
+        
+        if level != self.level:
+            self.level = level
+            self.pending.clear()
+            self.generation.incrementAndGet()
+        
+        # Find the size of the sprite and the range of visible tiles at this
+        # level.
+        width = int(Math.ceil(self.sprite.width * level_scale))
+        height = int(Math.ceil(self.sprite.height * self.yscale * level_scale))
+        size = self.tile_size * factor
+        
+        tx0 = Math.max(0, int(Math.floor(-self.x/size)))
+        ty0 = Math.max(0, int(Math.floor(-self.y/size)))
+        tx1 = Math.min((width - 1)/self.tile_size,
+                       int(Math.floor((self.getWidth() - self.x)/size)))
+        ty1 = Math.min((height - 1)/self.tile_size,
+                       int(Math.floor((self.getHeight() - self.y)/size)))
+        
+        canvas.save()
+        canvas.translate(self.x, self.y)
+        canvas.scale(float(factor), float(factor))
+        
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                key = self.tileKey(level, tx, ty)
+                if self.tiles.containsKey(key):
+                    canvas.drawBitmap(self.tiles[key],
+                        float(tx * self.tile_size), float(ty * self.tile_size),
+                        self.paint)
+                else:
+                    self.requestTile(key, level_scale, width, height, tx, ty)
+                    self.drawParent(canvas, level, tx, ty)
+        
+        canvas.restore()
+    
+    """This method returns the key used to cache the tile at the given position
+    in a zoom level."""
+    
+    @args(long, [int, int, int])
+    def tileKey(self, level, tx, ty):
+    
+        return (long(level + 32) << 48) | (long(tx) << 24) | long(ty)
+    
+    """The following method asks the background thread to create the tile at
+    the given position in a zoom level, unless it has already been asked."""
+    
+    @args(void, [long, double, int, int, int, int])
+    def requestTile(self, key, level_scale, width, height, tx, ty):
+    
+        if self.pending.contains(key):
+            return
+        
+        self.pending.add(key)
+        self.executor.execute(TileTask(self, self.generation.get(), key,
+            self.sprite, self.yscale, level_scale, width, height, tx, ty))
+    
+    """This method draws the part of the cached tile from the level above the
+    given one that covers the tile at the given position, enlarged to fill the
+    tile's area, if it is cached. The canvas is already scaled for the given
+    level."""
+    
+    @args(void, [Canvas, int, int, int])
+    def drawParent(self, canvas, level, tx, ty):
+    
+        key = self.tileKey(level - 1, tx/2, ty/2)
+        if not self.tiles.containsKey(key):
+            return
+        
+        parent = self.tiles[key]
+        half = self.tile_size/2
+        sx = (tx % 2) * half
+        sy = (ty % 2) * half
+        sw = Math.min(half, parent.getWidth() - sx)
+        sh = Math.min(half, parent.getHeight() - sy)
+        
+        if sw <= 0 or sh <= 0:
+            return
+        
+        left = tx * self.tile_size
+        top = ty * self.tile_size
+        self.source.set(sx, sy, sx + sw, sy + sh)
+        self.target.set(left, top, left + (sw * 2), top + (sh * 2))
+        canvas.drawBitmap(parent, self.source, self.target, self.paint)
+    
+    """The following method is called in the main UI thread when a tile has
+    been created, adding it to the cache, discarding the oldest cached tile if
+    the cache is full, and drawing the view again. Tiles that were not created
+    because they were no longer needed, and tiles of a previous sprite, are
+    ignored."""
+    
+    @args(void, [TileTask])
+    def tileReady(self, task):
+    
+        if task.generation != self.generation.get():
+            return
+        
+        self.pending.remove(task.key)
+        if task.tile == None:
+            return
+        
+        self.tiles[task.key] = task.tile
+        self.keys.add(task.key)
+        if len(self.keys) > self.capacity:
+            self.tiles.remove(self.keys.remove())
+        
+        self.invalidate()
+    
+    """This method creates a tile by sampling the pixels of the sprite at the
+    given scale, using the nearest pixel for each pixel in the tile. Tiles at
+    the right and bottom edges of the sprite are only as large as they need to
+    be. It is called in a background thread, so it is given the sprite and its
+    vertical scale factor instead of using those held by a view."""
+    
+    @static
+    @args(Bitmap, [Sprite, int, double, int, int, int, int])
+    def createTile(sprite, yscale, level_scale, width, height, tx, ty):
+    
+        tile_size = TileView.tile_size
+        left = tx * tile_size
+        top = ty * tile_size
+        tw = Math.min(tile_size, width - left)
+        th = Math.min(tile_size, height - top)
+        
+        # Find the column in the sprite that each column of the tile shows.
+        columns = array(int, tw)
+        for i in range(tw):
+            columns[i] = Math.min(sprite.width - 1,
+                                  int((left + i)/level_scale)) * 4
+        
+        pixels = array(byte, tw * th * 4)
+        j = 0
+        
+        for y in range(th):
+        
+            row = Math.min(sprite.height - 1,
+                           int((top + y)/(level_scale * yscale)))
+            offset = row * sprite.width * 4
+            
+            for i in range(tw):
+                k = offset + columns[i]
+                pixels[j] = sprite.rgba[k]
+                pixels[j + 1] = sprite.rgba[k + 1]
+                pixels[j + 2] = sprite.rgba[k + 2]
+                pixels[j + 3] = sprite.rgba[k + 3]
+                j += 4
+        
+        tile = Bitmap.createBitmap(tw, th, Bitmap.Config.ARGB_8888)
+        tile.copyPixelsFromBuffer(ByteBuffer.wrap(pixels))
+        return tile
+    
+    """Touch events are passed to the detectors for pinch and drag gestures."""
+    
+    def onTouchEvent(self, event):
+    
+        self.scaler.onTouchEvent(event)
+        if not self.scaler.isInProgress():
+            self.gestures.onTouchEvent(event)
+        
+        return True
+    
+    """The following method zooms the sprite as the user pinches, keeping the
+    point between the user's fingers in the same place."""
+    
+    @args(bool, [ScaleGestureDetector])
+    def onScale(self, detector):
+    
+        if self.sprite == None:
+            return False
+        
+        scale = Math.max(self.min_scale, Math.min(float(self.max_scale),
+                         self.scale * detector.getScaleFactor()))
+        
+        fx = detector.getFocusX()
+        fy = detector.getFocusY()
+        self.x = fx - ((fx - self.x) * scale/self.scale)
+        self.y = fy - ((fy - self.y) * scale/self.scale)
+        self.scale = scale
+        
+        self.constrain()
+        self.invalidate()
+        return True
+    
+    @args(bool, [ScaleGestureDetector])
+    def onScaleBegin(self, detector):
+        return True
+    
+    @args(void, [ScaleGestureDetector])
+    def onScaleEnd(self, detector):
+        pass
+    
+    """Dragging the sprite moves it within the view."""
+    
+    @args(bool, [MotionEvent, MotionEvent, float, float])
+    def onScroll(self, e1, e2, distanceX, distanceY):
+    
+        if self.sprite == None:
+            return False
+        
+        self.x -= distanceX
+        self.y -= distanceY
+        self.constrain()
+        self.invalidate()
+        return True
+    
+    @args(bool, [MotionEvent])
+    def onDown(self, event):
+        return True
+    
+    @args(void, [MotionEvent])
+    def onShowPress(self, event):
+        pass
+    
+    @args(bool, [MotionEvent])
+    def onSingleTapUp(self, event):
+        return False
+    
+    @args(void, [MotionEvent])
+    def onLongPress(self, event):
+        pass
+    
+    @args(bool, [MotionEvent, MotionEvent, float, float])
+    def onFling(self, e1, e2, velocityX, velocityY):
+        return False
+
+
+"""The following class creates a tile for a `TileView` in a background thread,
+passing it to the view in the main UI thread. Tiles requested before the
+view's sprite or zoom level changed are not created."""
+
+class TileTask(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {
+        "view": TileView, "generation": int, "key": long,
+        "sprite": Sprite, "yscale": int, "level_scale": double,
+        "width": int, "height": int, "tx": int, "ty": int,
+        "tile": Bitmap
+        }
+    
+    @args(void, [TileView, int, long, Sprite, int, double, int, int, int, int])
+    def __init__(self, view, generation, key, sprite, yscale, level_scale,
+                 width, height, tx, ty):
+        
+        Object.__init__(self)
+        
+        self.view = view
+        self.generation = generation
+        self.key = key
+        self.sprite = sprite
+        self.yscale = yscale
+        self.level_scale = level_scale
+        self.width = width
+        self.height = height
+        self.tx = tx
+        self.ty = ty
+        self.tile = None
+    
+    def run(self):
+    
+        if self.generation == self.view.generation.get():
+            self.tile = TileView.createTile(self.sprite, self.yscale,
+                self.level_scale, self.width, self.height, self.tx, self.ty)
+        
+        self.view.post(TileReady(self))
+
+
+"""This class passes a tile created by a `TileTask` to its view in the main UI
+thread."""
+
+class TileReady(Object):
+
+    __interfaces__ = [Runnable]
+    
+    __fields__ = {"task": TileTask}
+    
+    @args(void, [TileTask])
+    def __init__(self, task):
+    
+        Object.__init__(self)
+        self.task = task
+    
+    def run(self):
+    
+        self.task.view.tileReady(self.task)
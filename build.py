@@ -63,10 +63,31 @@ activity_manifest = [
                           "android:mimeType": "*/*",
                           "android:pathPattern": r".*,ff9",
                           "android:host": "*"}),
+                    # Content URIs are accepted with the same patterns.
+                    Data({"android:scheme": "content",
+                          "android:mimeType": "*/*",
+                          "android:pathPattern": r".*\.spr",
+                          "android:host": "*"}),
+                    Data({"android:scheme": "content",
+                          "android:mimeType": "*/*",
+                          "android:pathPattern": r".*\.ff9",
+                          "android:host": "*"}),
+                    Data({"android:scheme": "content",
+                          "android:mimeType": "*/*",
+                          "android:pathPattern": r".*,ff9",
+                          "android:host": "*"}),
                     Action({"android:name": "android.intent.action.VIEW"}),
                     Category({"android:name": "android.intent.category.DEFAULT"}),
                     ])
-                ])
+                ]),
+            # The provider serves sprites as PNG images to other applications,
+            # which are only allowed to read the URIs they are given.
+            Provider({
+                "android:name": "SpriteProvider",
+                "android:authorities": package_name + ".sprites",
+                "android:exported": "false",
+                "android:grantUriPermissions": "true"
+                })
             ])
         ])
     ]
@@ -82,8 +103,7 @@ this_dir = os.path.split(os.path.abspath(__file__))[0]
 docs_dir = os.path.join(this_dir, "Docs")
 
 # We need to allow external storage to be read just to be generally useful,
-# but also need write access so that we can write temporary PNG files for other
-# applications to display.
+# but also need write access so that sprites can be saved as PNG files.
 permissions = ["android.permission.READ_EXTERNAL_STORAGE",
                "android.permission.WRITE_EXTERNAL_STORAGE"]
 
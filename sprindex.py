@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+Copyright (C) 2017 David Boddie <david@boddie.org.uk>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Writes .sprindex files for spritefiles so that they can be copied to a device
+# along with the spritefiles they describe. The format is described in the
+# Sources/spriteindex.py module. Indexes written by this tool do not contain
+# thumbnails.
+
+import os, struct, sys, zlib
+
+MAGIC = b"SPRX"
+VERSION = 1
+HEADER = 40
+RECORD = 40
+SAMPLE = 65536
+
+# The number of bits per pixel for old screen modes and for each sprite type.
+mode_log2bpp = {
+     0: 0,  1: 1,  2: 2,  3: 1,  4: 0,  5: 1,  6: 1,  7: 2,  8: 1,  9: 2,
+    10: 3, 11: 1, 12: 2, 13: 3, 14: 2, 15: 3, 16: 2, 17: 2, 18: 0, 19: 1,
+    20: 2, 21: 3, 22: 2, 23: 0, 24: 3, 25: 0, 26: 1, 27: 2, 28: 3, 29: 0,
+    30: 1, 31: 2, 32: 3, 33: 0, 34: 1, 35: 2, 36: 3, 37: 0, 38: 1, 39: 2,
+    40: 3, 41: 0, 42: 1, 43: 2, 44: 0, 45: 1, 46: 2, 47: 3, 48: 2, 49: 3
+    }
+
+type_log2bpp = {1: 0, 2: 1, 3: 2, 4: 3, 5: 4, 6: 5, 7: 5}
+
+
+def checksum(data):
+
+    sample = data[:SAMPLE]
+    crc = zlib.crc32(sample)
+    crc = zlib.crc32(data[len(data) - len(sample):], crc)
+    return crc & 0xffffffff
+
+
+def read_sprites(data):
+
+    number, offset, free = struct.unpack("<iii", data[:12])
+    offset -= 4
+    free -= 4
+
+    sprites = {}
+
+    while offset < free:
+
+        next, = struct.unpack("<i", data[offset:offset + 4])
+        name = data[offset + 4:offset + 16].split(b"\x00")[0]
+
+        (h_words, v_lines, first_bit, last_bit, image, mask,
+         mode) = struct.unpack("<iiiiiii", data[offset + 16:offset + 44])
+
+        sprite_type = mode >> 27
+        if sprite_type == 0:
+            log2bpp = mode_log2bpp.get(mode & 0x3f)
+        else:
+            log2bpp = type_log2bpp.get(sprite_type)
+
+        if log2bpp is None:
+            width = height = 0
+            mode = palette_hash = flags = 0
+        else:
+            width = ((h_words + 1) * (32 >> log2bpp)) - \
+                    (first_bit >> log2bpp) - ((31 - last_bit) >> log2bpp)
+            height = v_lines + 1
+
+            palette = data[offset + 44:offset + image]
+            if palette:
+                palette_hash = zlib.crc32(palette) & 0xffffffff
+            else:
+                palette_hash = 0
+
+            flags = int(mask != image)
+
+        # Later sprites replace earlier ones with the same name, as in the
+        # application.
+        sprites[name] = (offset, width, height, mode & 0xffffffff,
+                         palette_hash, flags)
+
+        if next <= 0:
+            break
+        offset += next
+
+    return sprites
+
+
+def write_index(path):
+
+    data = open(path, "rb").read()
+    sprites = read_sprites(data)
+    names = sorted(sprites.keys())
+
+    records = HEADER
+    thumbs = records + (len(names) * RECORD)
+
+    # The modification time of the spritefile is not recorded because it is
+    # not preserved when the files are copied to a device.
+    output = [MAGIC, struct.pack("<iqIiiiii", VERSION, len(data),
+                                 checksum(data), len(names), 0, records,
+                                 thumbs, 0)]
+
+    for name in names:
+        offset, width, height, mode, palette_hash, flags = sprites[name]
+        output.append(struct.pack("<12siiiIIii", name, offset, width, height,
+                                  mode, palette_hash, flags, 0))
+
+    index_path = path + ".sprindex"
+    open(index_path, "wb").write(b"".join(output))
+    return index_path, len(names)
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s <spritefile> ...\n" % sys.argv[0])
+        sys.exit(1)
+
+    for path in sys.argv[1:]:
+        try:
+            index_path, count = write_index(path)
+            print("%s: %i sprites" % (index_path, count))
+        except (IOError, struct.error) as e:
+            sys.stderr.write("%s: %s\n" % (path, e))
+
+    sys.exit(0)